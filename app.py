@@ -1,52 +1,197 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response
-import RPi.GPIO as GPIO
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, g
+from drivers import sim_gpio
 import time
 import re
+import atexit
 import json
+import logging
 import os
 import threading
-import requests 
-from datetime import datetime
-from drivers.stepper import A4988
-from drivers.pump_v0 import Pump
+import numpy as np
+from drivers.stepper import A4988, load_channels
+from drivers.pump_v0 import Pump, settle_time_for, FLUIDS_FILE
+from drivers.scheduler import schedule_plan, timing_report
+from drivers.multiaxis import MultiAxis, dispense_together
+from drivers.runtime import Runtime, Cancelled
+from drivers.motion import MotionPlanner
+from drivers.feedback import TimingController
+from drivers.position import PositionStore
+from drivers.calibration import CalibrationStore
+from drivers.program import compile_program, ProgramError
+from drivers.trace import TraceRecorder
+from drivers.simulator import dry_run
+from drivers.worker import ProcessEngine
+from services.events import EventBus, format_sse
+from services.runlog import RunLog
+from services.jobs import Job, JobManager
+from services.logging_config import configure_logging
+from services.programs import ProgramLibrary, PROGRAMS_DIR
+from services.metrics import Registry, CONTENT_TYPE
+
+# Console output goes through a queue drained by a background thread, so moves never block on it.
+# Per-module levels: NMRPI_LOG_LEVELS="INFO,drivers.stepper=DEBUG"
+configure_logging()
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
 app.secret_key = 'your_secret_key'  # Required for flash messages
 
-# Initialize log to store pump actions
-log = []
-
-# Directory to store program files
-PROGRAMS_DIR = 'programs'
-if not os.path.exists(PROGRAMS_DIR):
-    os.makedirs(PROGRAMS_DIR)
-
-# event stuff
-is_paused = threading.Event()
-is_running = False
+# Event bus waking SSE clients as soon as something happens
+events = EventBus()
+
+# Bounded log of pump actions, rolled over to logs/; every entry is also published on the bus
+log = RunLog(events)
+
+# Prometheus metrics, served on /metrics. Per-pulse values are binned once per move.
+metrics = Registry()
+step_lateness = metrics.histogram('nmrpi_step_lateness_seconds', "Lateness of the STEP pulses behind their deadlines.",
+                                  [1E-5, 2E-5, 5E-5, 1E-4, 2E-4, 5E-4, 1E-3, 2E-3, 5E-3, 1E-2, 5E-2], ('channel',))
+step_jitter = metrics.histogram('nmrpi_step_interval_jitter_seconds',
+                                "Interval between consecutive STEP pulses minus its planned value.",
+                                [-1E-3, -2E-4, -5E-5, -1E-5, 0, 1E-5, 5E-5, 2E-4, 1E-3, 5E-3], ('channel',))
+move_error = metrics.histogram('nmrpi_move_duration_error_seconds', "Actual minus planned duration of the moves.",
+                               [-0.05, -0.01, -0.001, 0, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1], ('channel',))
+pause_overshoot = metrics.histogram('nmrpi_pause_overshoot_seconds', "Time PAUSE lines ended after their planned end.",
+                                    [1E-4, 5E-4, 1E-3, 2E-3, 5E-3, 1E-2, 2E-2, 5E-2, 0.1, 0.5])
+queue_wait = metrics.histogram('nmrpi_job_queue_wait_seconds', "Time jobs waited in the queue before running.",
+                               [0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600])
+request_latency = metrics.histogram('nmrpi_http_request_duration_seconds', "Latency of the HTTP handlers.",
+                                    [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+                                    ('route', 'method', 'status'))
+steps_emitted = metrics.counter('nmrpi_steps_total', "STEP pulses played.", ('channel',))
+dispensed = metrics.counter('nmrpi_dispensed_ml_total', "Volume pushed out of the syringes in mL.", ('channel',))
+drift_events = metrics.counter('nmrpi_calibration_drift_total', "Moves whose timing drifted past the recalibration threshold.",
+                               ('channel',))
+
+# Opt-in motion traces: NMRPI_TRACE_DIR=traces writes the STEP edges of every move (see python/trace_tool.py)
+TRACE_DIR_ENV = 'NMRPI_TRACE_DIR'
+recorder = TraceRecorder(os.environ[TRACE_DIR_ENV]) if os.environ.get(TRACE_DIR_ENV) else None
+if recorder is not None:
+    atexit.register(recorder.flush)  # Traces are written by a background thread
+
+def record_move(channel, report):
+    """Feed the timing report of a finished move to the metrics."""
+    steps_emitted.inc(report['steps'], channel=channel)
+    if 'late' in report:
+        step_lateness.observe_many(report['late'], channel=channel)
+        # The planned edges are the played ones minus their lateness
+        edges = report['edges']
+        step_jitter.observe_many(np.diff(edges) - np.diff(edges - report['late']), channel=channel)
+    move_error.observe(report['elapsed'] - report['planned'], channel=channel)
+    if report.get('drifted'):
+        drift_events.inc(channel=channel)
+
+def record_action(channel, kind, **data):
+    """Feed a pump draw/push notification to the metrics."""
+    if kind == 'volume':
+        dispensed.inc(data['volume'], channel=channel)
+
+# Saved programs, indexed in memory; saves are atomic and keep the previous versions
+programs = ProgramLibrary(PROGRAMS_DIR)
 
 # Global variable for pump settings
 pump_settings = {
     'syringe_volume': 5.0,
     'ml_per_rotation': 1.0,
     'step_mode': 'sixteenth',
-    'speed': 0.5
+    'speed': 0.5,
+    'max_accel': 10.0,  # rev/s^2
+    'max_jerk': None,  # rev/s^3; None for a trapezoidal profile
+    'backend': 'gpio',  # Step pulse backend: 'gpio', 'pigpio' (DMA) or 'sim'
+    'fluid': 'default',  # Sets the settle time after draws and pushes (config/fluids.json)
+    'timing': 'absolute',  # 'absolute': lines start at their planned time and pauses catch up; 'relative': one after another
+    'idle_timeout': 5.0  # s the drivers stay energized after the last move (always during a program run); 0 disables right away
 }
 
-# Function to initialize the pump
-def initialize_pump(settings):
-    stepper = A4988(config_file='config/pin_map.json', auto_calibrate=True, speed=settings['speed'], pulseWidth=5E-6)
+# Lines starting later than this (s) behind their planned time are logged
+LATE_WARNING = 0.1
+
+PIN_MAP_FILE = 'config/pin_map.json'
+
+# Function to initialize the pump on one channel of the pin map
+# One store per file, shared by every channel: saves are merged into the file under its lock
+positions = PositionStore()
+calibrations = CalibrationStore()
+
+def initialize_pump(settings, channel=None):
+    planner = MotionPlanner(max_accel=settings['max_accel'], max_jerk=settings['max_jerk'])
+    stepper = A4988(config_file=PIN_MAP_FILE, auto_calibrate=True, speed=settings['speed'], pulseWidth=5E-6,
+                    planner=planner, backend=settings['backend'], feedback=TimingController(), channel=channel,
+                    idle_timeout=settings['idle_timeout'], position_store=positions,
+                    calibration_store=calibrations)
     pump = Pump(
         motor=stepper,
         syringe_volume=settings['syringe_volume'],
         ml_per_rotation=settings['ml_per_rotation'],
-        step_mode=settings['step_mode']
+        step_mode=settings['step_mode'],
+        settle_time=settle_time_for(settings['fluid'])
     )
+    # Draw and volume events go to the bus, tagged with the channel
+    pump.listeners.append(lambda kind, **data: events.publish(kind, channel=stepper.channel, **data))
+    pump.listeners.append(lambda kind, **data: record_action(stepper.channel, kind, **data))
+    stepper.listeners.append(lambda report: record_move(stepper.channel, report))
+    if recorder is not None:
+        recorder.attach(stepper)
     return pump
 
-# Initialize the pump when the app starts
-pump = initialize_pump(pump_settings)
+def initialize_pumps(settings):
+    """Initialize one pump per channel of the pin map, all with the same settings."""
+    return {channel: initialize_pump(settings, channel) for channel in load_channels(PIN_MAP_FILE)}
+
+def configure_pump(channel_pump, settings):
+    """Apply settings to a pump in place; return the names of those that changed."""
+    changed = channel_pump.reconfigure(
+        syringe_volume=settings['syringe_volume'],
+        ml_per_rotation=settings['ml_per_rotation'],
+        step_mode=settings['step_mode'],
+        settle_time=settle_time_for(settings['fluid'])
+    )
+    changed += channel_pump.motor.reconfigure(backend=settings['backend'], max_accel=settings['max_accel'],
+                                              max_jerk=settings['max_jerk'], idle_timeout=settings['idle_timeout'])
+    return changed
+
+# Initialize the pumps when the app starts; the first channel is the default pump
+pumps = initialize_pumps(pump_settings)
+pump = next(iter(pumps.values()))
+
+# Held by a program run and by direct moves; settings only change and pumps only move from
+# requests while no program runs (queued jobs are recompiled)
+run_lock = threading.Lock()
+
+def recalibrate_drifted():
+    """Recalibrates the channels whose timing drifted; called with run_lock held, once nothing moves."""
+    for name, channel_pump in pumps.items():
+        if channel_pump.motor.recalibration_due:
+            channel_pump.motor.recalibrate(background=False)
+            log.append(f"Recalibrated {name} after its step timing drifted.")
+
+# Single timing loop for moves that run on several channels at once. Opt-in step worker:
+# NMRPI_STEP_WORKER=1 plays the pulses in a separate process (drivers.worker), pinned to
+# NMRPI_STEP_CPUS (e.g. "3", a core isolated with isolcpus=3) and run under SCHED_FIFO at
+# NMRPI_STEP_PRIORITY (e.g. 80, needs CAP_SYS_NICE) when those are set
+STEP_WORKER_ENV = 'NMRPI_STEP_WORKER'
+if os.environ.get(STEP_WORKER_ENV, '') not in ('', '0'):
+    step_cpus = {int(cpu) for cpu in os.environ.get('NMRPI_STEP_CPUS', '').split(',') if cpu.strip()}
+    step_priority = int(os.environ.get('NMRPI_STEP_PRIORITY', '0')) or None
+    engine = ProcessEngine(pulseWidth=5E-6, cpus=step_cpus, priority=step_priority)
+    atexit.register(engine.close)
+else:
+    engine = MultiAxis(pulseWidth=5E-6)
+
+# Program runs and multi-channel moves play all channels from one merged timing loop, not
+# through each motor's pulse backend: 'sim' gets its own loop on the simulated GPIO, and
+# pigpio (one DMA pulse train per motor) cannot play them
+sim_engine = MultiAxis(pulseWidth=5E-6, gpio=sim_gpio)
+
+def run_engine():
+    """Engine for program runs and multi-channel moves under the selected pulse backend."""
+    if pump_settings['backend'] == 'sim':
+        return sim_engine
+    if pump_settings['backend'] != 'gpio':
+        raise RuntimeError(f"Program runs and multi-channel moves are not supported with the "
+                           f"'{pump_settings['backend']}' backend; choose 'gpio' or 'sim' in the setup.")
+    return engine
 
 @app.route('/')
 def index():
@@ -57,6 +202,9 @@ def index():
 
 @app.route('/run_pump', methods=['POST'])
 def run_pump():
+    if not run_lock.acquire(blocking=False):
+        log.append("Pump not moved: a program is running. Stop it or wait for it to end.")
+        return redirect(url_for('index'))
     try:
         # Get volume and speed from the form input
         volume = float(request.form['volume'])
@@ -72,31 +220,74 @@ def run_pump():
         return redirect(url_for('index', last_volume=volume, last_speed=speed))
     
     except Exception as e:
-        print(f"Error running pump: {e}")
+        logger.error("Error running pump: %s", e)
         log.append(f"Error running pump: {e}")
         return redirect(url_for('index'))  # Redirect to avoid repeated errors on refresh
+    finally:
+        recalibrate_drifted()
+        run_lock.release()
     
+@app.route('/run_pumps', methods=['POST'])
+def run_pumps():
+    """Dispenses from several channels at once: JSON {channel: {"volume": mL, "speed": rps}}."""
+    if not run_lock.acquire(blocking=False):
+        return jsonify({'status': 'error', 'error': "A program is running. Stop it or wait for it to end."}), 409
+    try:
+        jobs = []
+        for channel, job in request.get_json().items():
+            if channel not in pumps:
+                raise ValueError(f"Unknown channel '{channel}'.")
+            jobs.append((pumps[channel], float(job['volume']), float(job.get('speed', pump_settings['speed']))))
+        dispense_together(run_engine(), jobs)
+        log.append("Moved " + ", ".join(f"{p.motor.channel}: {v} mL at {s} rps" for p, v, s in jobs) + ".")
+        return jsonify({'status': 'done'})
+    except Exception as e:
+        log.append(f"Error running pumps: {e}")
+        return jsonify({'status': 'error', 'error': str(e)}), 400
+    finally:
+        recalibrate_drifted()
+        run_lock.release()
+
 @app.route('/setup')
 def setup():
-    return render_template('setup.html', settings=pump_settings)
+    with open(FLUIDS_FILE, 'r') as file:
+        fluids = list(json.load(file))
+    return render_template('setup.html', settings=pump_settings, fluids=fluids, channels=list(pumps))
     
 @app.route('/setup_pump', methods=['POST'])
 def setup_pump():
+    if not run_lock.acquire(blocking=False):
+        log.append("Settings not changed: a program is running. Stop it or wait for it to end.")
+        return redirect(url_for('setup'))
     try:
         # Update pump settings with form inputs
-        pump_settings['syringe_volume'] = float(request.form['syringe_volume'])
-        pump_settings['ml_per_rotation'] = float(request.form['ml_per_rotation'])
-        pump_settings['step_mode'] = request.form['step_mode']
-        pump_settings['speed'] = float(request.form['speed'])
+        settings = dict(pump_settings)
+        settings['syringe_volume'] = float(request.form['syringe_volume'])
+        settings['ml_per_rotation'] = float(request.form['ml_per_rotation'])
+        settings['step_mode'] = request.form['step_mode']
+        settings['speed'] = float(request.form['speed'])
+        settings['max_accel'] = float(request.form['max_accel'])
+        max_jerk = request.form.get('max_jerk', '').strip()
+        settings['max_jerk'] = float(max_jerk) if max_jerk else None
+        settings['backend'] = request.form.get('backend', settings['backend'])
+        settings['fluid'] = request.form.get('fluid', settings['fluid'])
+        settings['timing'] = request.form.get('timing', settings['timing'])
+        settings['idle_timeout'] = float(request.form.get('idle_timeout', settings['idle_timeout']))
         
-        # Reinitialize the pump with new settings
-        global pump
-        pump = initialize_pump(pump_settings)
+        # Apply the changes to the pumps in place: no new pin setup or calibration
+        changed = set()
+        for channel_pump in pumps.values():
+            changed.update(configure_pump(channel_pump, settings))
+        pump_settings.update(settings)
         
         # Log the setup action
         setup_log = f"Pump reconfigured with: syringe_volume={pump_settings['syringe_volume']} mL, " \
                     f"ml_per_rotation={pump_settings['ml_per_rotation']} mL, " \
-                    f"step_mode={pump_settings['step_mode']}, speed={pump_settings['speed']} rps"
+                    f"step_mode={pump_settings['step_mode']}, speed={pump_settings['speed']} rps, " \
+                    f"max_accel={pump_settings['max_accel']} rev/s^2, max_jerk={pump_settings['max_jerk']} rev/s^3, " \
+                    f"backend={pump_settings['backend']}, fluid={pump_settings['fluid']}, " \
+                    f"timing={pump_settings['timing']}, idle_timeout={pump_settings['idle_timeout']} s " \
+                    f"(changed: {', '.join(sorted(changed)) or 'nothing on the hardware'})"
         log.append(setup_log)
         
         return redirect(url_for('index'))
@@ -105,42 +296,74 @@ def setup_pump():
         error_message = f"Error setting up pump: {e}"
         log.append(error_message)
         return redirect(url_for('setup'))
+    finally:
+        run_lock.release()
+
+@app.route('/recalibrate', methods=['POST'])
+def recalibrate():
+    """Re-measures the stepper timing calibration of the selected channel (default all) while no pump moves."""
+    if not run_lock.acquire(blocking=False):
+        log.append("Not recalibrated: a program is running. Stop it or wait for it to end.")
+        return redirect(url_for('setup'))
+    try:
+        channel = request.form.get('channel')
+        for name, channel_pump in pumps.items():
+            if channel in (None, '', name):
+                channel_pump.motor.recalibrate(background=False)
+    finally:
+        run_lock.release()
+    log.append(f"Recalibrated {channel or 'all channels'}.")
+    return redirect(url_for('setup'))
+
+@app.route('/set_empty', methods=['POST'])
+def set_empty():
+    """Declares the syringes fully pushed: zeroes the step counters of the selected channel (default all)."""
+    if not run_lock.acquire(blocking=False):
+        log.append("Position not zeroed: a program is running. Stop it or wait for it to end.")
+        return redirect(url_for('setup'))
+    try:
+        channel = request.form.get('channel')
+        for name, channel_pump in pumps.items():
+            if channel in (None, '', name):
+                channel_pump.set_empty()
+    finally:
+        run_lock.release()
+    log.append(f"Plunger position zeroed on {channel or 'all channels'}.")
+    return redirect(url_for('setup'))
+
+@app.route('/pump_state', methods=['GET'])
+def pump_state():
+    """Returns the step counter, syringe content and total dispensed volume of every channel."""
+    return jsonify({name: {
+        'position': channel_pump.motor.position,
+        'revolutions': channel_pump.motor.revolutions,
+        'loaded_volume': channel_pump.loaded_volume,
+        'syringe_volume': channel_pump.syringe_volume,
+        'dispensed_volume': channel_pump.dispensed_volume,
+    } for name, channel_pump in pumps.items()})
+
+@app.route('/timing_feedback', methods=['GET'])
+def timing_feedback():
+    """Returns the step timing model learned by the closed-loop controller of every channel (or ?channel=)."""
+    channel = request.args.get('channel')
+    if channel and channel not in pumps:
+        return jsonify({'error': f"Unknown channel '{channel}'."}), 404
+    return jsonify({name: {'buckets': channel_pump.motor.feedback.snapshot()}
+                    for name, channel_pump in pumps.items() if channel in (None, '', name)})
 
 @app.route('/program_editor')
 def program_editor():
     """Displays a simple text box for editing a program."""
     return render_template('program_editor.html')
 
-# Define patterns for parsing each command
-COMMANDS = {
-    'MOVE': r'^MOVE (\d+(\.\d+)?)\s*(ml)?\s*SPEED (\d+(\.\d+)?)\s*(ml/s)?$',
-    'PAUSE': r'^PAUSE (\d+(\.\d+)?)$',
-    'END': r'^END$'
-}
-
-def parse_command(command):
-    """Parse a command line and return the action and values if valid."""
-    command = command.lower()  # Normalize command to lowercase
-    if command.startswith("move"):
-        match = re.match(r'^move (\d+(\.\d+)?)\s*(ml)?\s*speed (\d+(\.\d+)?)\s*(ml/s)?$', command)
-        if match:
-            volume = float(match.group(1))
-            speed = float(match.group(4))
-            return "MOVE", volume, speed
-        else:
-            match = re.match(r'^move (\d+(\.\d+)?)$', command)
-            if match:
-                volume = float(match.group(1))
-                return "MOVE", volume, None
-    elif command.startswith("pause"):
-        match = re.match(r'^pause (\d+(\.\d+)?)$', command)
-        if match:
-            duration = float(match.group(1))
-            return "PAUSE", duration, None
-    elif command == "end":
-        return "END", None, None
-
-    return None, None, None
+def compile_for_pump(program_content):
+    """Compile program text against the current pump settings (cached by content hash)."""
+    return compile_program(
+        program_content,
+        syringe_volume=pump_settings['syringe_volume'],
+        default_speed=pump_settings['speed'],
+        channels=list(pumps)
+    )
 
 @app.route('/save_program', methods=['POST'])
 def save_program():
@@ -159,14 +382,8 @@ def save_program():
         if not safe_program_name:
             raise ValueError("Program name cannot be empty after sanitization.")
         
-        # Ensure the program directory exists
-        if not os.path.exists(PROGRAMS_DIR):
-            os.makedirs(PROGRAMS_DIR)
-
-        # Save the program content to a JSON file
-        program_file = os.path.join(PROGRAMS_DIR, f"{safe_program_name}.json")
-        with open(program_file, 'w', encoding='utf-8') as file:
-            json.dump({'name': program_name, 'content': program_content}, file, ensure_ascii=False, indent=4)
+        # Save the program content to a JSON file (the previous version is kept)
+        programs.save(safe_program_name, program_content, title=program_name)
 
         # Flash success message and redirect
         flash(f"Program '{program_name}' saved successfully.")
@@ -185,121 +402,276 @@ def save_program():
 @app.route('/run_program')
 def run_program():
     """Displays the Run Program page."""
-    programs = [f.replace('.json', '') for f in os.listdir(PROGRAMS_DIR) if f.endswith('.json')]
-    return render_template('run_program.html', programs=programs, log=log)
+    return render_template('run_program.html', programs=programs.names(), log=log)
 
 @app.route('/load_program', methods=['POST'])
 def load_program():
     """Loads and displays a selected program."""
-    program_name = request.form['program_name']
-    program_file = os.path.join(PROGRAMS_DIR, f"{program_name}.json")
-    
-    if os.path.exists(program_file):
-        with open(program_file, 'r') as file:
-            program_data = json.load(file)
-        return jsonify({'content': program_data['content']})
-    else:
+    program = programs.load(request.form['program_name'])
+    if program is None:
         return jsonify({'error': 'Program not found'}), 404
+    return jsonify({'content': program['content'], 'content_hash': program['content_hash']})
 
-def execute_program(program_content):
-    """Runs the program, with the option to pause and resume."""
-    global is_running
-    is_running = True
-    log.clear()  # Clear old logs at the start of execution
+@app.route('/programs', methods=['GET'])
+def list_programs():
+    """Returns the metadata of the saved programs, filtered by ?q= (name, title or text) if given."""
+    query = request.args.get('q', '').strip()
+    return jsonify({'programs': programs.search(query) if query else programs.list()})
 
-    with app.app_context():  # Add application context
-        for line in program_content.splitlines():
-            if not is_running:
-                break
-            is_paused.wait()  # Wait here if paused
+@app.route('/programs/<name>/versions', methods=['GET'])
+def program_versions(name):
+    """Returns the previous versions of a program, or the content of one with ?version=."""
+    try:
+        version = request.args.get('version')
+        if version is None:
+            return jsonify({'name': name, 'versions': programs.versions(name)})
+        content = programs.load_version(name, version)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if content is None:
+        return jsonify({'error': 'Version not found'}), 404
+    return jsonify({'name': name, 'version': version, 'content': content})
+
+def execute_program(plan, job=None):
+    """Runs a compiled program plan; the job (default: a new one) pauses, resumes and cancels it."""
+    job = job or Job(plan)
+    if job.started is not None:
+        queue_wait.observe(job.started - job.submitted)
+    with run_lock:  # Settings cannot change under a run
+        if job.source is not None:
+            # Compiled against the current settings (a cache hit unless they changed while queued)
+            try:
+                plan = job.plan = compile_for_pump(job.source)
+            except ProgramError as e:
+                log.append(f"Program not started: it does not compile with the current settings ({e}).")
+                raise
+        try:
+            run_with = run_engine()
+        except RuntimeError as e:
+            log.append(f"Program not started: {e}")
+            raise
+        try:
+            _execute_plan(plan, job, run_with)
+        finally:
+            recalibrate_drifted()
+
+def _execute_plan(plan, job, run_with):
+    run_id = log.start_run()  # Tag this run's log entries
+    if recorder is not None:
+        recorder.start_run(run_id)
+    events.publish('state', state='running', run_id=run_id, job_id=job.id)
+
+    # Plan the draws across the whole program, starting from what is already in each syringe
+    schedule = schedule_plan(plan, pumps)
+    job.estimated_duration = schedule.estimated_duration
+    log.append(f"Running {len(plan.instructions)} instructions: {plan.total_volume:.2f} mL in "
+               f"{schedule.draws} draws, estimated {schedule.estimated_duration:.1f} s.")
+
+    # Moves started on several channels run side by side on the shared engine; the job's
+    # token pauses or stops them within a few steps
+    runtime = Runtime(pumps, run_with, token=job.token)
+
+    # Keep the drivers energized from line to line; the idle timeout starts when the run ends
+    for channel_pump in runtime.pumps.values():
+        channel_pump.motor.hold()
+
+    # Every line has a planned start on the run clock (monotonic, time paused excluded)
+    absolute = pump_settings['timing'] == 'absolute'
+    executed, planned, actual = [], [], []
 
-            command = line.strip()
-            log.append(f"Executing: {command}")  # Log execution
+    with app.app_context():  # Add application context
+        try:
+            for index, (instruction, actions) in enumerate(zip(plan.instructions, schedule.actions)):
+                job.token.check()
+
+                command = instruction.text
+                log.append(f"Executing: {command}")  # Log execution
+                job.progress = {'instruction': index + 1, 'total': len(plan.instructions),
+                                'line': instruction.line, 'command': command}
+                events.publish('progress', job_id=job.id, **job.progress)
+
+                try:
+                    start = schedule.starts[index]
+                    started = runtime.execute(instruction, actions, at=start if absolute else None)
+                    executed.append(instruction)
+                    planned.append(start)
+                    actual.append(started)
+                    if instruction.action == "PAUSE":
+                        pause_overshoot.observe(runtime.clock() - (start if absolute else started) - instruction.duration)
+                    if started - start > LATE_WARNING:
+                        log.append(f"Line {instruction.line} started {started - start:.2f} s late.",
+                                   planned=start, actual=started)
+                    if instruction.action == "END":
+                        log.append("Program execution complete.")
+                        logger.info("Program execution complete.")
+                        events.publish('state', state='complete', job_id=job.id)
+                        break
+                except Cancelled:
+                    raise
+                except Exception as e:
+                    log.append(f"Error executing command '{command}': {e}")
+                    logger.error("Error executing command '%s': %s", command, e)
+
+            runtime.wait("all")  # Let moves still running at the end of the program finish
+        except Cancelled:
+            log.append("Program stopped.")
+        except Exception as e:
+            log.append(f"Error finishing program: {e}")
+            runtime.cancel()
+        finally:
+            for channel_pump in runtime.pumps.values():
+                channel_pump.motor.release()
+
+        # Planned-vs-actual summary of the run
+        if executed:
+            report = timing_report(executed, planned, actual, schedule.estimated_duration, runtime.clock())
+            log.append(f"Timing: ran {report['actual_duration']:.2f} s of a planned {report['planned_duration']:.2f} s "
+                       f"({report['end_late']:+.2f} s, {runtime.paused_time:.1f} s paused not counted); latest line "
+                       f"{report['max_late_line']} started {report['max_late']:+.3f} s vs plan.", timing=report)
+            events.publish('timing', job_id=job.id, **report)
 
-            try:
-                action, param1, param2 = parse_command(command)
-                if action == "MOVE":
-                    speed = param2 if param2 is not None else pump_settings['speed']
-                    pump.move_volume(param1, speed=speed)
-                elif action == "PAUSE":
-                    time.sleep(param1)
-                elif action == "END":
-                    log.append("Program execution complete.")
-                    print("Program execution complete.")
-
-                    # Trigger the stop logic
-                    requests.post("http://127.0.0.1:5000/stop_program")
-                    break
-                else:
-                    log.append(f"Unknown command: {command}")
-                    print(f"Unknown command: {command}")
-            except Exception as e:
-                log.append(f"Error executing command '{command}': {e}")
-                print(f"Error executing command '{command}': {e}")
-
-        is_running = False
         log.append("Program execution ended.")
-        print("Program execution ended.")
+        log.end_run()
+        events.publish('state', state='ended', run_id=run_id, job_id=job.id)
+        logger.info("Program execution ended.")
+
+# Single worker running queued programs one after another
+jobs = JobManager(execute_program, events)
 
 @app.route('/start_program', methods=['POST'])
 def start_program():
-    """Starts executing the loaded program in a separate thread."""
-    global is_paused, is_running
-    is_paused.set()  # Ensure the thread isn't paused initially
-    is_running = True
+    """Compiles the program and queues it; it starts as soon as the jobs ahead of it are done."""
     program_content = request.form['program_content']
-    print(f"Received program content for execution:\n{program_content}")
-    
-    def complete_program():
-        execute_program(program_content)
-        # Notify the front-end that the program has finished
-        is_running = False
-    
-    thread = threading.Thread(target=complete_program)
-    thread.start()
-    return jsonify({'status': 'started'})
+    logger.debug("Received program content for execution:\n%s", program_content)
+    try:
+        plan = compile_for_pump(program_content)
+    except ProgramError as e:
+        return jsonify({'status': 'error', 'errors': [{'line': line, 'message': message} for line, message in e.errors]}), 400
+    try:
+        run_engine()
+    except RuntimeError as e:
+        return jsonify({'status': 'error', 'errors': [{'line': 0, 'message': str(e)}]}), 400
+
+    # Estimated from the pumps as they are now; the run estimates it again when it starts
+    estimated_duration = schedule_plan(plan, pumps).estimated_duration
+    job = jobs.submit(plan, name=request.form.get('program_name'), source=program_content,
+                      estimated_duration=estimated_duration)
+    return jsonify({'status': 'queued', 'job_id': job.id, 'position': jobs.position(job),
+                    'total_volume': plan.total_volume, 'estimated_duration': estimated_duration})
+
+@app.route('/forecast_program', methods=['POST'])
+def forecast_program():
+    """Dry-runs the program in virtual time on copies of the pumps: timeline, duration, draws and volume per line."""
+    try:
+        plan = compile_for_pump(request.form['program_content'])
+    except ProgramError as e:
+        return jsonify({'status': 'error', 'errors': [{'line': line, 'message': message} for line, message in e.errors]}), 400
+    forecast = dry_run(plan, pumps, absolute=pump_settings['timing'] == 'absolute')
+    return jsonify({'status': 'ok', **forecast})
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    """Returns the queued, running and recently finished jobs."""
+    return jsonify({'jobs': [job.to_dict() for job in jobs.list()]})
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Returns the status and progress of a job."""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({**job.to_dict(), 'position': jobs.position(job)})
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancels a queued job, or stops a running one between two steps."""
+    job = jobs.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
 
 @app.route('/pause_program', methods=['POST'])
 def pause_program():
-    """Pauses the program execution."""
-    is_paused.clear()  # Pause the thread
-    return jsonify({'status': 'paused'})
+    """Pauses the running job."""
+    job = jobs.current
+    if job is None:
+        return jsonify({'status': 'idle'})
+    job.pause()
+    events.publish('state', state='paused', job_id=job.id)
+    return jsonify({'status': 'paused', 'job_id': job.id})
 
 @app.route('/resume_program', methods=['POST'])
 def resume_program():
-    """Resumes the program execution."""
-    is_paused.set()  # Resume the thread
-    return jsonify({'status': 'resumed'})
+    """Resumes the running job."""
+    job = jobs.current
+    if job is None:
+        return jsonify({'status': 'idle'})
+    job.resume()
+    events.publish('state', state='resumed', job_id=job.id)
+    return jsonify({'status': 'resumed', 'job_id': job.id})
 
 @app.route('/stop_program', methods=['POST'])
 def stop_program():
-    """Stops the program execution."""
-    global is_running
-    is_running = False
-    is_paused.set()  # Resume to allow thread to exit if paused
-    return jsonify({'status': 'stopped'})
+    """Stops the running job; queued jobs still run."""
+    job = jobs.current
+    if job is None:
+        return jsonify({'status': 'idle'})
+    jobs.cancel(job.id)
+    events.publish('state', state='stopped', job_id=job.id)
+    return jsonify({'status': 'stopped', 'job_id': job.id})
+
+@app.route('/metrics', methods=['GET'])
+def export_metrics():
+    """Returns the metrics in the Prometheus text format."""
+    return Response(metrics.render(), content_type=CONTENT_TYPE)
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_latency(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    request_latency.observe(time.perf_counter() - g.request_start, route=route, method=request.method,
+                            status=response.status_code)
+    return response
 
 @app.route('/log', methods=['GET'])
 def get_log():
-    return jsonify({'log': log})
+    """Returns the log entries after the optional ?after=<seq> cursor, and the new cursor."""
+    records = log.since(request.args.get('after', 0, type=int))
+    cursor = records[-1]['seq'] if records else request.args.get('after', log.seq, type=int)
+    return jsonify({'log': records, 'cursor': cursor})
+
+@app.route('/log/query', methods=['GET'])
+def query_log():
+    """Returns archived log entries by time range (?start=&end=, epoch seconds) and/or ?run_id=."""
+    records = log.query(start=request.args.get('start', type=float),
+                        end=request.args.get('end', type=float),
+                        run_id=request.args.get('run_id'))
+    return jsonify({'log': records})
 
 @app.route('/log_stream')
 def log_stream():
     def generate_logs():
-        """Generator that yields new log entries as they are added."""
-        last_log_length = 0
-        while True:
-            if len(log) > last_log_length:  # Only send new logs
-                for entry in log[last_log_length:]:
-                    yield f"data: {entry}\n\n"
-                last_log_length = len(log)
-            time.sleep(0.5)  # Prevent high CPU usage
+        """Generator that yields log entries and structured events as soon as they are published."""
+        with events.condition:  # Nothing can be appended between the backlog and subscribing
+            backlog = list(log)
+            subscription = events.subscribe()
+        try:
+            yield ": connected\n\n"  # Sends the response headers straight away
+            for record in backlog:
+                yield f"data: {record['message']}\n\n"
+            while True:
+                published = subscription.get(timeout=15)
+                if not published:
+                    yield ": keep-alive\n\n"  # Lets the server notice disconnected clients
+                for event in published:
+                    yield format_sse(event)
+        finally:
+            subscription.close()
 
     return Response(generate_logs(), content_type='text/event-stream')
 
-@app.teardown_appcontext
-def disable_motor(exception):
-    pump.motor.disable()
-
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,175 @@
+import threading
+import time
+import numpy as np
+from drivers.utils import play_waveform, SPIN_MARGIN
+
+try:
+    import pigpio  # Optional: only needed for the DMA backend
+except ImportError:
+    pigpio = None
+
+class PulseBackend:
+    """
+    Base class for the step pulse generators used by A4988.
+
+    A backend receives the precomputed offsets of a move (see drivers.utils.build_waveform)
+    and produces the STEP pulses. Blocking backends return from play() when the move is
+    done; non-blocking ones return at once and wait() blocks until the move is finished.
+    Both return the move's timing report from wait().
+    """
+    blocking = True
+
+    def __init__(self):
+        self.last_report = None
+
+    def play(self, offsets, pins, pulseWidth, spin_margin=SPIN_MARGIN):
+        raise NotImplementedError
+
+    def busy(self):
+        """Return True while a move is still being played."""
+        return False
+
+    def wait(self):
+        """Block until the current move is done and return its timing report."""
+        return self.last_report
+
+    def close(self):
+        """Release any resources held by the backend."""
+        pass
+
+class GPIOBackend(PulseBackend):
+    """Toggles STEP from Python through RPi.GPIO (drivers.utils.play_waveform)."""
+
+    def play(self, offsets, pins, pulseWidth, spin_margin=SPIN_MARGIN):
+        self.last_report = play_waveform(offsets, pins, pulseWidth, spin_margin=spin_margin)
+        return self.last_report
+
+class SimulatedBackend(PulseBackend):
+    """
+    Produces no pulses at all; every move takes exactly its planned time.
+
+    Args:
+        realtime (bool): Sleep for the planned duration of each move (one sleep per move).
+            If False, moves return immediately.
+    """
+
+    def __init__(self, realtime=True):
+        super().__init__()
+        self.realtime = realtime
+        self.moves = []  # (steps, planned duration) of every move played
+
+    def play(self, offsets, pins, pulseWidth, spin_margin=SPIN_MARGIN):
+        n = len(offsets) - 1
+        planned = float(offsets[n])
+        if self.realtime:
+            time.sleep(planned)
+        self.moves.append((n, planned))
+        self.last_report = {
+            'steps': n,
+            'elapsed': planned,
+            'planned': planned,
+            'mean_late': 0.0,
+            'max_late': 0.0,
+            'p99_late': 0.0,
+        }
+        return self.last_report
+
+class PigpioBackend(PulseBackend):
+    """
+    Hands the pulse train to the pigpio daemon, which plays it with DMA.
+
+    Pulses are uploaded as a series of waves of at most chunk_size steps. A feeder
+    thread queues each wave behind the one being transmitted (WAVE_MODE_ONE_SHOT_SYNC)
+    and frees the finished ones, so play() returns at once and the Python side sleeps
+    for almost the whole move.
+
+    Args:
+        host (str): Host running pigpiod.
+        port (int): pigpiod port.
+        chunk_size (int): Steps per wave; pigpio limits the total pulses held at once.
+    """
+    blocking = False
+
+    def __init__(self, host='localhost', port=8888, chunk_size=2000):
+        super().__init__()
+        if pigpio is None:
+            raise RuntimeError("The pigpio module is not installed; it is required for the pigpio backend.")
+        self.pi = pigpio.pi(host, port)
+        if not self.pi.connected:
+            raise RuntimeError(f"Could not connect to pigpiod at {host}:{port}.")
+        self.chunk_size = chunk_size
+        self.feeder = None
+
+    def play(self, offsets, pins, pulseWidth, spin_margin=SPIN_MARGIN):
+        self.wait()  # Moves are played one after another
+        step_pin = pins['STEP']['number']
+        self.pi.set_mode(step_pin, pigpio.OUTPUT)
+
+        # Pulse high time and the low time up to the next rising edge, in whole microseconds
+        edges = np.rint(np.asarray(offsets) * 1E6).astype(np.int64)
+        high = max(int(round(pulseWidth * 1E6)), 1)
+        lows = np.maximum(np.diff(edges) - high, 1).tolist()
+
+        self.last_report = None
+        self.feeder = threading.Thread(target=self._feed, args=(step_pin, high, lows, float(offsets[-1])), daemon=True)
+        self.feeder.start()
+        return None
+
+    def _feed(self, step_pin, high, lows, planned):
+        mask = 1 << step_pin
+        start_time = time.perf_counter()
+        sent = []  # wave ids queued on the daemon, oldest first
+        for i in range(0, len(lows), self.chunk_size):
+            pulses = []
+            for low in lows[i:i + self.chunk_size]:
+                pulses.append(pigpio.pulse(mask, 0, high))
+                pulses.append(pigpio.pulse(0, mask, low))
+            self.pi.wave_add_generic(pulses)
+            wave_id = self.pi.wave_create()
+            self.pi.wave_send_using_mode(wave_id, pigpio.WAVE_MODE_ONE_SHOT_SYNC)
+            sent.append(wave_id)
+            # Keep at most two waves on the daemon: the one playing and the next one
+            while len(sent) > 1:
+                if self.pi.wave_tx_at() == sent[-1]:
+                    self.pi.wave_delete(sent.pop(0))
+                else:
+                    time.sleep(0.005)
+        while self.pi.wave_tx_busy():
+            time.sleep(0.005)
+        for wave_id in sent:
+            self.pi.wave_delete(wave_id)
+        elapsed = time.perf_counter() - start_time
+        self.last_report = {
+            'steps': len(lows),
+            'elapsed': elapsed,
+            'planned': planned,
+            'mean_late': 0.0,  # DMA timing; not measured per pulse
+            'max_late': 0.0,
+            'p99_late': 0.0,
+        }
+
+    def busy(self):
+        return self.feeder is not None and self.feeder.is_alive()
+
+    def wait(self):
+        if self.feeder is not None:
+            self.feeder.join()
+            self.feeder = None
+        return self.last_report
+
+    def close(self):
+        self.wait()
+        self.pi.wave_tx_stop()
+        self.pi.stop()
+
+BACKENDS = {
+    'gpio': GPIOBackend,
+    'pigpio': PigpioBackend,
+    'sim': SimulatedBackend,
+}
+
+def make_backend(name, **kwargs):
+    """Create a pulse backend by name ('gpio', 'pigpio' or 'sim')."""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown pulse backend '{name}'. Choose from {', '.join(BACKENDS)}.")
+    return BACKENDS[name](**kwargs)
@@ -0,0 +1,26 @@
+import socket
+import time
+
+from drivers.store import JsonStore
+
+CALIBRATION_FILE = 'config/calibration.json'
+
+class CalibrationStore(JsonStore):
+    def __init__(self, path=CALIBRATION_FILE):
+        """
+        Persists stepper calibration results between runs.
+
+        Args:
+            path (str): JSON file holding one entry per host and driver configuration; None
+                keeps the entries in memory only (e.g. for a benchmark).
+        """
+        super().__init__(path)
+
+    @staticmethod
+    def key(pulseWidth, backend):
+        """Key of a calibration: the host plus the driver settings that affect timing."""
+        return f"{socket.gethostname()}|{type(backend).__name__}|pulseWidth={pulseWidth:g}"
+
+    def save(self, key, sleep_overhead):
+        """Store a calibration result."""
+        self.put(key, {'sleep_overhead': sleep_overhead, 'timestamp': time.time()})
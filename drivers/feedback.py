@@ -0,0 +1,102 @@
+import copy
+import threading
+import numpy as np
+
+def steady_elapsed(report):
+    """
+    Duration of a move at its typical step rate: the planned duration times the median
+    ratio of the played to the scheduled interval between steps.
+
+    A stall stretches a few intervals (and the catch-up after it shortens a few) without
+    moving the median, so one hiccup does not make the next moves run faster. Reports
+    without edge times (simulated or pigpio moves) keep their measured elapsed time.
+    """
+    edges = report.get('edges')
+    if edges is None or len(edges) < 3:
+        return report['elapsed']
+    played = np.diff(edges)
+    scheduled = np.diff(edges - report['late'])
+    valid = scheduled > 0
+    if not valid.any():
+        return report['elapsed']
+    return report['planned'] * float(np.median(played[valid] / scheduled[valid]))
+
+class TimingController:
+    def __init__(self, gain=0.5, min_scale=0.8, max_scale=1.2, smoothing=0.3):
+        """
+        Learns the real duration of moves and corrects the timing of later ones.
+
+        Moves are grouped in (step mode, speed) buckets. For each bucket the controller
+        keeps a running (exponentially weighted) average of the measured cost of one step
+        and a time scale applied to the step schedule of the next move in that bucket,
+        so the delivered speed converges to the requested one.
+
+        Args:
+            gain (float): Fraction of the measured error corrected after each move (0-1).
+            min_scale (float): Lower bound of the schedule time scale.
+            max_scale (float): Upper bound of the schedule time scale.
+            smoothing (float): Weight of the newest move in the running step-cost average.
+        """
+        self.gain = gain
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.smoothing = smoothing
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def bucket(stepMode, speed):
+        return (stepMode, round(speed, 3))
+
+    def scale(self, stepMode, speed):
+        """Time scale to apply to the schedule of a move (1.0 for no correction)."""
+        entry = self.buckets.get(self.bucket(stepMode, speed))
+        return entry['scale'] if entry else 1.0
+
+    def slowness(self, stepMode, speed):
+        """Measured duration of the last move over its (corrected) schedule (1.0 if none yet)."""
+        entry = self.buckets.get(self.bucket(stepMode, speed))
+        return entry['slowness'] if entry else 1.0
+
+    def update(self, stepMode, speed, steps, target, elapsed):
+        """
+        Feed back the result of a move.
+
+        Args:
+            steps (int): Steps in the move.
+            target (float): Duration the move should have taken (uncorrected plan), in s.
+            elapsed (float): Duration the move actually took, in s; see steady_elapsed() for
+                one that a stall does not inflate.
+        """
+        if steps == 0 or target <= 0 or elapsed <= 0:
+            return
+        key = self.bucket(stepMode, speed)
+        with self.lock:
+            entry = self.buckets.setdefault(key, {'scale': 1.0, 'step_cost': elapsed / steps, 'error': 0.0,
+                                                  'slowness': 1.0, 'moves': 0})
+            entry['step_cost'] += self.smoothing * (elapsed / steps - entry['step_cost'])
+            entry['error'] = elapsed / target - 1
+            entry['slowness'] = elapsed / (target * entry['scale'])  # The move was scheduled with the current scale
+            entry['scale'] *= (target / elapsed) ** self.gain
+            entry['scale'] = min(max(entry['scale'], self.min_scale), self.max_scale)
+            entry['moves'] += 1
+
+    def copy(self):
+        """Independent controller with the same settings and everything learned so far."""
+        with self.lock:
+            twin = TimingController(self.gain, self.min_scale, self.max_scale, self.smoothing)
+            twin.buckets = copy.deepcopy(self.buckets)
+        return twin
+
+    def reset(self):
+        """Forget everything learned so far."""
+        with self.lock:
+            self.buckets.clear()
+
+    def snapshot(self):
+        """Return the learned model as a list of plain dicts (for monitoring)."""
+        with self.lock:
+            return [
+                {'step_mode': mode, 'speed': speed, **entry}
+                for (mode, speed), entry in sorted(self.buckets.items())
+            ]
@@ -0,0 +1,14 @@
+"""
+Selects the GPIO implementation used by the drivers.
+
+Set NMRPI_GPIO=sim to use the simulated drivers.sim_gpio module (for benchmarks and
+development off the Pi). Otherwise RPi.GPIO is used, and failing to import it is an
+error: on the Pi, silently running on the simulator would report moves that never
+reached the motors.
+"""
+import os
+
+if os.environ.get('NMRPI_GPIO', '').lower() == 'sim':
+    from drivers import sim_gpio as GPIO
+else:
+    import RPi.GPIO as GPIO
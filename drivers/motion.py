@@ -0,0 +1,116 @@
+import numpy as np
+
+class MotionPlanner:
+    def __init__(self, max_accel=10.0, max_jerk=None, start_speed=0.25, cache_size=256):
+        """
+        Plans accel/cruise/decel step schedules for the stepper.
+
+        Args:
+            max_accel (float): Maximum acceleration in rev/s^2.
+            max_jerk (float): Maximum jerk in rev/s^3. None gives a trapezoidal profile,
+                a value gives a jerk-limited S-curve.
+            start_speed (float): Speed in rps the motor can start and stop at without ramping.
+            cache_size (int): Maximum number of schedules kept in the cache.
+        """
+        if max_accel <= 0:
+            raise ValueError("max_accel must be greater than zero.")
+        if max_jerk is not None and max_jerk <= 0:
+            raise ValueError("max_jerk must be greater than zero.")
+        self.max_accel = max_accel
+        self.max_jerk = max_jerk
+        self.start_speed = start_speed
+        self.cache_size = cache_size
+        self.cache = {}  # (steps, speed, stepMode) -> step offsets
+
+    def clear_cache(self):
+        """Forget all cached schedules (call after changing the limits)."""
+        self.cache.clear()
+
+    def set_limits(self, max_accel, max_jerk=None):
+        """Change the acceleration and jerk limits in place; return True (and clear the cache) if they changed."""
+        if max_accel <= 0:
+            raise ValueError("max_accel must be greater than zero.")
+        if max_jerk is not None and max_jerk <= 0:
+            raise ValueError("max_jerk must be greater than zero.")
+        if (max_accel, max_jerk) == (self.max_accel, self.max_jerk):
+            return False
+        self.max_accel = max_accel
+        self.max_jerk = max_jerk
+        self.clear_cache()  # Schedules planned with the old limits
+        return True
+
+    def schedule(self, steps, speed, stepMode, spr):
+        """
+        Return the step offsets for a move, in the format of drivers.utils.build_waveform.
+
+        Args:
+            steps (int): Number of steps in the move.
+            speed (float): Cruise speed in revolutions per second.
+            stepMode (str): Step mode of the move; part of the cache key.
+            spr (int): Steps per revolution in that step mode.
+        """
+        key = (steps, speed, stepMode)
+        offsets = self.cache.get(key)
+        if offsets is None:
+            offsets = self._plan(steps, speed * spr, self.start_speed * spr, self.max_accel * spr,
+                                 self.max_jerk * spr if self.max_jerk is not None else None)
+            offsets.setflags(write=False)  # Shared between moves, so keep it read-only
+            if len(self.cache) >= self.cache_size:
+                self.cache.pop(next(iter(self.cache)))  # Drop the oldest schedule
+            self.cache[key] = offsets
+        return offsets
+
+    def _ramp_time(self, dv, accel, jerk):
+        """Time to change speed by dv steps/s without exceeding the acceleration and jerk limits."""
+        if jerk is None:
+            return dv / accel
+        # Half-cosine velocity ramp: peak accel = pi*dv/(2T), peak jerk = pi^2*dv/(2T^2)
+        return max(np.pi * dv / (2 * accel), np.pi * np.sqrt(dv / (2 * jerk)))
+
+    def _ramp_position(self, t, v0, dv, T, jerk):
+        """Steps covered at time(s) t into a ramp from v0 to v0 + dv lasting T seconds."""
+        if jerk is None:
+            return v0 * t + 0.5 * dv / T * t ** 2
+        return v0 * t + 0.5 * dv * (t - T / np.pi * np.sin(np.pi * t / T))
+
+    def _plan(self, steps, v_max, v0, accel, jerk):
+        """Build the offsets array for one move; all quantities are in steps and seconds."""
+        v0 = min(v0, v_max)
+        if steps == 0:
+            return np.zeros(1)
+        if v0 >= v_max:
+            return np.arange(steps + 1, dtype=np.float64) / v_max
+
+        def ramp_distance(vp):
+            return (v0 + vp) / 2 * self._ramp_time(vp - v0, accel, jerk)
+
+        # Short moves never reach cruise speed: lower the peak until both ramps fit
+        v_peak = v_max
+        if 2 * ramp_distance(v_peak) > steps:
+            lo, hi = v0, v_max
+            for _ in range(50):
+                mid = (lo + hi) / 2
+                if 2 * ramp_distance(mid) > steps:
+                    hi = mid
+                else:
+                    lo = mid
+            v_peak = lo
+        if v_peak <= v0:
+            return np.arange(steps + 1, dtype=np.float64) / v0
+        dv = v_peak - v0
+        T = self._ramp_time(dv, accel, jerk)
+        D = ramp_distance(v_peak)
+        cruise_time = (steps - 2 * D) / v_peak
+        total_time = 2 * T + cruise_time
+
+        # Invert the ramp's position curve on a dense grid, then place every step at once
+        t_grid = np.linspace(0, T, int(min(max(4 * D, 64), 1E5)))
+        s_grid = self._ramp_position(t_grid, v0, dv, T, jerk)
+
+        k = np.arange(steps + 1, dtype=np.float64)
+        offsets = T + (k - D) / v_peak  # cruise
+        up = k <= D
+        offsets[up] = np.interp(k[up], s_grid, t_grid)
+        down = k >= steps - D
+        offsets[down] = total_time - np.interp(steps - k[down], s_grid, t_grid)
+        return offsets
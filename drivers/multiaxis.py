@@ -0,0 +1,275 @@
+import time
+from itertools import zip_longest
+import numpy as np
+from drivers.gpio import GPIO
+from drivers.utils import SPIN_MARGIN, CATCH_UP, lateness_stats
+from drivers.pump_v0 import split_volume
+from drivers.scheduler import schedule_refills
+
+class MultiAxis:
+    def __init__(self, pulseWidth=5E-6, spin_margin=SPIN_MARGIN, check_every=16, gpio=None, catch_up=CATCH_UP):
+        """
+        Plays the STEP pulses of several A4988 channels from one timing loop.
+
+        The pulse trains of all running moves are merged into a single array of
+        absolute deadlines (sorted by time), so several motors step concurrently at
+        their own rates without a thread per motor. Moves can be started while others
+        are running; run_until() plays everything due up to a deadline. As in
+        drivers.utils.play_waveform, no pulse follows the previous pulse of its axis sooner
+        than its planned interval shortened by catch_up, so an axis that fell behind
+        catches up gradually instead of in a burst.
+
+        Args:
+            pulseWidth (float): STEP pulse width in s.
+            spin_margin (float): Busy-wait this long before each deadline instead of sleeping.
+            check_every (int): Pulses played between two checks of the cancel/pause token.
+            gpio (module): GPIO module the STEP pins are written to (default drivers.gpio.GPIO);
+                drivers.sim_gpio plays the moves of the 'sim' backend without touching the pins.
+            catch_up (float): Fraction by which an axis that fell behind may run faster than planned.
+        """
+        self.gpio = gpio or GPIO
+        self.pulseWidth = pulseWidth
+        self.spin_margin = spin_margin
+        self.check_every = check_every
+        self.catch_up = catch_up
+        self.times = np.empty(0)  # Absolute deadlines of the pending pulses (perf_counter clock)
+        self.pins = np.empty(0, dtype=np.int64)  # STEP pin of each pending pulse
+        self.owners = np.empty(0, dtype=np.int64)  # Axis id of each pending pulse
+        self.intervals = np.empty(0)  # Shortest interval allowed since the previous pulse of the same axis
+        self.last_edges = []  # axis id -> time of its last pulse (or of the start of its move)
+        self.axes = {}  # name -> state of the move running on that axis
+        self.ids = {}  # name -> axis id
+
+    def start(self, name, motor, offsets, at=None):
+        """
+        Queue a move prepared with motor.prepare_move() to start at time `at`
+        (perf_counter seconds, default now). The motor's finish_move() is called
+        when the move is done.
+        """
+        if name in self.axes:
+            raise RuntimeError(f"Axis '{name}' is already moving.")
+        start = time.perf_counter() if at is None else at
+        axis_id = self.ids.setdefault(name, len(self.ids))
+        n = len(offsets) - 1
+        self.axes[name] = {'motor': motor, 'start': start, 'end': start + float(offsets[n]),
+                           'planned': float(offsets[n]), 'steps': n, 'remaining': n, 'late': [], 'edges': []}
+        self._merge(axis_id, motor.step_pin, start, offsets, np.ones(len(self.times), dtype=bool))
+
+    def _merge(self, axis_id, pin, start, offsets, keep):
+        """Merge the pulses of a move starting at start into the pending ones selected by keep."""
+        n = len(offsets) - 1
+        offsets = np.asarray(offsets)
+        intervals = np.diff(offsets[:n], prepend=offsets[0]) * (1 - self.catch_up)
+        times = np.concatenate([self.times[keep], start + offsets[:n]])
+        order = np.argsort(times, kind='stable')
+        self.times = times[order]
+        self.pins = np.concatenate([self.pins[keep], np.full(n, pin, dtype=np.int64)])[order]
+        self.owners = np.concatenate([self.owners[keep], np.full(n, axis_id, dtype=np.int64)])[order]
+        self.intervals = np.concatenate([self.intervals[keep], intervals])[order]
+        self.last_edges.extend([start] * (axis_id + 1 - len(self.last_edges)))
+        self.last_edges[axis_id] = start
+
+    def busy(self, name=None):
+        """Return True while the named axis (or any axis) is moving."""
+        return name in self.axes if name is not None else bool(self.axes)
+
+    def end_time(self, name):
+        """Planned end of the move running on the named axis (perf_counter seconds)."""
+        return self.axes[name]['end']
+
+    def run_until(self, deadline=None, token=None):
+        """
+        Play every pulse due before deadline (default: the end of all running moves),
+        wait until the deadline, and finish the moves that are done by then.
+
+        With a token (drivers.runtime.CancelToken), playing is checked every
+        check_every pulses and whenever the loop sleeps, and stops once the token is
+        paused or cancelled; the pulses not played stay pending (see resume() and cancel()).
+
+        Returns {name: timing report} of the finished moves.
+        """
+        if deadline is None:
+            deadline = max((axis['end'] for axis in self.axes.values()), default=time.perf_counter())
+        n = int(np.searchsorted(self.times, deadline, side='right'))
+
+        clock = time.perf_counter
+        sleep = token.sleep if token is not None else time.sleep  # The token's sleep returns True when interrupted
+        output = self.gpio.output
+        high, low = self.gpio.HIGH, self.gpio.LOW
+        pulseWidth = self.pulseWidth
+        spin_margin = self.spin_margin
+        deadlines = self.times[:n].tolist()
+        pins = self.pins[:n].tolist()
+        owners = self.owners[:n].tolist()
+        intervals = self.intervals[:n].tolist()
+        last_edges = self.last_edges
+        actual = [0.0] * n
+
+        played = 0
+        next_check = 0 if token is not None else n  # Index of the next pulse before which the token is read
+        for i in range(n):
+            if i == next_check:
+                if token.interrupted:
+                    break
+                next_check += self.check_every
+            owner = owners[i]
+            due = max(deadlines[i], last_edges[owner] + intervals[i])
+            gap = due - clock()
+            if gap > spin_margin and sleep(gap - spin_margin):
+                break
+            while clock() < due:
+                pass
+            pin = pins[i]
+            output(pin, high)
+            t = clock()
+            actual[i] = t
+            last_edges[owner] = t
+            while clock() - t < pulseWidth:
+                pass
+            output(pin, low)
+            played += 1
+
+        # Attribute the lateness of the played pulses to their axes
+        if played:
+            edges = np.asarray(actual[:played])
+            late = edges - self.times[:played]
+            owners = self.owners[:played]
+            for name, axis in self.axes.items():
+                mine = owners == self.ids[name]
+                count = int(np.count_nonzero(mine))
+                if count:
+                    axis['late'].append(late[mine])
+                    axis['edges'].append(edges[mine])
+                    axis['remaining'] -= count
+            self.times = self.times[played:]
+            self.pins = self.pins[played:]
+            self.owners = self.owners[played:]
+            self.intervals = self.intervals[played:]
+        if token is not None and token.interrupted:
+            return {}
+
+        gap = deadline - clock()
+        if gap > spin_margin and sleep(gap - spin_margin):
+            return {}
+        while clock() < deadline:
+            pass
+
+        finished = {}
+        now = clock()
+        for name, axis in list(self.axes.items()):
+            if axis['remaining'] == 0 and axis['end'] <= now:
+                del self.axes[name]
+                report = {
+                    'steps': axis['steps'],
+                    'elapsed': now - axis['start'],
+                    'planned': axis['planned'],
+                    **lateness_stats(*self._played(axis)),
+                }
+                finished[name] = axis['motor'].finish_move(report)
+        return finished
+
+    @staticmethod
+    def _played(axis):
+        """Lateness and edge times of the pulses an axis has played."""
+        if not axis['late']:
+            return np.zeros(0), np.zeros(0)
+        return np.concatenate(axis['late']), np.concatenate(axis['edges'])
+
+    def resume(self):
+        """
+        Restart the moves interrupted by a pause from where they stopped.
+
+        The remaining steps of each move are rescheduled from now with the motor's
+        remaining_waveform() (ramped up again from a standstill); the time spent paused
+        is left out of the moves' timing reports.
+        """
+        now = time.perf_counter() + 1E-3  # Slightly ahead so the first pulses are not late
+        for name, axis in self.axes.items():
+            mine = self.owners == self.ids[name]
+            if not mine.any():
+                axis['start'] += max(now - axis['end'], 0.0)
+                axis['end'] = max(axis['end'], now)
+                continue
+            first = float(self.times[mine][0])
+            offsets = axis['motor'].remaining_waveform(axis['remaining'])
+            n = len(offsets) - 1
+            axis['planned'] += float(offsets[n]) - (axis['end'] - first)
+            axis['start'] += now - first
+            axis['end'] = now + float(offsets[n])
+            self._merge(self.ids[name], axis['motor'].step_pin, now, offsets, ~mine)
+
+    def cancel(self):
+        """
+        Drop every pending pulse and finish the running moves where they stand.
+
+        Returns {name: fraction of the move's steps that were played}.
+        """
+        self.times = self.times[:0]
+        self.pins = self.pins[:0]
+        self.owners = self.owners[:0]
+        self.intervals = self.intervals[:0]
+        done = {}
+        now = time.perf_counter()
+        for name, axis in list(self.axes.items()):
+            del self.axes[name]
+            played = axis['steps'] - axis['remaining']
+            fraction = played / axis['steps'] if axis['steps'] else 1.0
+            axis['motor'].finish_move({
+                'steps': played,
+                'elapsed': now - axis['start'],
+                'planned': axis['planned'] * fraction,
+                **lateness_stats(*self._played(axis)),
+                'cancelled': True,
+            })
+            done[name] = fraction
+        return done
+
+    def move(self, moves):
+        """
+        Move several motors at the same time and wait for all of them.
+
+        Args:
+            moves (dict): name -> (motor, keyword arguments of motor.prepare_move()).
+
+        Returns {name: timing report}.
+        """
+        prepared = {name: motor.prepare_move(**kwargs)[0] for name, (motor, kwargs) in moves.items()}
+        start = time.perf_counter() + 1E-3  # Common start, slightly ahead so the first pulses are not late
+        for name, offsets in prepared.items():
+            self.start(name, moves[name][0], offsets, at=start)
+        return self.run_until()
+
+def dispense_together(engine, jobs):
+    """
+    Dispense from several pumps at once, each at its own speed.
+
+    The draw/push actions of every pump are run phase by phase: the n-th action of
+    all pumps is played in one merged waveform, then the longest settle time of the
+    pumps involved is waited.
+
+    Args:
+        engine (MultiAxis): Engine driving the pumps' motors.
+        jobs (list): (pump, volume in mL, speed in rps) per pump.
+    """
+    plans = []
+    for pump, volume, speed in jobs:
+        if volume <= 0:
+            raise ValueError("Volume must be greater than zero.")
+        actions = schedule_refills([split_volume(volume, pump.syringe_volume)],
+                                   pump.syringe_volume, pump.loaded_volume)[0][0]
+        plans.append((pump, speed, actions))
+
+    for phase in zip_longest(*[actions for _, _, actions in plans]):
+        moves = {}
+        done = []
+        for (pump, speed, _), action in zip(plans, phase):
+            if action is None:
+                continue
+            kind, volume = action
+            pump.check_action(kind, volume)
+            moves[pump.motor.channel] = (pump.motor, pump.motor_move(kind, volume, speed))
+            done.append((pump, kind, volume))
+        engine.move(moves)
+        for pump, kind, volume in done:
+            pump.complete_action(kind, volume)
+        time.sleep(max(pump.settle_time for pump, _, _ in done))
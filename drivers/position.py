@@ -0,0 +1,18 @@
+from drivers.store import JsonStore
+
+POSITION_FILE = 'config/position.json'
+
+class PositionStore(JsonStore):
+    def __init__(self, path=POSITION_FILE):
+        """
+        Persists the step counters of every channel between runs.
+
+        Args:
+            path (str): JSON file holding one entry per channel; None keeps the entries in
+                memory only (e.g. for a dry run).
+        """
+        super().__init__(path)
+
+    def save(self, channel, state):
+        """Store the state of a channel."""
+        self.put(channel, state)
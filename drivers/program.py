@@ -1,19 +1,165 @@
-import time
-
-class Program:
-    def __init__(self, pump):
-        self.pump = pump
-
-    def parse_and_execute(self, commands):
-        lines = commands.split('\n')
-        for line in lines:
-            if 'pump' in line:
-                volume = float(line.split()[1])
-                self.pump.move_volume(volume, speed=1)
-            elif 'wait' in line:
-                wait_time = int(line.split()[1])
-                print(f"Waiting for {wait_time} seconds...")
-                time.sleep(wait_time)
-            elif 'repeat' in line:
-                # Handle repeat logic if needed
-                pass
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from drivers.pump_v0 import split_volume
+
+# Program grammar, matched case-insensitively against each stripped line:
+#   [start] move <mL> [ml] [speed <rps> [ml/s]] [on <channel>]
+#   wait all | wait any | wait <channel>
+#   pause <s>
+#   repeat <n> ... end repeat
+#   end
+MOVE_PATTERN = re.compile(r'^(start )?move (\d+(\.\d+)?)\s*(ml)?(\s*speed (\d+(\.\d+)?)\s*(ml/s)?)?(\s+on (\w+))?$', re.IGNORECASE)
+WAIT_PATTERN = re.compile(r'^wait (\w+)$', re.IGNORECASE)
+PAUSE_PATTERN = re.compile(r'^pause (\d+(\.\d+)?)$', re.IGNORECASE)
+REPEAT_PATTERN = re.compile(r'^repeat (\d+)$', re.IGNORECASE)
+END_REPEAT_PATTERN = re.compile(r'^end ?repeat$', re.IGNORECASE)
+END_PATTERN = re.compile(r'^end$', re.IGNORECASE)
+
+class ProgramError(ValueError):
+    """Raised when a program does not compile; errors is a list of (line number, message)."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("; ".join(f"line {line}: {message}" for line, message in errors))
+
+@dataclass(frozen=True)
+class Instruction:
+    line: int  # 1-based line number in the program text
+    text: str
+    action: str  # "MOVE", "START", "WAIT", "PAUSE" or "END"
+    volume: float = None  # mL, MOVE/START only
+    speed: float = None  # rps, MOVE/START only
+    duration: float = None  # s, PAUSE only
+    cycles: tuple = ()  # Volumes of the draw-push cycles of a MOVE/START
+    channel: str = None  # Pump channel of a MOVE/START (None for the default channel)
+    wait_for: str = None  # WAIT only: "all", "any" or a channel name
+
+@dataclass(frozen=True)
+class Plan:
+    instructions: tuple
+    content_hash: str
+    total_volume: float  # mL
+
+# Compiled plans keyed by content hash and the settings they were compiled with
+_plan_cache = OrderedDict()
+_plan_cache_lock = threading.Lock()  # Programs are compiled from request threads and the job worker
+PLAN_CACHE_SIZE = 128
+
+def compile_program(content, syringe_volume, default_speed, max_speed=5.0, max_cycles=20, channels=None,
+                    max_instructions=100000):
+    """
+    Compile program text into a validated execution plan.
+
+    MOVE waits for its move to finish; START begins a move on a channel and goes on
+    at once, and WAIT blocks until all, any or one of the started channels is idle.
+    REPEAT blocks are unrolled here, so running a loop costs nothing per line. How long
+    a plan takes depends on the pumps it runs on: see drivers.scheduler.schedule_plan.
+
+    Args:
+        content (str): Program text, one command per line (blank lines are ignored).
+        syringe_volume (float): Syringe volume in mL, used to split moves into cycles.
+        default_speed (float): Speed in rps of MOVE lines without a SPEED.
+        max_speed (float): Highest accepted speed in rps.
+        max_cycles (int): Highest accepted number of draw-push cycles for one MOVE.
+        channels (iterable): Valid channel names; None accepts any name.
+        max_instructions (int): Highest accepted number of instructions after unrolling.
+
+    Raises:
+        ProgramError: listing every invalid line.
+    """
+    content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    channels = tuple(channels) if channels is not None else None
+    key = (content_hash, syringe_volume, default_speed, max_speed, max_cycles, channels, max_instructions)
+    with _plan_cache_lock:
+        plan = _plan_cache.get(key)
+        if plan is not None:
+            _plan_cache.move_to_end(key)
+            return plan
+
+    blocks = [[]]  # Instruction lists of the enclosing REPEAT blocks; blocks[0] is the program
+    repeats = []  # (line, count) of the open REPEAT blocks
+    errors = []
+    for number, raw in enumerate(content.splitlines(), start=1):
+        text = raw.strip()
+        if not text:
+            continue
+        match = MOVE_PATTERN.match(text)
+        if match:
+            volume = float(match.group(2))
+            speed = float(match.group(6)) if match.group(6) else default_speed
+            channel = match.group(10)
+            if volume <= 0:
+                errors.append((number, "Volume must be greater than zero."))
+                continue
+            if not 0 < speed <= max_speed:
+                errors.append((number, f"Speed must be greater than zero and at most {max_speed} rps."))
+                continue
+            if channel is not None and channels is not None and channel not in channels:
+                errors.append((number, f"Unknown channel '{channel}'."))
+                continue
+            cycles = tuple(split_volume(volume, syringe_volume))
+            if len(cycles) > max_cycles:
+                errors.append((number, f"{volume} mL needs {len(cycles)} syringe cycles (at most {max_cycles} allowed)."))
+                continue
+            blocks[-1].append(Instruction(number, text, "START" if match.group(1) else "MOVE", volume=volume,
+                                          speed=speed, cycles=cycles, channel=channel))
+            continue
+        match = WAIT_PATTERN.match(text)
+        if match:
+            wait_for = match.group(1)
+            if wait_for.lower() in ("all", "any"):
+                wait_for = wait_for.lower()
+            elif channels is not None and wait_for not in channels:
+                errors.append((number, f"Unknown channel '{wait_for}'."))
+                continue
+            blocks[-1].append(Instruction(number, text, "WAIT", wait_for=wait_for))
+            continue
+        match = PAUSE_PATTERN.match(text)
+        if match:
+            duration = float(match.group(1))
+            blocks[-1].append(Instruction(number, text, "PAUSE", duration=duration))
+            continue
+        match = REPEAT_PATTERN.match(text)
+        if match:
+            repeats.append((number, int(match.group(1))))
+            blocks.append([])
+            continue
+        if END_REPEAT_PATTERN.match(text):
+            if not repeats:
+                errors.append((number, "END REPEAT without REPEAT."))
+                continue
+            line, count = repeats.pop()
+            body = blocks.pop()
+            # Checked before unrolling: a huge count must not build the list first
+            if len(blocks[-1]) + len(body) * count > max_instructions:
+                errors.append((line, f"Program unrolls to more than {max_instructions} instructions."))
+                break
+            blocks[-1].extend(body * count)
+            continue
+        if END_PATTERN.match(text):
+            if repeats:
+                errors.append((number, "END inside a REPEAT block."))
+                continue
+            blocks[-1].append(Instruction(number, text, "END"))
+            break  # Nothing after END is executed
+        errors.append((number, f"Unknown command: {text}"))
+    for number, _ in repeats:
+        errors.append((number, "REPEAT without END REPEAT."))
+
+    if errors:
+        raise ProgramError(errors)
+
+    instructions = blocks[0]
+    plan = Plan(
+        instructions=tuple(instructions),
+        content_hash=content_hash,
+        total_volume=sum(i.volume for i in instructions if i.action in ("MOVE", "START")),
+    )
+    with _plan_cache_lock:
+        _plan_cache[key] = plan
+        if len(_plan_cache) > PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+    return plan
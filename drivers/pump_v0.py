@@ -1,7 +1,45 @@
+import json
+import logging
 import time
+from collections import deque
+from drivers.scheduler import schedule_refills
+
+logger = logging.getLogger(__name__)
+
+FLUIDS_FILE = 'config/fluids.json'
+
+def settle_time_for(fluid, fluids_file=FLUIDS_FILE):
+    """Look up the settle time (s) of a fluid in the fluids file, falling back to its 'default' entry."""
+    with open(fluids_file, 'r') as file:
+        settle_times = json.load(file)
+    return float(settle_times.get(fluid, settle_times['default']))
+
+def split_volume(volume, syringe_volume):
+    """
+    Split a volume into the draw-push cycles used to dispense it.
+
+    Volumes within the syringe capacity take one cycle, volumes between one and two
+    syringe volumes are split into two equal cycles, and larger volumes use full
+    syringes until the remainder falls into one of the first two cases.
+    """
+    cycles = []
+    remaining_volume = volume
+    while remaining_volume > 1E-9:  # Ignore floating point residue
+        if remaining_volume <= syringe_volume:
+            # Single cycle if remaining volume is within syringe capacity
+            volume_to_dispense = remaining_volume
+        elif syringe_volume < remaining_volume <= 2 * syringe_volume:
+            # Split volume into two equal cycles if between 1 and 2 syringe volumes
+            volume_to_dispense = remaining_volume / 2
+        else:
+            # Use full syringe volume if more than 2 syringe volumes are needed
+            volume_to_dispense = syringe_volume
+        cycles.append(volume_to_dispense)
+        remaining_volume -= volume_to_dispense
+    return cycles
 
 class Pump:
-    def __init__(self, motor, syringe_volume=5.0, ml_per_rotation=1.0, step_mode="full"):
+    def __init__(self, motor, syringe_volume=5.0, ml_per_rotation=1.0, step_mode="full", settle_time=1.0):
         """
         Initializes the Pump class.
         
@@ -10,83 +48,158 @@ class Pump:
             syringe_volume (float): Total volume of the syringe in mL.
             ml_per_rotation (float): Volume in mL per motor rotation.
             step_mode (str): Default step mode to use for all movements ("full", "half", etc.).
+            settle_time (float): Dwell in seconds after each draw and each push (see settle_time_for).
         """
         self.motor = motor
         self.syringe_volume = syringe_volume
         self.ml_per_rotation = ml_per_rotation
         self.step_mode = step_mode
-        self.movement_history = []
-        self.retracted = False  # Track syringe position (True if fully drawn, False if fully pushed)
+        self.movement_history = deque(maxlen=1000)  # Most recent movements only
+        self.listeners = []  # Callables notified of draws and pushes: listener(kind, **data)
+        self.settle_time = settle_time
 
         # Set the step mode initially
         self.set_step_mode(step_mode)
 
+    @property
+    def loaded_volume(self):
+        """Volume in the syringe in mL, from the motor's step counter (position 0 is the plunger fully pushed)."""
+        return max(self.motor.revolutions * self.ml_per_rotation, 0.0)
+
+    @property
+    def retracted(self):
+        """True if the syringe holds liquid, False if the plunger is fully pushed."""
+        return self.loaded_volume > self.step_volume()
+
+    @property
+    def dispensed_volume(self):
+        """Total volume pushed by this pump in mL, over its whole life (persisted with the step counter)."""
+        return self.motor.distance("CCW") * self.ml_per_rotation
+
+    def step_volume(self):
+        """Volume moved by one step in the current step mode, in mL."""
+        return self.ml_per_rotation / (self.motor.motor_spr * self.motor.microstep.MSmap[self.step_mode]['factor'])
+
+    def set_empty(self):
+        """Declare the plunger fully pushed: the step counter's zero."""
+        self.motor.set_position(0)
+
+    def reconfigure(self, syringe_volume=None, ml_per_rotation=None, step_mode=None, settle_time=None):
+        """
+        Change the pump settings in place (None keeps a setting); return the list of those that changed.
+
+        The plunger position (the motor's step counter) is kept, so the syringe content is
+        simply read with the new ml_per_rotation; only a new step mode touches the pins.
+        """
+        changed = []
+        for name, value in (('syringe_volume', syringe_volume), ('ml_per_rotation', ml_per_rotation),
+                            ('settle_time', settle_time)):
+            if value is not None and value != getattr(self, name):
+                setattr(self, name, value)
+                changed.append(name)
+        if step_mode is not None and step_mode != self.step_mode:
+            self.set_step_mode(step_mode)
+            changed.append('step_mode')
+        return changed
+
     def set_step_mode(self, step_mode):
         """Sets the step mode for all movements and updates the motor configuration."""
         self.step_mode = step_mode
         self.motor.set_step_type(step_mode)
-        print(f"Step mode set to {self.step_mode} for all movements.")
+        logger.info("Step mode set to %s for all movements.", self.step_mode)
 
-    def move_volume(self, volume, speed=1):
+    def move_volume(self, volume, speed=1, actions=None):
         """
         Dispenses the specified volume, handling multiple draw-push cycles if needed.
 
         Args:
             volume (float): Volume in mL to dispense.
             speed (float): Speed in revolutions per second.
+            actions (list): Draw/push actions planned by drivers.scheduler for this move.
+                Without them, only what is missing from the syringe is drawn for each cycle.
         """
         if volume <= 0:
             raise ValueError("Volume must be greater than zero.")
 
-        remaining_volume = volume
-        max_volume_per_dispense = self.syringe_volume
-
-        # Dispense in draw-push cycles based on volume conditions
-        while remaining_volume > 0:
-            if remaining_volume <= max_volume_per_dispense:
-                # Single cycle if remaining volume is within syringe capacity
-                volume_to_dispense = remaining_volume
-
-            elif max_volume_per_dispense < remaining_volume <= 2 * max_volume_per_dispense:
-                # Split volume into two equal cycles if between 1 and 2 syringe volumes
-                volume_to_dispense = remaining_volume / 2
+        if actions is None:
+            actions = schedule_refills([split_volume(volume, self.syringe_volume)],
+                                       self.syringe_volume, self.loaded_volume)[0][0]
 
+        for kind, action_volume in actions:
+            if kind == "draw":
+                self.draw(action_volume, speed)
             else:
-                # Use full syringe volume if more than 2 syringe volumes are needed
-                volume_to_dispense = max_volume_per_dispense
-
-            # Only draw the needed volume for each cycle
-            if not self.retracted:
-                self._draw_syringe(volume=volume_to_dispense, speed=speed)
-                self.retracted = True
-                time.sleep(1)
-
-            # Push out the calculated volume in the syringe
-            print(f"Pushing {volume_to_dispense:.2f} mL out of the syringe...")
-            self._push_syringe(volume=volume_to_dispense, speed=speed)
-            self.retracted = False  # Ensure we end in the pushed position
-            time.sleep(1)
-
-            # Record the movement and update remaining volume
-            self.record_movement(volume_to_dispense, "in")
-            remaining_volume -= volume_to_dispense
+                self.dispense(action_volume, speed)
+
+    def draw(self, volume, speed=1):
+        """Draws volume into the (possibly partially filled) syringe and lets it settle."""
+        self.check_action("draw", volume)
+        self._draw_syringe(volume=volume, speed=speed)
+        self.complete_action("draw", volume)
+        time.sleep(self.settle_time)
+
+    def dispense(self, volume, speed=1):
+        """Pushes volume out of the syringe, which must already hold it, and lets it settle."""
+        self.check_action("push", volume)
+        logger.debug("Pushing %.2f mL out of the syringe...", volume)
+        self._push_syringe(volume=volume, speed=speed)
+        self.complete_action("push", volume)
+        time.sleep(self.settle_time)
+
+    def check_action(self, kind, volume):
+        """Raise ValueError if a draw or push of volume does not fit the syringe's current content."""
+        tolerance = self.step_volume()  # The content is only known to within a step
+        if kind == "draw" and self.loaded_volume + volume > self.syringe_volume + tolerance:
+            raise ValueError(f"Cannot draw {volume:.2f} mL: the syringe already holds {self.loaded_volume:.2f} "
+                             f"of {self.syringe_volume} mL.")
+        if kind == "push" and volume > self.loaded_volume + tolerance:
+            raise ValueError(f"Cannot push {volume:.2f} mL: the syringe only holds {self.loaded_volume:.2f} mL.")
+
+    def motor_move(self, kind, volume, speed):
+        """Keyword arguments of the motor move that draws or pushes volume."""
+        return {
+            'revolutions': volume / self.ml_per_rotation,
+            'stepMode': self.step_mode,
+            'direction': "CW" if kind == "draw" else "CCW",
+            'speed': speed,
+        }
+
+    def action_duration(self, kind, volume, speed):
+        """Planned time in s of a draw or push, including its settle dwell."""
+        move = self.motor_move(kind, volume, speed)
+        return self.motor.move_duration(move['revolutions'], move['stepMode'], move['speed']) + self.settle_time
+
+    def complete_action(self, kind, volume):
+        """Report a draw or push of volume once the motor has moved (the content follows the step counter)."""
+        if kind == "draw":
+            self._notify('draw', volume=volume, loaded_volume=self.loaded_volume)
+        else:
+            self._notify('volume', volume=volume, loaded_volume=self.loaded_volume,
+                         dispensed_volume=self.dispensed_volume)
+
+            # Record the movement
+            self.record_movement(volume, "in")
+
+    def _notify(self, kind, **data):
+        for listener in self.listeners:
+            listener(kind, **data)
 
     def _draw_syringe(self, volume, speed):
         """Draws liquid into the syringe by converting volume to revolutions and moving the motor."""
         revolutions = volume / self.ml_per_rotation
-        self.motor.move(revolutions, stepMode=self.step_mode, direction="CW", speed=speed)
-        print(f"Drew {volume:.2f} mL into the syringe (equivalent to {revolutions:.2f} revolutions).")
+        self.motor.move(**self.motor_move("draw", volume, speed))
+        logger.info("Drew %.2f mL into the syringe (equivalent to %.2f revolutions).", volume, revolutions)
 
     def _push_syringe(self, volume, speed):
         """Pushes liquid out of the syringe by converting volume to revolutions and moving the motor."""
         revolutions = volume / self.ml_per_rotation
-        self.motor.move(revolutions, stepMode=self.step_mode, direction="CCW", speed=speed)
-        print(f"Pushed {volume:.2f} mL out of the syringe (equivalent to {revolutions:.2f} revolutions).")
+        self.motor.move(**self.motor_move("push", volume, speed))
+        logger.info("Pushed %.2f mL out of the syringe (equivalent to %.2f revolutions).", volume, revolutions)
 
     def record_movement(self, volume, direction):
         """Records a movement in the movement history."""
         self.movement_history.append({'volume': volume, 'direction': direction, 'timestamp': time.time()})
-        print(f"Recorded movement: {volume} mL {direction}")
+        logger.debug("Recorded movement: %s mL %s", volume, direction)
 
     def print_info(self):
         """Prints the current status and configuration of the pump."""
@@ -94,5 +207,8 @@ class Pump:
         print(f"- Syringe Volume: {self.syringe_volume} mL")
         print(f"- ml per Rotation: {self.ml_per_rotation}")
         print(f"- Current Step Mode: {self.step_mode}")
-        print(f"- Retracted State: {'Yes' if self.retracted else 'No'}")
+        print(f"- Retracted State: {'Yes' if self.retracted else 'No'} ({self.loaded_volume:.2f} mL loaded)")
+        print(f"- Plunger Position: {self.motor.revolutions:.4f} revolutions from empty")
+        print(f"- Dispensed in Total: {self.dispensed_volume:.3f} mL")
+        print(f"- Settle Time: {self.settle_time} s")
         print(f"- Movement History: {self.movement_history}")
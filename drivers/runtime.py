@@ -0,0 +1,201 @@
+import threading
+import time
+from collections import deque
+
+class Cancelled(Exception):
+    """Raised inside a run once its cancel token has been cancelled."""
+
+class CancelToken:
+    def __init__(self):
+        """
+        Cancel and pause flags of a run, checked by drivers.multiaxis every few pulses
+        and by the Runtime between events.
+        """
+        self.cancelled = False
+        self.paused = False
+        self.interrupted = False  # cancelled or paused; a plain attribute so checking it costs next to nothing
+        self.event = threading.Event()  # Set while interrupted: wakes the engine's sleeps
+        self.resumed = threading.Event()
+        self.resumed.set()
+
+    def cancel(self):
+        self.cancelled = self.interrupted = True
+        self.event.set()
+        self.resumed.set()  # Let a paused run notice the cancellation
+
+    def pause(self):
+        self.paused = self.interrupted = True
+        self.resumed.clear()
+        self.event.set()
+
+    def resume(self):
+        self.paused = False
+        self.interrupted = self.cancelled
+        if not self.cancelled:
+            self.event.clear()
+        self.resumed.set()
+
+    def sleep(self, seconds):
+        """Sleep like time.sleep, but return True as soon as the token is paused or cancelled."""
+        return self.event.wait(seconds)
+
+    def wait_resumed(self):
+        """Block while paused (until resumed or cancelled)."""
+        self.resumed.wait()
+
+    def check(self):
+        """Raise Cancelled if the token has been cancelled."""
+        if self.cancelled:
+            raise Cancelled()
+
+class Runtime:
+    def __init__(self, pumps, engine, default_channel=None, token=None, timer=None):
+        """
+        Runs compiled program instructions on several pump channels from one event loop.
+
+        Every channel has a queue of draw/push actions. A channel's next action is
+        started on the MultiAxis engine at the deadline its previous action (plus its
+        settle time) ends, and moves keep running while the program waits or pauses.
+
+        Deadlines are kept on the run clock (clock()): seconds since the runtime was
+        created, not counting the time spent paused, so a pause moves the rest of the
+        run back as a whole.
+
+        Args:
+            pumps (dict): Channel name -> Pump.
+            engine (MultiAxis): Engine playing the STEP pulses of all channels.
+            default_channel (str): Channel of moves that do not name one (default: the first).
+            token (CancelToken): Pauses or cancels the run within a few steps. A paused move
+                resumes with its remaining steps; a cancel raises Cancelled.
+            timer (callable): Clock in s the run clock is taken from (default time.perf_counter);
+                the engine must use the same one (see drivers.simulator for a virtual one).
+        """
+        self.pumps = pumps
+        self.engine = engine
+        self.token = token
+        self.timer = timer or time.perf_counter
+        self.default_channel = default_channel or next(iter(pumps))
+        self.channels = {name: {'queue': deque(), 'current': None, 'ready_at': None} for name in pumps}
+        self.origin = self.timer()  # Timer time of run clock 0, moved forward by every pause
+        self.paused_time = 0.0
+
+    def clock(self):
+        """Run clock in s (pauses excluded)."""
+        return self.timer() - self.origin
+
+    def execute(self, instruction, actions=(), at=None):
+        """
+        Execute one compiled instruction; actions are its draw/push actions (drivers.scheduler).
+
+        With `at`, the planned start of the instruction on the run clock, the runtime waits
+        for that deadline (running moves go on) and ends a PAUSE at its planned end, so
+        time lost on earlier lines is caught up instead of adding up.
+
+        Returns the actual start on the run clock.
+        """
+        if at is not None:
+            self._run(lambda: self.clock() >= at, at)
+        started = self.clock()
+        action = instruction.action
+        if action in ("MOVE", "START"):
+            channel = instruction.channel or self.default_channel
+            self.start(channel, actions, instruction.speed)
+            if action == "MOVE":
+                self.wait(channel)
+        elif action == "WAIT":
+            self.wait(instruction.wait_for)
+        elif action == "PAUSE":
+            self.sleep(instruction.duration, start=at)
+        elif action == "END":
+            self.wait("all")
+        return started
+
+    def start(self, channel, actions, speed):
+        """Queue draw/push actions on a channel; they start as soon as the channel is free."""
+        state = self.channels[channel]
+        state['queue'].extend((kind, volume, speed) for kind, volume in actions)
+        if state['current'] is None and state['ready_at'] is None:
+            state['ready_at'] = self.clock()
+
+    def busy(self, channel):
+        state = self.channels[channel]
+        return state['current'] is not None or state['ready_at'] is not None
+
+    def wait(self, wait_for="all"):
+        """Run the event loop until all channels, any busy channel, or the named channel are idle."""
+        if wait_for == "all":
+            self._run(lambda: not any(self.busy(name) for name in self.channels))
+        elif wait_for == "any":
+            running = [name for name in self.channels if self.busy(name)]
+            if running:
+                self._run(lambda: any(not self.busy(name) for name in running))
+        else:
+            self._run(lambda: not self.busy(wait_for))
+
+    def sleep(self, duration, start=None):
+        """Run the event loop (moves keep going) until duration seconds after start (run clock, default now)."""
+        deadline = (self.clock() if start is None else start) + duration
+        self._run(lambda: self.clock() >= deadline, deadline)
+
+    def _run(self, done, deadline=None):
+        token = self.token
+        while True:
+            if token is not None and token.interrupted:
+                self._interrupted()
+            now = self.clock()
+            # Start the next action of every channel whose deadline has come
+            for name, state in self.channels.items():
+                if state['current'] is None and state['ready_at'] is not None and state['ready_at'] <= now:
+                    if state['queue']:
+                        pump = self.pumps[name]
+                        kind, volume, speed = state['queue'].popleft()
+                        pump.check_action(kind, volume)
+                        offsets, _ = pump.motor.prepare_move(**pump.motor_move(kind, volume, speed))
+                        at = max(state['ready_at'], self.clock()) + self.origin
+                        self.engine.start(name, pump.motor, offsets, at=at)
+                        state['current'] = (kind, volume)
+                    state['ready_at'] = None
+            if done():
+                return
+
+            # Play pulses up to the next event: a channel becoming ready, a move ending or the deadline
+            ends = {name: self.engine.end_time(name) - self.origin
+                    for name, state in self.channels.items() if state['current']}
+            events = [state['ready_at'] for state in self.channels.values() if state['ready_at'] is not None]
+            events += ends.values()
+            if deadline is not None:
+                events.append(deadline)
+            if not events:
+                return  # Nothing is running and nothing will: the condition cannot change
+            finished = self.engine.run_until(min(events) + self.origin, token=token)
+            for name in finished:
+                state = self.channels[name]
+                kind, volume = state['current']
+                self.pumps[name].complete_action(kind, volume)
+                state['current'] = None
+                state['ready_at'] = ends[name] + self.pumps[name].settle_time  # From the planned end: no drift
+
+    def _interrupted(self):
+        """Handle a paused or cancelled token: hold until resumed, or stop and raise Cancelled."""
+        if self.token.paused:
+            paused_at = self.timer()
+            self.token.wait_resumed()
+            if not self.token.cancelled:
+                paused = self.timer() - paused_at
+                self.origin += paused
+                self.paused_time += paused
+                self.engine.resume()  # Remaining steps of the interrupted moves, ramped up again
+        if self.token.cancelled:
+            self.cancel()  # Stop the moves where they are
+            raise Cancelled()
+
+    def cancel(self):
+        """Stop every channel now, accounting for the part of each move that was played."""
+        played = self.engine.cancel()
+        for name, state in self.channels.items():
+            if state['current'] is not None:
+                kind, volume = state['current']
+                self.pumps[name].complete_action(kind, volume * played.get(name, 0.0))
+            state['queue'].clear()
+            state['current'] = None
+            state['ready_at'] = None
@@ -0,0 +1,143 @@
+from dataclasses import dataclass
+
+@dataclass(frozen=True)
+class RefillSchedule:
+    actions: tuple  # Per plan instruction: tuple of ("draw" | "push", volume) for MOVEs, () otherwise
+    draws: int  # Number of draws in the whole program
+    estimated_duration: float  # s, including pauses and settle dwells
+    starts: tuple = ()  # Per plan instruction: planned start in s from the start of the run
+
+def schedule_refills(moves, syringe_volume, loaded_volume=0.0):
+    """
+    Decide when to draw and how much, looking ahead across a sequence of moves.
+
+    Each move is given as the list of its draw-push cycle volumes (see
+    drivers.pump_v0.split_volume). Whenever the syringe holds less than the next
+    cycle, it is topped up with enough for that cycle and as many of the following
+    cycles as fit in the syringe; otherwise the cycle is pushed from what is
+    already loaded.
+
+    Args:
+        moves (list): Cycle volume lists, one per move, in execution order.
+        syringe_volume (float): Syringe capacity in mL.
+        loaded_volume (float): Volume already in the syringe in mL.
+
+    Returns:
+        (list of action lists, one per move; volume left in the syringe)
+    """
+    queue = [(m, volume) for m, cycles in enumerate(moves) for volume in cycles]
+    actions = [[] for _ in moves]
+    loaded = loaded_volume
+    for i, (m, volume) in enumerate(queue):
+        if loaded + 1E-9 < volume:
+            # Fill for this cycle and every following cycle that still fits
+            needed = 0.0
+            for _, upcoming in queue[i:]:
+                if needed + upcoming > syringe_volume + 1E-9:
+                    break
+                needed += upcoming
+            draw = max(needed, volume) - loaded
+            actions[m].append(("draw", draw))
+            loaded += draw
+        actions[m].append(("push", volume))
+        loaded -= volume
+    return actions, max(loaded, 0.0)
+
+def timeline(instructions, durations, default_channel=None):
+    """
+    Planned start (s from the start of the run) of every instruction, and the total duration.
+
+    MOVE and START occupy their channel for their duration (a START on a busy channel
+    queues behind the running move); MOVE, WAIT, PAUSE and END advance the program clock.
+
+    Args:
+        instructions (list): Compiled instructions (drivers.program.Instruction).
+        durations (list): Duration in s of each instruction (move time or pause).
+        default_channel (str): Channel of moves that do not name one.
+    """
+    now = 0.0
+    busy = {}  # channel -> time it becomes idle
+    starts = []
+    for instruction, duration in zip(instructions, durations):
+        starts.append(now)
+        action = instruction.action
+        if action in ("MOVE", "START"):
+            channel = instruction.channel or default_channel
+            busy[channel] = max(now, busy.get(channel, 0.0)) + duration
+            if action == "MOVE":
+                now = busy[channel]
+        elif action == "WAIT":
+            if instruction.wait_for == "all":
+                now = max([now, *busy.values()])
+            elif instruction.wait_for == "any":
+                pending = [t for t in busy.values() if t > now]
+                now = min(pending) if pending else now
+            else:
+                now = max(now, busy.get(instruction.wait_for, 0.0))
+        elif action == "PAUSE":
+            now += duration
+        elif action == "END":
+            now = max([now, *busy.values()])
+    return starts, max([now, *busy.values()])
+
+def schedule_plan(plan, pumps, default_channel=None):
+    """
+    Build the refill schedule of a compiled program (drivers.program.Plan).
+
+    Draws are planned per channel with that channel's pump (syringe volume, current
+    content, settle time and ml per rotation). Move times come from the pump's motion
+    profile, so the planned start of every instruction can be used as its deadline.
+
+    Args:
+        plan (Plan): Compiled program.
+        pumps (dict): Channel name -> Pump.
+        default_channel (str): Channel of moves that do not name one (default: the first).
+    """
+    default_channel = default_channel or next(iter(pumps))
+    moves = {}  # channel -> indices of its MOVE/START instructions
+    for index, instruction in enumerate(plan.instructions):
+        if instruction.action in ("MOVE", "START"):
+            moves.setdefault(instruction.channel or default_channel, []).append(index)
+
+    actions = [()] * len(plan.instructions)
+    durations = [instruction.duration or 0.0 for instruction in plan.instructions]
+    draws = 0
+    for channel, indices in moves.items():
+        pump = pumps[channel]
+        cycles = [list(plan.instructions[index].cycles) for index in indices]
+        channel_actions, _ = schedule_refills(cycles, pump.syringe_volume, pump.loaded_volume)
+        for index, steps in zip(indices, channel_actions):
+            speed = plan.instructions[index].speed
+            actions[index] = tuple(steps)
+            draws += sum(1 for kind, _ in steps if kind == "draw")
+            durations[index] = sum(pump.action_duration(kind, volume, speed) for kind, volume in steps)
+
+    starts, duration = timeline(plan.instructions, durations, default_channel)
+    return RefillSchedule(actions=tuple(actions), draws=draws, estimated_duration=duration, starts=tuple(starts))
+
+def timing_report(instructions, planned, actual, planned_end, actual_end):
+    """
+    Compare the planned and actual start of every executed instruction.
+
+    Args:
+        instructions (list): Executed instructions (drivers.program.Instruction).
+        planned (list): Planned starts in s from the start of the run.
+        actual (list): Actual starts in s from the start of the run (pauses of the run excluded).
+        planned_end (float): Planned duration of the run in s.
+        actual_end (float): Actual duration of the run in s (pauses excluded).
+
+    Returns a dict with the per-instruction rows and the mean, worst and final lateness in s.
+    """
+    rows = [{'line': instruction.line, 'text': instruction.text, 'planned': p, 'actual': a, 'late': a - p}
+            for instruction, p, a in zip(instructions, planned, actual)]
+    late = [row['late'] for row in rows]
+    worst = max(rows, key=lambda row: row['late'], default=None)
+    return {
+        'instructions': rows,
+        'mean_late': sum(late) / len(late) if late else 0.0,
+        'max_late': worst['late'] if worst else 0.0,
+        'max_late_line': worst['line'] if worst else None,
+        'planned_duration': planned_end,
+        'actual_duration': actual_end,
+        'end_late': actual_end - planned_end,
+    }
@@ -0,0 +1,75 @@
+"""
+Simulated drop-in for the subset of RPi.GPIO used by the drivers.
+
+Every change of an output level is recorded with a perf_counter_ns timestamp, so
+step timing can be measured on any machine; only the last MAX_EVENTS changes are
+kept, so an app left running on the simulator does not grow without bound. Select
+it with NMRPI_GPIO=sim (see drivers.gpio) or import it directly.
+"""
+import time
+from collections import deque
+import numpy as np
+
+BCM = 11
+BOARD = 10
+OUT = 0
+IN = 1
+HIGH = 1
+LOW = 0
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+
+MAX_EVENTS = 100000
+
+_mode = None
+_levels = {}  # pin -> current level
+events = deque(maxlen=MAX_EVENTS)  # (timestamp_ns, pin, level) of the latest level changes, in order
+
+def setwarnings(flag):
+    pass
+
+def setmode(mode):
+    global _mode
+    _mode = mode
+
+def getmode():
+    return _mode
+
+def _channels(channel):
+    return channel if isinstance(channel, (list, tuple)) else [channel]
+
+def setup(channel, direction, pull_up_down=PUD_OFF, initial=None):
+    if _mode is None:
+        raise RuntimeError("Please set pin numbering mode using GPIO.setmode(GPIO.BOARD) or GPIO.setmode(GPIO.BCM)")
+    for pin in _channels(channel):
+        _levels.setdefault(pin, LOW)
+        if direction == OUT and initial is not None:
+            output(pin, initial)
+
+def output(channel, value):
+    t = time.perf_counter_ns()
+    values = value if isinstance(value, (list, tuple)) else [value] * len(_channels(channel))
+    for pin, level in zip(_channels(channel), values):
+        level = HIGH if level else LOW
+        if _levels.get(pin) != level:
+            _levels[pin] = level
+            events.append((t, pin, level))
+
+def input(channel):
+    return _levels.get(channel, LOW)
+
+def cleanup(channel=None):
+    if channel is None:
+        _levels.clear()
+    else:
+        for pin in _channels(channel):
+            _levels.pop(pin, None)
+
+def reset():
+    """Forget all recorded events (pin levels are kept)."""
+    events.clear()
+
+def edges(pin, level=HIGH):
+    """Return the timestamps (seconds, perf_counter clock) at which pin changed to level."""
+    return np.array([t for t, p, v in events if p == pin and v == level], dtype=np.float64) / 1E9
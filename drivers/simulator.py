@@ -0,0 +1,161 @@
+"""
+Virtual-time dry runs of compiled programs.
+
+A dry run executes a plan with the real Runtime, Pump and A4988 logic (refill
+scheduling, syringe checks, motion profiles, step counters, settle times), but on
+twins of the pumps that drive drivers.sim_gpio, keep their step counters in memory,
+and move on a virtual clock that jumps from one event to the next. No pulse is
+played and nothing is slept, so a protocol of half an hour is forecast in
+milliseconds.
+"""
+import numpy as np
+from drivers import sim_gpio
+from drivers.backends import SimulatedBackend
+from drivers.position import PositionStore
+from drivers.pump_v0 import Pump
+from drivers.runtime import Runtime
+from drivers.scheduler import schedule_plan
+from drivers.stepper import A4988
+from drivers.utils import lateness_stats
+
+class VirtualClock:
+    def __init__(self, start=0.0):
+        """Clock that only moves when told to; perf_counter() and sleep() mimic the time module."""
+        self.now = start
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0.0)
+
+    def advance_to(self, t):
+        self.now = max(self.now, t)
+
+class VirtualEngine:
+    def __init__(self, clock):
+        """
+        Stand-in for drivers.multiaxis.MultiAxis that plays no pulses. Every move takes the
+        time the motor expects it to really take on the virtual clock (A4988.expected_duration():
+        its planned time, stretched by the slowness its timing feedback has measured).
+
+        Args:
+            clock (VirtualClock): Clock advanced by run_until().
+        """
+        self.clock = clock
+        self.axes = {}  # name -> state of the move running on that axis
+
+    def start(self, name, motor, offsets, at=None):
+        if name in self.axes:
+            raise RuntimeError(f"Axis '{name}' is already moving.")
+        start = self.clock.now if at is None else at
+        n = len(offsets) - 1
+        duration = motor.expected_duration(float(offsets[n]))
+        self.axes[name] = {'motor': motor, 'start': start, 'end': start + duration, 'duration': duration,
+                           'planned': float(offsets[n]), 'steps': n}
+
+    def busy(self, name=None):
+        return name in self.axes if name is not None else bool(self.axes)
+
+    def end_time(self, name):
+        return self.axes[name]['end']
+
+    def run_until(self, deadline=None, token=None):
+        """Jump to deadline (default: the end of all moves) and finish the moves done by then."""
+        if deadline is None:
+            deadline = max((axis['end'] for axis in self.axes.values()), default=self.clock.now)
+        self.clock.advance_to(deadline)
+        finished = {}
+        for name, axis in list(self.axes.items()):
+            if axis['end'] <= self.clock.now:
+                del self.axes[name]
+                finished[name] = axis['motor'].finish_move(self._report(axis['steps'], axis['duration'], axis['planned']))
+        return finished
+
+    def resume(self):
+        pass  # Virtual runs are never paused
+
+    def cancel(self):
+        done = {}
+        for name, axis in list(self.axes.items()):
+            del self.axes[name]
+            elapsed = min(self.clock.now - axis['start'], axis['duration'])
+            fraction = elapsed / axis['duration'] if axis['duration'] > 0 else 1.0
+            report = self._report(int(axis['steps'] * fraction), elapsed, axis['planned'] * fraction)
+            report['cancelled'] = True
+            axis['motor'].finish_move(report)
+            done[name] = fraction
+        return done
+
+    @staticmethod
+    def _report(steps, elapsed, planned):
+        return {'steps': steps, 'elapsed': elapsed, 'planned': planned, **lateness_stats(np.zeros(0), np.zeros(0))}
+
+def twin_pump(pump):
+    """
+    Copy of a pump for dry runs: same settings, motion planner, calibration, timing
+    feedback and plunger position, but driving the simulated GPIO and keeping its step
+    counter in memory. The feedback is a copy, so the twin's moves are corrected like the
+    real pump's next ones and go on learning during the dry run without touching the
+    original; drift does not trigger a recalibration.
+    """
+    motor = pump.motor
+    positions = PositionStore(path=None)
+    positions.save(motor.channel, {'position': motor.position, 'target': motor.target, **motor.odometer})
+    twin = A4988(motor.config_file, pulseWidth=motor.pulseWidth, motor_spr=motor.motor_spr, planner=motor.planner,
+                 backend=SimulatedBackend(realtime=False), channel=motor.channel, position_store=positions,
+                 gpio=sim_gpio, feedback=motor.feedback.copy() if motor.feedback is not None else None,
+                 drift_threshold=float('inf'))
+    twin.sleep_overhead = motor.sleep_overhead
+    return Pump(motor=twin, syringe_volume=pump.syringe_volume, ml_per_rotation=pump.ml_per_rotation,
+                step_mode=pump.step_mode, settle_time=pump.settle_time)
+
+def dry_run(plan, pumps, absolute=True, default_channel=None):
+    """
+    Execute a compiled plan on twins of the pumps in virtual time.
+
+    Args:
+        plan (Plan): Compiled program (drivers.program.compile_program).
+        pumps (dict): Channel name -> Pump; only read, never moved.
+        absolute (bool): Start lines at their planned times, as the app's 'absolute' timing does.
+        default_channel (str): Channel of moves that do not name one (default: the first).
+
+    Returns a dict with the total duration, the planned estimate, the number of draws,
+    the volume, the syringe content at the end per channel and one entry per executed
+    line (start and end in s from the start, pushed and drawn volume, draws, error).
+    """
+    clock = VirtualClock()
+    twins = {name: twin_pump(pump) for name, pump in pumps.items()}
+    runtime = Runtime(twins, VirtualEngine(clock), default_channel=default_channel, timer=clock.perf_counter)
+    schedule = schedule_plan(plan, twins, default_channel=runtime.default_channel)
+    lines = []
+    for index, (instruction, actions) in enumerate(zip(plan.instructions, schedule.actions)):
+        entry = {
+            'line': instruction.line,
+            'command': instruction.text,
+            'channel': (instruction.channel or runtime.default_channel) if actions else None,
+            'planned_start': schedule.starts[index],
+            'volume': sum(volume for kind, volume in actions if kind == "push"),
+            'drawn': sum(volume for kind, volume in actions if kind == "draw"),
+            'draws': sum(1 for kind, _ in actions if kind == "draw"),
+            'error': None,
+        }
+        try:
+            entry['start'] = runtime.execute(instruction, actions, at=schedule.starts[index] if absolute else None)
+        except Exception as e:  # Reported per line, like a real run
+            entry['start'] = runtime.clock()
+            entry['error'] = str(e)
+        entry['end'] = runtime.clock()
+        lines.append(entry)
+        if instruction.action == "END":
+            break
+    runtime.wait("all")
+    return {
+        'duration': runtime.clock(),
+        'estimated_duration': schedule.estimated_duration,
+        'draws': schedule.draws,
+        'total_volume': plan.total_volume,
+        'loaded_volume': {name: twin.loaded_volume for name, twin in twins.items()},
+        'errors': sum(1 for entry in lines if entry['error']),
+        'lines': lines,
+    }
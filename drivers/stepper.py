@@ -1,15 +1,61 @@
-import RPi.GPIO as GPIO
-import time
-from drivers.utils import calibrate_sleep_overhead, step, Microstep
+from drivers.gpio import GPIO
+from drivers.utils import calibrate_sleep_overhead, build_waveform, SPIN_MARGIN, Microstep, PinShadow
+from drivers.backends import BACKENDS, GPIOBackend, make_backend
 import json
+import logging
+import threading
+from drivers.calibration import CalibrationStore
+from drivers.position import PositionStore
+from drivers.feedback import steady_elapsed
+
+logger = logging.getLogger(__name__)
+
+POSITION_RESOLUTION = 16  # Position counter units per full step: one unit is a step of the finest mode
+
+def load_channels(config_file):
+    """
+    Read a pin map file and return {channel name: pin mapping}.
+
+    The file either maps channel names to pin mappings under a "channels" key, or is
+    a single pin mapping (older format), which becomes one channel named "pump1".
+    """
+    with open(config_file, 'r') as file:
+        pin_map = json.load(file)
+    if 'channels' in pin_map:
+        return pin_map['channels']
+    return {'pump1': pin_map}
 
 class A4988:
-    def __init__(self, config_file, auto_calibrate=False, speed=None, pulseWidth=None, motor_spr=200):
-        """Initialize stepper with GPIO pin mappings and microstep pins."""
-        GPIO.setwarnings(False)
-        GPIO.setmode(GPIO.BCM)
-        with open(config_file, 'r') as file:
-            self.pins = json.load(file)
+    __slots__ = ('gpio', 'config_file', 'channel', 'pins', 'step_pin', 'dir_pin', 'enable_pin', 'shadow', 'stepDelay',
+                 'sleep_overhead', 'pins_setup', 'microstep', 'motor_spr', 'pulseWidth', 'rps_tolerance', 'last_move', 'planner',
+                 'backend', '_pending', 'calibration_store', 'drift_threshold', 'recalibration_due', '_calibration_thread',
+                 'feedback',
+                 'position_store', 'position', 'target', 'odometer', 'idle_timeout', 'holds', '_idle_timer', '_idle_lock',
+                 'listeners')
+
+    def __init__(self, config_file, auto_calibrate=False, speed=None, pulseWidth=None, motor_spr=200, rps_tolerance=0.02, planner=None, backend=None,
+                 calibration_store=None, drift_threshold=0.05, feedback=None, channel=None, position_store=None, idle_timeout=0,
+                 gpio=None):
+        """
+        Initialize stepper with GPIO pin mappings and microstep pins (of the given channel, default the first).
+
+        gpio is the RPi.GPIO-like module driving the pins (default drivers.gpio.GPIO), e.g.
+        drivers.sim_gpio for a stepper that must never touch the hardware.
+        """
+        self.gpio = gpio or GPIO
+        self.gpio.setwarnings(False)
+        self.gpio.setmode(self.gpio.BCM)
+        self.config_file = config_file
+        channels = load_channels(config_file)
+        self.channel = channel or next(iter(channels))
+        if self.channel not in channels:
+            raise ValueError(f"Unknown channel '{self.channel}' in {config_file}.")
+        self.pins = channels[self.channel]
+        # Pin numbers resolved once; the shadow skips writes of levels a pin already has
+        self.step_pin = self.pins['STEP']['number']
+        self.dir_pin = self.pins['DIR']['number']
+        self.enable_pin = self.pins['ENABLE']['number']
+        self.shadow = PinShadow(self.gpio)
 
         self.stepDelay = None  # This will be dynamically calculated
         self.sleep_overhead = None  # To store the calibrated sleep overhead
@@ -17,9 +63,39 @@ class A4988:
         self.microstep = None  # this will handle microstepping
         self.motor_spr = motor_spr  # steps per revolution; default for nema17 pololu is 200
         self.pulseWidth = pulseWidth or 5E-6  # Default pulse width
+        self.rps_tolerance = rps_tolerance  # Allowed relative error between requested and measured rps
+        self.last_move = None  # Timing report of the most recent move
+        self.planner = planner  # Optional MotionPlanner for accel/decel ramps; None moves at constant speed
+        # Pulse generator: a PulseBackend instance or a name from drivers.backends.BACKENDS
+        if isinstance(backend, str):
+            backend = make_backend(backend)
+        self.backend = backend or GPIOBackend()
+        self._pending = None  # (spr, speed, stepMode, scale, position units per step) of a move not finished yet
+        self.calibration_store = calibration_store or CalibrationStore()
+        self.drift_threshold = drift_threshold  # rps error past which the calibration is marked due
+        self.recalibration_due = False  # Drift was seen; recalibrate() once no pulses are playing
+        self._calibration_thread = None
+        self.feedback = feedback  # Optional TimingController correcting the schedules of later moves
+        self.listeners = []  # Callables notified of the timing report of every finished move: listener(report)
+
+        # Hold/idle policy: the driver stays enabled while held (hold()/release()) and is disabled
+        # idle_timeout s after the last move otherwise (0: right after every move), from a timer thread
+        self.idle_timeout = idle_timeout
+        self.holds = 0
+        self._idle_timer = None
+        self._idle_lock = threading.RLock()
+
+        # Odometry in POSITION_RESOLUTION units (CW positive), restored from the position store.
+        # position counts the steps actually played; target is where the moves asked to be, so
+        # the fraction of a step that could not be played is carried into the next move.
+        self.position_store = position_store or PositionStore()
+        state = self.position_store.get(self.channel) or {}
+        self.position = int(state.get('position', 0))
+        self.target = float(state.get('target', self.position))
+        self.odometer = {'CW': int(state.get('CW', 0)), 'CCW': int(state.get('CCW', 0))}  # Units moved each way
 
         # Set up GPIO and verify pin setup
-        GPIO.setwarnings(False)
+        self.gpio.setwarnings(False)
         self.setup_pins()
 
         # Optional auto-calibration during initialization
@@ -32,93 +108,241 @@ class A4988:
         """Set up the GPIO pins."""
         try:
             # Set all pins to defaults first
+            self.shadow.invalidate()
             for pin_name, pin in self.pins.items():
-                print(f"Setting up {pin_name} pin at GPIO {pin['number']}")
-                GPIO.setup(pin['number'], GPIO.OUT)
-                initial_state = GPIO.LOW if pin['init'] == "LOW" else GPIO.HIGH
-                GPIO.output(pin['number'], initial_state)  # Set all pins to initial state
+                logger.debug("Setting up %s pin at GPIO %s", pin_name, pin['number'])
+                self.gpio.setup(pin['number'], self.gpio.OUT)
+                initial_state = self.gpio.LOW if pin['init'] == "LOW" else self.gpio.HIGH
+                self.shadow.write(pin['number'], initial_state)  # Set all pins to initial state
             
             # Now, set up microstepping independent of the other pins
-            self.microstep = Microstep(self.pins)
+            self.microstep = Microstep(self.pins, shadow=self.shadow)
 
             self.pins_setup = True
-            print("All pins set up successfully.")
+            logger.debug("All pins of %s set up.", self.channel)
 
         except Exception as e:
-            print(f"Error during pin setup: {e}")
+            logger.error("Error during pin setup: %s", e)
             self.pins_setup = False
 
     def enable(self):
         """Enable the motor driver (ENABLE pin is active low)."""
         if not self.pins_setup:
             raise RuntimeError("Pins have not been set up correctly.")
-        GPIO.output(self.pins['ENABLE']['number'], GPIO.LOW)
-        print(f"Motor enabled")
+        with self._idle_lock:
+            self._cancel_idle()
+            if self.shadow.write(self.enable_pin, self.gpio.LOW):
+                logger.debug("Motor enabled")
 
     def disable(self):
         """Disable the motor driver (ENABLE pin is active low)."""
         if not self.pins_setup:
             raise RuntimeError("Pins have not been set up correctly.")
-        GPIO.output(self.pins['ENABLE']['number'], GPIO.HIGH)
-        print(f"Motor disabled")
+        with self._idle_lock:
+            self._cancel_idle()
+            if self.shadow.write(self.enable_pin, self.gpio.HIGH):
+                logger.debug("Motor disabled")
+
+    def hold(self):
+        """Keep the driver enabled between moves until release() (holds nest, e.g. for a program run)."""
+        with self._idle_lock:
+            self.holds += 1
+            self._cancel_idle()
+
+    def release(self):
+        """End a hold(); once no hold is left the idle timeout starts."""
+        with self._idle_lock:
+            self.holds = max(self.holds - 1, 0)
+            self.idle()
+
+    def idle(self):
+        """Apply the idle policy after a move: disable now, later from a timer, or not while held."""
+        with self._idle_lock:
+            self._cancel_idle()
+            if self.holds or self._pending is not None:
+                return
+            if not self.idle_timeout:
+                self.disable()
+                return
+            timer = threading.Timer(self.idle_timeout, self._idle_expired)
+            timer.daemon = True
+            self._idle_timer = timer
+            timer.start()
+
+    def _idle_expired(self):
+        with self._idle_lock:
+            # A move, hold or newer timer since this one was started wins over it
+            if self._idle_timer is threading.current_thread() and not self.holds and self._pending is None:
+                self.disable()
+                logger.debug("%s idle for %s s; motor disabled.", self.channel, self.idle_timeout)
+
+    def _cancel_idle(self):
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
 
     def set_direction(self, direction):
         """Set direction to Clockwise (HIGH) or Counter-Clockwise (LOW)."""
         if not self.pins_setup:
             raise RuntimeError("Pins have not been set up correctly.")
-        if direction == "CW":
-            GPIO.output(self.pins['DIR']['number'], GPIO.HIGH)
-            print(f"Direction set to Clockwise")
-        else:
-            GPIO.output(self.pins['DIR']['number'], GPIO.LOW)
-            print(f"Direction set to Counter-Clockwise")
+        if self.shadow.write(self.dir_pin, self.gpio.HIGH if direction == "CW" else self.gpio.LOW):
+            logger.debug("Direction set to %s", "clockwise" if direction == "CW" else "counter-clockwise")
 
-    def calibrate(self):
-        """Calibrate the sleep overhead and store it."""
+    def calibrate(self, force=False):
+        """
+        Load the sleep overhead from the calibration store, measuring it only if
+        there is no stored value for this host and configuration or force is True.
+        """
         if not self.pins_setup:
             raise RuntimeError("Pins have not been set up correctly.")
-        
+
+        key = CalibrationStore.key(self.pulseWidth, self.backend)
+        stored = None if force else self.calibration_store.get(key)
+        if stored is not None:
+            self.sleep_overhead = stored['sleep_overhead']
+            logger.info("Calibration loaded: sleep_overhead = %s", self.sleep_overhead)
+            return
+
         # Measure and store the sleep overhead using the new calibration function
         self.sleep_overhead = calibrate_sleep_overhead()  # Only measure sleep overhead
-        print(f"Calibration complete: sleep_overhead = {self.sleep_overhead}")
+        self.calibration_store.save(key, self.sleep_overhead)
+        logger.info("Calibration complete: sleep_overhead = %s", self.sleep_overhead)
+
+    def recalibrate(self, background=True):
+        """
+        Measure the sleep overhead again, by default in a background thread.
+
+        The measurement spins on time.sleep(0), so it must not overlap a move: it would
+        compete with the pulse loop for the CPU. Call it between moves, e.g. once a run
+        is over for the motors whose recalibration_due was set by a drifting move.
+        """
+        if self._calibration_thread is not None and self._calibration_thread.is_alive():
+            return  # Already recalibrating
+        self.recalibration_due = False
+        if not background:
+            self.calibrate(force=True)
+            return
+        self._calibration_thread = threading.Thread(target=self.calibrate, kwargs={'force': True}, daemon=True)
+        self._calibration_thread.start()
+
+    def reconfigure(self, **settings):
+        """
+        Change settings in place, without setting the pins up or calibrating again.
+
+        Only what a setting affects is redone: a new backend is calibrated (from the
+        calibration store when it has an entry), new ramp limits clear the planner's
+        schedule cache, and both reset the timing feedback learned with the old schedules.
+        A move still playing is finished first.
+
+        Args (all optional; settings not given are kept):
+            backend (str or PulseBackend): Pulse generator, e.g. 'gpio'. A name of the current
+                backend's type keeps the current instance.
+            max_accel (float): Planner acceleration limit in rev/s^2 (needs a planner).
+            max_jerk (float): Planner jerk limit in rev/s^3, None for a trapezoidal profile.
+            idle_timeout (float): See idle().
+
+        Returns the list of the settings that changed.
+        """
+        unknown = set(settings) - {'backend', 'max_accel', 'max_jerk', 'idle_timeout'}
+        if unknown:
+            raise ValueError(f"Cannot reconfigure {', '.join(sorted(unknown))}.")
+        self.wait()  # Nothing is swapped under a playing move
+        changed = []
+
+        if 'backend' in settings:
+            backend = settings['backend']
+            if isinstance(backend, str):
+                if isinstance(self.backend, BACKENDS.get(backend, ())):
+                    backend = self.backend
+                else:
+                    backend = make_backend(backend)
+            if backend is not self.backend:
+                self.backend.close()
+                self.backend = backend
+                changed.append('backend')
+
+        if 'max_accel' in settings or 'max_jerk' in settings:
+            if self.planner is None:
+                raise ValueError("This stepper has no motion planner to set limits on.")
+            if self.planner.set_limits(settings.get('max_accel', self.planner.max_accel),
+                                       settings.get('max_jerk', self.planner.max_jerk)):
+                changed.append('planner')
+
+        if 'idle_timeout' in settings and settings['idle_timeout'] != self.idle_timeout:
+            self.idle_timeout = settings['idle_timeout']
+            changed.append('idle_timeout')
+            self.idle()  # Restart a pending idle timer with the new timeout
+
+        # Derived state that depends on the old settings
+        if 'backend' in changed and self.sleep_overhead is not None:
+            self.calibrate()  # The calibration is kept per backend
+        if ('backend' in changed or 'planner' in changed) and self.feedback is not None:
+            self.feedback.reset()
+        if changed:
+            logger.info("%s reconfigured: %s.", self.channel, ", ".join(changed))
+        return changed
 
     def set_step_type(self, stepMode):
         """Set the step mode (full, half, quarter, sixteenth) without moving the motor."""
-        print(f"Setting step mode to {stepMode}")
+        logger.debug("Setting step mode to %s", stepMode)
         self.microstep.set_mode(stepMode)
-        print(f"Step mode {stepMode} set successfully.")
+        logger.debug("Step mode %s set.", stepMode)
+
+    def move(self, revolutions=None, steps=None, stepMode="full", speed=1, direction="CW", pulseWidth=5E-6, wait=True):
+        """
+        Move the stepper motor by a given number of revolutions or steps in the specified direction.
+
+        With a non-blocking backend and wait=False the call returns as soon as the pulse
+        train has been handed over; call wait() to finish the move and get its report.
+        """
+        offsets, spin_margin = self.prepare_move(revolutions, steps, stepMode, speed, direction, pulseWidth)
+        self.backend.play(offsets, self.pins, pulseWidth, spin_margin=spin_margin)
+        if not wait and not self.backend.blocking:
+            return None
+        return self.wait()
+
+    def prepare_move(self, revolutions=None, steps=None, stepMode="full", speed=1, direction="CW", pulseWidth=5E-6):
+        """
+        Set up the driver for a move and return its pulse train without playing it.
 
-    def move(self, revolutions=None, steps=None, stepMode="full", speed=1, direction="CW", pulseWidth=5E-6):
-        """Move the stepper motor by a given number of revolutions or steps in the specified direction."""
+        Returns (offsets, spin_margin) for a pulse backend or drivers.multiaxis; pass the
+        resulting timing report to finish_move() once the pulses have been played.
+        """
         if not self.pins_setup:
             raise RuntimeError("Pins have not been set up correctly.")
         
         if self.sleep_overhead is None:
             raise RuntimeError("Sleep overhead not calibrated. Please run calibrate() first.")
 
+        # Finish any move still playing before touching the pins
+        self.wait()
+
         # Set microstepping mode
         self.microstep.set_mode(stepMode)
         spr = self.microstep.get_factor() * self.motor_spr  # Steps per revolution
 
         # Determine if we're moving by revolutions or steps
+        sign = 1 if direction == "CW" else -1
+        unit = POSITION_RESOLUTION // self.microstep.get_factor()  # Position units per step in this mode
         if steps is not None:
-            total_steps = steps
+            total_steps = int(steps)
+            self.target += sign * total_steps * unit
             revolutions = total_steps / spr  # Convert steps to revolutions for rps reporting
-            print(f"Moving {steps} steps in {stepMode} mode, which is {revolutions:.3f} revolutions.")
+            logger.debug("Moving %s steps in %s mode, which is %.3f revolutions.", steps, stepMode, revolutions)
         elif revolutions is not None:
-            total_steps = spr * revolutions
-            print(f"Moving {revolutions} revolutions in {stepMode} mode, which is {total_steps} steps.")
+            # Round the distance to the target, not the move, so rounding errors do not add up
+            self.target += sign * revolutions * self.motor_spr * POSITION_RESOLUTION
+            total_steps = max(int(round(sign * (self.target - self.position) / unit)), 0)
+            logger.debug("Moving %s revolutions in %s mode, which is %d steps.", revolutions, stepMode, total_steps)
         else:
             raise ValueError("Either revolutions or steps must be provided.")
-        total_steps = int(round(total_steps))
 
         # Calculate steps per second (SPS)
         sps = spr * speed
 
-        # Calculate stepDelay based on speed, sleep overhead, and pulse width
-        step_desired = 1 / sps
-        self.stepDelay = step_desired - self.sleep_overhead - pulseWidth
-        self.stepDelay = max(self.stepDelay, pulseWidth)  # Ensure minimum step delay
+        # Step period; pulses are scheduled at absolute deadlines so sleep overhead is not subtracted here
+        self.stepDelay = max(1 / sps, 2 * pulseWidth)  # Leave room for the low half of the pulse
+        spin_margin = max(SPIN_MARGIN, 2 * self.sleep_overhead)
         
         # Enable the motor
         self.enable()
@@ -126,18 +350,126 @@ class A4988:
         # Set direction based on input
         self.set_direction(direction)
 
-        # Perform the steps
-        time_elapsed = step(total_steps, self.pins, pulseWidth, self.stepDelay)
-        
-        # Calculate revolutions per second (rps)
-        measured_rps = revolutions / time_elapsed
-        print(f"Movement complete. Speed measured @ {round(measured_rps, 3)} rps.")
+        # Precompute the whole pulse train
+        offsets, scale = self._waveform(total_steps, spr, stepMode, speed, self.stepDelay)
+        self._pending = (spr, speed, stepMode, scale, sign * unit)
+        return offsets, spin_margin
 
-        # Disable the motor after movement is complete
-        self.disable()
+    def _waveform(self, total_steps, spr, stepMode, speed, stepDelay):
+        """Pulse offsets of a move (ramped if a planner is set) and the feedback correction applied to them."""
+        if self.planner is not None:
+            offsets = self.planner.schedule(total_steps, 1 / (stepDelay * spr), stepMode, spr)
+        else:
+            offsets = build_waveform(total_steps, stepDelay)
+        scale = self.feedback.scale(stepMode, speed) if self.feedback is not None else 1.0
+        if scale != 1.0:
+            offsets = offsets * scale  # Correct for the step cost learned from earlier moves
+        return offsets, scale
+
+    def expected_duration(self, planned):
+        """
+        Duration the move set up by prepare_move() is expected to really take, from its
+        planned duration and the slowness the feedback measured on the last move like it.
+        """
+        if self.feedback is None or self._pending is None:
+            return planned
+        _, speed, stepMode, _, _ = self._pending
+        return planned * self.feedback.slowness(stepMode, speed)
+
+    def remaining_waveform(self, steps):
+        """Pulse offsets for the last `steps` steps of the move set up by prepare_move(), starting from a standstill."""
+        spr, speed, stepMode, _, _ = self._pending
+        offsets, _ = self._waveform(steps, spr, stepMode, speed, self.stepDelay)
+        return offsets
+
+    def move_duration(self, revolutions, stepMode="full", speed=1, pulseWidth=5E-6):
+        """Planned duration in s of a move, computed without touching the pins."""
+        spr = self.microstep.MSmap.get(stepMode, self.microstep.MSmap['full'])['factor'] * self.motor_spr
+        total_steps = int(round(spr * revolutions))
+        stepDelay = max(1 / (spr * speed), 2 * pulseWidth)
+        offsets, _ = self._waveform(total_steps, spr, stepMode, speed, stepDelay)
+        return float(offsets[-1])
+
+    @property
+    def revolutions(self):
+        """Position in revolutions from zero (CW positive)."""
+        return self.position / (self.motor_spr * POSITION_RESOLUTION)
+
+    def distance(self, direction):
+        """Total revolutions moved in a direction ("CW" or "CCW") since the counters were created."""
+        return self.odometer[direction] / (self.motor_spr * POSITION_RESOLUTION)
+
+    def set_position(self, position=0):
+        """Declare the current position (in POSITION_RESOLUTION units), e.g. 0 at the home position."""
+        self.position = int(position)
+        self.target = float(self.position)
+        self.save_position()
+
+    def save_position(self):
+        self.position_store.save(self.channel, {'position': self.position, 'target': self.target, **self.odometer})
+
+    def wait(self):
+        """Wait for the current move to finish, report its timing and apply the idle policy (see idle())."""
+        if self._pending is None:
+            return self.last_move
+        return self.finish_move(self.backend.wait())
+
+    def finish_move(self, report):
+        """Complete the move set up by prepare_move() with the timing report of its pulses."""
+        spr, speed, stepMode, scale, step_units = self._pending
+        self._pending = None
+        total_steps = report['steps']
+        cancelled = report.get('cancelled', False)  # Stopped part way: its timing says nothing about drift
+
+        # Count the steps actually played
+        self.position += total_steps * step_units
+        self.odometer['CW' if step_units > 0 else 'CCW'] += total_steps * abs(step_units)
+        if cancelled:
+            self.target = float(self.position)  # The rest of the move is abandoned
+        self.save_position()
+
+        # Calculate revolutions per second (rps) and the error against the planned average speed
+        time_elapsed = report['elapsed']
+        target = report['planned'] / scale  # Duration before the feedback correction
+        report['correction'] = scale
+        if self.feedback is not None and not cancelled:
+            self.feedback.update(stepMode, speed, total_steps, target, steady_elapsed(report))
+        planned_rps = (total_steps / spr) / target if target > 0 else speed
+        measured_rps = (total_steps / spr) / time_elapsed if time_elapsed > 0 else planned_rps
+        report['step_mode'] = stepMode
+        report['steps_per_rev'] = spr
+        report['requested_rps'] = speed
+        report['planned_rps'] = planned_rps
+        report['measured_rps'] = measured_rps
+        report['rps_error'] = measured_rps / planned_rps - 1
+        self.last_move = report
+        logger.info("Movement complete. Speed measured @ %.3f rps (%+.2f%% vs plan, max step lateness %.0f us).",
+                    measured_rps, report['rps_error'] * 100, report['max_late'] * 1E6)
+        if cancelled:
+            logger.info("Movement stopped after %d steps.", total_steps)
+        elif abs(report['rps_error']) > self.rps_tolerance:
+            logger.warning("Measured speed is outside the %.0f%% tolerance of the planned %.3f rps.",
+                           self.rps_tolerance * 100, planned_rps)
+        # Only marked here: recalibrating now would run alongside the pulses of later moves
+        report['drifted'] = not cancelled and abs(report['rps_error']) > self.drift_threshold
+        if report['drifted']:
+            logger.warning("Step timing drifted %+.2f%%; recalibration due once the motor is idle.",
+                           report['rps_error'] * 100)
+            self.recalibration_due = True
+        for listener in self.listeners:
+            listener(report)
+
+        # Disable the motor now or after the idle timeout, unless it is held
+        self.idle()
+
+        return report
 
     def cleanup(self):
         """Clean up the GPIO resources."""
-        print("Cleaning up GPIO resources for the stepper.")
-        GPIO.cleanup()
+        logger.info("Cleaning up GPIO resources for the stepper.")
+        self.wait()
+        self.disable()
+        self.backend.close()
+        self.gpio.cleanup()
+        self.shadow.invalidate()  # The pins are back to inputs; write every level again after a new setup
 
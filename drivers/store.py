@@ -0,0 +1,50 @@
+import json
+import os
+import tempfile
+import threading
+
+class JsonStore:
+    def __init__(self, path):
+        """
+        Dictionary of entries persisted to a JSON file, shared by every user of the file.
+
+        Saves re-read the file and merge the new entry into it under a lock, so several
+        stores (or threads) writing different keys of the same file never drop each
+        other's entries.
+
+        Args:
+            path (str): JSON file holding the entries; None keeps them in memory only
+                (e.g. for a dry run or a benchmark).
+        """
+        self.path = path
+        self.entries = None if path is not None else {}  # Loaded lazily
+        self.lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def get(self, key):
+        """Return the stored entry for key, or None."""
+        with self.lock:
+            if self.entries is None:
+                self.entries = self._read()
+            return self.entries.get(key)
+
+    def put(self, key, value):
+        """Store an entry, merging it into the file and replacing the file atomically."""
+        with self.lock:
+            if self.path is None:
+                self.entries[key] = value
+                return
+            entries = self._read()
+            entries[key] = value
+            directory = os.path.dirname(self.path) or '.'
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as file:
+                json.dump(entries, file, indent=4)
+            os.replace(tmp_path, self.path)
+            self.entries = entries
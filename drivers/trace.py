@@ -0,0 +1,270 @@
+"""
+Motion traces: the STEP edge times of recorded moves, one binary file per move.
+
+File layout (little endian):
+
+    header  HEADER_SIZE bytes: magic, version, step count, run ID, channel,
+            step mode, requested rps, steps per revolution, wall-clock start
+    edges   count x float64: rising edge times in s from the first deadline
+    late    count x float32: lateness of each edge behind its deadline in s
+
+Both columns are read through numpy memmaps, so a trace of millions of steps is
+analyzed chunk by chunk without loading it into RAM.
+"""
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import numpy as np
+
+TRACE_DIR = 'traces'
+MAGIC = b'NMRTRACE'
+VERSION = 1
+HEADER = struct.Struct('<8sHxxQ32s16s16sddI')
+HEADER_SIZE = 128  # HEADER padded, so the columns start aligned
+
+logger = logging.getLogger(__name__)
+
+def _text(raw):
+    return raw.rstrip(b'\0').decode('utf-8', 'replace')
+
+def write_trace(path, edges, late, run_id='', channel='', step_mode='', requested_rps=0.0, steps_per_rev=0,
+                started=None):
+    """
+    Write a trace file.
+
+    Args:
+        edges (array): perf_counter times of the rising edges (any origin; stored relative to the first deadline).
+        late (array): Lateness of each edge behind its deadline in s.
+    """
+    edges = np.asarray(edges, dtype=np.float64)
+    late = np.asarray(late, dtype=np.float64)
+    origin = float(edges[0] - late[0]) if len(edges) else 0.0
+    header = HEADER.pack(MAGIC, VERSION, len(edges), run_id.encode()[:32], channel.encode()[:16],
+                         step_mode.encode()[:16], float(requested_rps), time.time() if started is None else started,
+                         int(steps_per_rev))
+    with open(path, 'wb') as file:
+        file.write(header.ljust(HEADER_SIZE, b'\0'))
+        (edges - origin).tofile(file)
+        late.astype('<f4').tofile(file)
+    return path
+
+class Trace:
+    def __init__(self, path):
+        """
+        A trace file opened lazily: edges and late are read-only memmaps of its columns.
+
+        Args:
+            path (str): File written by write_trace().
+        """
+        self.path = path
+        with open(path, 'rb') as file:
+            raw = file.read(HEADER.size)
+        if len(raw) < HEADER.size:
+            raise ValueError(f"{path} is not a trace file.")
+        magic, version, count, run_id, channel, step_mode, requested_rps, started, steps_per_rev = HEADER.unpack(raw)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} trace file.")
+        self.count = count
+        self.header = {
+            'run_id': _text(run_id),
+            'channel': _text(channel),
+            'step_mode': _text(step_mode),
+            'requested_rps': requested_rps,
+            'steps_per_rev': steps_per_rev,
+            'started': started,
+            'steps': count,
+        }
+        if count:
+            self.edges = np.memmap(path, dtype='<f8', mode='r', offset=HEADER_SIZE, shape=(count,))
+            self.late = np.memmap(path, dtype='<f4', mode='r', offset=HEADER_SIZE + 8 * count, shape=(count,))
+        else:
+            self.edges = np.zeros(0)
+            self.late = np.zeros(0, dtype=np.float32)
+
+    def __len__(self):
+        return self.count
+
+    def chunks(self, chunk_size=1 << 20):
+        """Yield (edges, late) in chunks that overlap by one edge, so intervals across chunk ends are kept."""
+        for start in range(0, max(self.count - 1, 1), chunk_size):
+            stop = min(start + chunk_size + 1, self.count)
+            yield np.asarray(self.edges[start:stop]), np.asarray(self.late[start:stop], dtype=np.float64)
+
+class TraceRecorder:
+    def __init__(self, directory=TRACE_DIR):
+        """
+        Writes the STEP edges of every move of the attached motors to trace files.
+
+        The pulse loops already keep every edge time in a pre-allocated buffer (the
+        'edges' and 'late' arrays of a timing report), so recording costs nothing while
+        the move plays. Once the move is finished, its arrays are queued and a writer
+        thread writes the file: finish_move() can be called from a pulse loop that still
+        has other channels' pulses due, so it must neither wait for the disk nor copy
+        millions of values. The arrays are queued as they are: every report gets arrays
+        of its own, which nothing writes to once the move is finished.
+
+        Args:
+            directory (str): Directory of the trace files, named <run ID>-<channel>-<move>.trace.
+        """
+        self.directory = directory
+        self.run_id = time.strftime('%Y%m%d-%H%M%S')
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()  # (path, write_trace() arguments) of the traces to write
+        os.makedirs(directory, exist_ok=True)
+        self.writer = threading.Thread(target=self._write, name='trace-writer', daemon=True)
+        self.writer.start()
+
+    def attach(self, motor):
+        """Record the moves of an A4988 from now on."""
+        motor.listeners.append(lambda report: self.record(motor.channel, report))
+
+    def start_run(self, run_id):
+        """Name the traces of the following moves after a run."""
+        with self.lock:
+            self.run_id = run_id
+            self.sequence = 0
+
+    def record(self, channel, report):
+        """Queue the trace of a finished move; return the path it will be written to (None if the report has no edges)."""
+        if not len(report.get('edges', ())):
+            return None
+        with self.lock:
+            self.sequence += 1
+            run_id, sequence = self.run_id, self.sequence
+        path = os.path.join(self.directory, f"{run_id}-{channel}-{sequence:04d}.trace")
+        self.pending.put((path, report['edges'], report['late'], {
+            'run_id': run_id,
+            'channel': channel,
+            'step_mode': report.get('step_mode', ''),
+            'requested_rps': report.get('requested_rps', 0.0),
+            'steps_per_rev': report.get('steps_per_rev', 0),
+            'started': time.time(),
+        }))
+        return path
+
+    def flush(self):
+        """Block until every queued trace has been written."""
+        self.pending.join()
+
+    def _write(self):
+        while True:
+            path, edges, late, header = self.pending.get()
+            try:
+                write_trace(path, edges, late, **header)
+            except OSError as e:
+                logger.error("Could not write trace %s: %s", path, e)
+            finally:
+                self.pending.task_done()
+
+def analyze(trace, deadline=1E-4, nfft=4096, peaks=5, chunk_size=1 << 20):
+    """
+    Timing statistics of a trace, computed chunk by chunk.
+
+    Args:
+        trace (Trace): Trace to analyze.
+        deadline (float): Lateness in s above which a step counts as a missed deadline.
+        nfft (int): Segment length of the averaged jitter spectrum (Welch's method).
+        peaks (int): Number of spectrum peaks reported.
+
+    Returns a dict with the step count, duration, instantaneous velocity (rps from every
+    step interval), step interval jitter (actual minus planned interval) percentiles,
+    lateness, missed deadlines and the strongest jitter frequencies.
+    """
+    spr = trace.header['steps_per_rev'] or 1
+    bins = np.logspace(-8, 1, 271)  # |jitter| histogram for the percentiles: 30 bins per decade
+    jitter_counts = np.zeros(len(bins) + 1, dtype=np.int64)
+    window = np.hanning(nfft)
+    power = np.zeros(nfft // 2 + 1)
+    segments = 0
+    carry = np.zeros(0)
+    intervals = 0
+    velocity = {'min': np.inf, 'max': 0.0, 'sum': 0.0}
+    jitter_sum = jitter_max = 0.0
+    late_max = 0.0
+    missed = 0
+
+    for index, (edges, late) in enumerate(trace.chunks(chunk_size)):
+        new = late if index == 0 else late[1:]  # Chunks after the first repeat the previous chunk's last edge
+        if len(new):
+            late_max = max(late_max, float(new.max()))
+            missed += int(np.count_nonzero(new > deadline))
+        actual = np.diff(edges)
+        if not len(actual):
+            continue
+        planned = np.diff(edges - late)
+        jitter = actual - planned
+        rps = 1 / (actual * spr)
+        intervals += len(actual)
+        velocity['min'] = min(velocity['min'], float(rps.min()))
+        velocity['max'] = max(velocity['max'], float(rps.max()))
+        velocity['sum'] += float(rps.sum())
+        magnitude = np.abs(jitter)
+        jitter_counts += np.bincount(np.searchsorted(bins, magnitude), minlength=len(bins) + 1)
+        jitter_sum += float(magnitude.sum())
+        jitter_max = max(jitter_max, float(magnitude.max()))
+
+        # Averaged spectrum of the jitter over whole segments of nfft steps
+        carry = np.concatenate([carry, jitter])
+        whole = len(carry) // nfft * nfft
+        if whole:
+            blocks = carry[:whole].reshape(-1, nfft)
+            blocks = (blocks - blocks.mean(axis=1, keepdims=True)) * window
+            power += (np.abs(np.fft.rfft(blocks, axis=1)) ** 2).sum(axis=0)
+            segments += len(blocks)
+            carry = carry[whole:]
+
+    duration = float(trace.edges[-1] - trace.edges[0]) if len(trace) > 1 else 0.0
+    result = {
+        **trace.header,
+        'duration': duration,
+        'mean_sps': intervals / duration if duration > 0 else 0.0,
+        'velocity_rps': {
+            'mean': velocity['sum'] / intervals if intervals else 0.0,
+            'min': velocity['min'] if intervals else 0.0,
+            'max': velocity['max'],
+        },
+        'jitter_us': {
+            'mean': jitter_sum / intervals * 1E6 if intervals else 0.0,
+            'p50': _percentile(jitter_counts, bins, 0.50) * 1E6,
+            'p99': _percentile(jitter_counts, bins, 0.99) * 1E6,
+            'max': jitter_max * 1E6,
+        },
+        'max_late_us': late_max * 1E6,
+        'missed_deadlines': missed,
+        'deadline_us': deadline * 1E6,
+        'spectrum_peaks': [],
+    }
+    if segments and result['mean_sps'] > 0:
+        # Frequencies assume steps evenly spaced at the mean step rate
+        power = power[1:] / segments  # Without the DC bin
+        freqs = np.fft.rfftfreq(nfft, d=1 / result['mean_sps'])[1:]
+        amplitude = np.sqrt(power) * 2 / window.sum()
+        for index in np.argsort(power)[::-1][:peaks]:
+            result['spectrum_peaks'].append({'hz': float(freqs[index]), 'amplitude_us': float(amplitude[index] * 1E6)})
+    return result
+
+def _percentile(counts, bins, q):
+    """Upper bound of the histogram bin holding the q quantile."""
+    total = counts.sum()
+    if not total:
+        return 0.0
+    index = int(np.searchsorted(np.cumsum(counts), q * total))
+    return float(bins[min(index, len(bins) - 1)])
+
+def compare(a, b, **kwargs):
+    """Analyze two traces; return (analysis of a, analysis of b, {metric: b - a})."""
+    first, second = analyze(a, **kwargs), analyze(b, **kwargs)
+    delta = {
+        'duration': second['duration'] - first['duration'],
+        'mean_sps': second['mean_sps'] - first['mean_sps'],
+        'velocity_rps_mean': second['velocity_rps']['mean'] - first['velocity_rps']['mean'],
+        'jitter_us_p50': second['jitter_us']['p50'] - first['jitter_us']['p50'],
+        'jitter_us_p99': second['jitter_us']['p99'] - first['jitter_us']['p99'],
+        'max_late_us': second['max_late_us'] - first['max_late_us'],
+        'missed_deadlines': second['missed_deadlines'] - first['missed_deadlines'],
+    }
+    return first, second, delta
@@ -1,11 +1,15 @@
+import logging
 import time
-import RPi.GPIO as GPIO
+import numpy as np
+from drivers.gpio import GPIO
+
+logger = logging.getLogger(__name__)
 
 def calibrate_sleep_overhead(n=1E4):
     """Calibrate the sleep overhead by performing a large number of short sleep calls."""
     
     # Measure sleep overhead
-    print('Measuring sleep overhead...')
+    logger.info("Measuring sleep overhead...")
     t1 = time.time()
     for i in range(int(n)):
         time.sleep(0)  # Perform a large number of short sleep calls to measure overhead
@@ -13,8 +17,7 @@ def calibrate_sleep_overhead(n=1E4):
     t2 = time.time()
     
     sleep_overhead = (t2 - t1) / n  # Average sleep overhead per step
-    print(f'{n} sleeps took {t2 - t1:.6f} seconds.')
-    print(f'sleep_overhead =~ {sleep_overhead:.6f} seconds per step.')
+    logger.info("%d sleeps took %.6f seconds; sleep_overhead =~ %.6f seconds per step.", n, t2 - t1, sleep_overhead)
 
     return sleep_overhead
 
@@ -24,35 +27,150 @@ def calibrate_sleep_overhead(n=1E4):
 # pulseWidth = 5E-6  # Example pulse width
 # step_delay = calibrate_step_delay(ms, speed, pulseWidth)
 
+# Gaps longer than this are slept through (minus the margin); shorter ones are spun.
+# time.sleep on an RPi4 overshoots by roughly 60-130 us, so sleeping any closer to
+# a deadline than this makes the step late.
+SPIN_MARGIN = 2E-4
+
+# A pulse train that fell behind its deadlines (a stall, a long preemption) catches up
+# by running at most this fraction faster than planned, instead of firing the missed
+# pulses back to back: a burst the motor cannot follow loses steps.
+CATCH_UP = 0.1
+
+def build_waveform(n, period):
+    """
+    Precompute the pulse train for a constant-speed move.
+
+    Returns an array of n + 1 offsets (seconds from the start of the move): the
+    first n are the rising edges of each STEP pulse, the last one is the end of
+    the move (one full period after the last pulse).
+    """
+    return np.arange(n + 1, dtype=np.float64) * period
+
+def lateness_stats(late, edges):
+    """
+    Lateness fields of a timing report from the lateness (s) and the perf_counter time
+    of the rising edge of every played pulse.
+
+    The arrays themselves are kept as 'late' and 'edges', so per-pulse statistics (a
+    jitter histogram, a motion trace) can be taken after the move without touching the
+    pulse loop.
+    """
+    measured = late if len(late) else np.zeros(1)
+    return {
+        'mean_late': float(measured.mean()),
+        'max_late': float(measured.max()),
+        'p99_late': float(np.percentile(measured, 99)),
+        'late': late,
+        'edges': edges,
+    }
+
+def play_waveform(offsets, pin, pulseWidth, spin_margin=SPIN_MARGIN, catch_up=CATCH_UP):
+    """
+    Play back a precomputed pulse train against the monotonic clock.
+
+    Every pulse is fired at an absolute deadline (start + offset), so time spent
+    in GPIO calls or a late wake-up is absorbed by the next gap instead of adding
+    up over the move. Long gaps are slept through, the last spin_margin seconds
+    before each deadline are busy-waited. No pulse follows the previous one sooner
+    than its planned interval shortened by catch_up (see CATCH_UP), so a stall is
+    made up gradually rather than in a burst.
+
+    Returns a dict with the elapsed and planned durations of the move and the
+    lateness of the pulses relative to their deadlines (seconds, see lateness_stats).
+    """
+    n = len(offsets) - 1
+    step_pin = pin['STEP']['number']
+    clock = time.perf_counter
+    sleep = time.sleep
+    output = GPIO.output
+    high, low = GPIO.HIGH, GPIO.LOW
+    actual = [0.0] * n
+
+    start_time = clock()
+    deadlines = (offsets + start_time).tolist()
+    min_intervals = (np.diff(offsets, prepend=offsets[0]) * (1 - catch_up)).tolist()
+    last = start_time
+
+    for i in range(n):
+        deadline = max(deadlines[i], last + min_intervals[i])
+        gap = deadline - clock()
+        if gap > spin_margin:
+            sleep(gap - spin_margin)
+        while clock() < deadline:
+            pass
+        output(step_pin, high)
+        t = clock()
+        actual[i] = t
+        last = t
+        while clock() - t < pulseWidth:  # minimum pulse width, spun rather than slept
+            pass
+        output(step_pin, low)
+
+    # Hold the last period so the move lasts as long as it was planned to
+    deadline = max(deadlines[n], last + min_intervals[n])
+    gap = deadline - clock()
+    if gap > spin_margin:
+        sleep(gap - spin_margin)
+    while clock() < deadline:
+        pass
+    end_time = clock()
+
+    edges = np.asarray(actual)
+    return {
+        'steps': n,
+        'elapsed': end_time - start_time,
+        'planned': float(offsets[n]),
+        **lateness_stats(edges - np.asarray(deadlines[:n]), edges),
+    }
+
 def step(n, pin, pulseWidth, stepDelay):
+    """Perform n evenly spaced steps (pulseWidth high + stepDelay low) and return the elapsed time."""
+    offsets = build_waveform(n, pulseWidth + stepDelay)
+    return play_waveform(offsets, pin, pulseWidth)['elapsed']
 
-    start_time = time.time()
+class PinShadow:
+    __slots__ = ('gpio', 'levels')
 
-    for i in range(n):# 1 revolution
-        GPIO.output(pin['STEP']['number'], GPIO.HIGH)
-        time.sleep(pulseWidth)  # minimum pulse width # each of these calls costs 0.000125 s on average on an RPI4, mainly due to time.sleep overhead. Subtract this from the pulseWidth before using?
-        GPIO.output(pin['STEP']['number'], GPIO.LOW)
-        time.sleep(stepDelay)  # Short sleep to reduce CPU usage
-    
-    end_time = time.time()
+    def __init__(self, gpio=None):
+        """
+        Last level written to each output pin, so unchanged pins are not written again.
 
-    time_elapsed = end_time-start_time
-    
-    return time_elapsed
+        Shared by the A4988 and its Microstep; invalidate() it whenever the pins may have
+        been changed behind its back (GPIO.cleanup(), a new setup). gpio is the GPIO module
+        written to (default drivers.gpio.GPIO).
+        """
+        self.gpio = gpio or GPIO
+        self.levels = {}  # pin number -> level
+
+    def write(self, number, level):
+        """Drive a pin to level unless it is known to be there already; return True if written."""
+        if self.levels.get(number) == level:
+            return False
+        self.gpio.output(number, level)
+        self.levels[number] = level
+        return True
+
+    def invalidate(self):
+        self.levels.clear()
 
 class Microstep:
-    def __init__(self, pins, mode = 'full'):
-        # Store the GPIO pins for MS1, MS2, MS3
+    __slots__ = ('pins', 'ms_pins', 'shadow', 'current_mode', 'current_factor')
+
+    # Microstepping modes map
+    MSmap = {
+        'full': {'key': [0, 0, 0], 'factor': 1},
+        'half': {'key': [1, 0, 0], 'factor': 2},
+        'quarter': {'key': [0, 1, 0], 'factor': 4},
+        'eighth': {'key': [1, 1, 0], 'factor': 8},
+        'sixteenth': {'key': [1, 1, 1], 'factor': 16}
+    }
+
+    def __init__(self, pins, mode = 'full', shadow=None):
+        # Store the GPIO pins for MS1, MS2, MS3, resolved once to their numbers
         self.pins = pins
-        
-        # Microstepping modes map
-        self.MSmap = {
-            'full': {'key': [0, 0, 0], 'factor': 1},
-            'half': {'key': [1, 0, 0], 'factor': 2},
-            'quarter': {'key': [0, 1, 0], 'factor': 4},
-            'eighth': {'key': [1, 1, 0], 'factor': 8},
-            'sixteenth': {'key': [1, 1, 1], 'factor': 16}
-        }
+        self.ms_pins = tuple(pins[pin_name]['number'] for pin_name in ('MS1', 'MS2', 'MS3'))
+        self.shadow = shadow or PinShadow()
         
         # Track the current mode and factor
         self.current_mode = None
@@ -74,17 +192,15 @@ class Microstep:
         """Set the microstepping mode and configure the GPIO pins."""
         # Check if the mode exists, if not, default to 'full'
         if mode not in self.MSmap:
-            print(f'Invalid stepMode {mode}. Setting to "full".')
+            logger.warning('Invalid stepMode %s. Setting to "full".', mode)
             mode = 'full'
         
         ms_values = self.MSmap[mode]['key']
         
-        # Set the MS1, MS2, MS3 pins based on the selected mode
-        ms_pins = ['MS1', 'MS2', 'MS3']
-        for pin_name, val in zip(ms_pins, ms_values):
-            setting = GPIO.HIGH if val else GPIO.LOW
-            GPIO.output(self.pins[pin_name]['number'], setting)
-            print(f"Set {pin_name} to {'HIGH' if setting == GPIO.HIGH else 'LOW'}")
+        # Set the MS1, MS2, MS3 pins that differ from the selected mode
+        for number, val in zip(self.ms_pins, ms_values):
+            if self.shadow.write(number, GPIO.HIGH if val else GPIO.LOW):
+                logger.debug("Set GPIO %s to %s", number, 'HIGH' if val else 'LOW')
         
         # Track the current mode and factor
         self.current_mode = mode
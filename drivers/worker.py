@@ -0,0 +1,521 @@
+"""
+Step worker: the STEP pulses of the MultiAxis engine, played in a separate process.
+
+Inside the Flask process the pulse loop competes for the GIL with every request,
+SSE stream and template render. ProcessEngine has the engine interface the Runtime
+and dispense_together() use (start, run_until, resume, cancel, end_time, busy,
+move), but plays the pulses in a worker process (python -m drivers.worker) running
+its own MultiAxis, optionally pinned to isolated cores and under SCHED_FIFO.
+
+The two processes share one block of memory:
+
+    control   int64 words: command ring head and tail, interrupt flag, last reply,
+              worker PID, CPU mask and priority, error flag
+    commands  ring of fixed-size command records (START, LOAD, RUN, RESUME, CANCEL, STOP)
+    status    one record per axis: steps left, planned end and the result of the
+              last finished move, published by the worker
+    data      pool the pulse offsets of a command are written to
+    late      lateness and rising edge times of the finished moves, handed over in
+    edges     chunks when they do not fit at once
+
+Commands and offsets are written in place and read through numpy views on the other
+side, so nothing is pickled. Pipes only carry wake-ups: a doorbell for new commands,
+a reply byte when a command is done, and an interrupt byte that wakes the worker's
+sleeps when the run is paused or cancelled. Deadlines are perf_counter times, which
+are system-wide (CLOCK_MONOTONIC on Linux), so the same numbers mean the same
+instants in both processes.
+
+Motor state (DIR, ENABLE, microstep pins, positions, calibration) stays in the app
+process: the worker only drives the STEP pins and reports what it played, and the
+motors' finish_move() is called in the app process with that report.
+"""
+import json
+import logging
+import os
+import select
+import subprocess
+import sys
+import time
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+from drivers.gpio import GPIO
+from drivers.multiaxis import MultiAxis
+from drivers.utils import SPIN_MARGIN, lateness_stats
+
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Command kinds
+START, LOAD, RUN, RESUME, CANCEL, STOP = range(1, 7)
+
+# Words of the control block
+HEAD, TAIL, INTERRUPT, REPLY, PID, CPUS, PRIORITY, ERROR, CHUNK, ACK, CHUNK_START, CHUNK_LEN = range(12)
+CONTROL_SIZE = 16
+ERROR_SIZE = 256  # Bytes of the message of the last failed command
+
+COMMAND = np.dtype([('kind', '<i8'), ('axis', '<i8'), ('pin', '<i8'), ('count', '<i8'), ('data', '<i8'),
+                    ('at', '<f8')])
+STATUS = np.dtype([('steps', '<i8'), ('remaining', '<i8'), ('finished', '<i8'), ('cancelled', '<i8'),
+                   ('result', '<i8'), ('count', '<i8'), ('start', '<f8'), ('end', '<f8'), ('elapsed', '<f8'),
+                   ('planned', '<f8'), ('fraction', '<f8')])
+
+VIEWS = ('control', 'commands', 'status', 'data', 'late', 'edges', 'error')
+
+def _layout(ring_size, data_size, result_size, max_axes):
+    """(name, dtype, count, offset) of every view of the shared block, and its total size."""
+    fields = [('control', np.int64, CONTROL_SIZE), ('commands', COMMAND, ring_size), ('status', STATUS, max_axes),
+              ('data', np.float64, data_size), ('late', np.float64, result_size),
+              ('edges', np.float64, result_size), ('error', np.uint8, ERROR_SIZE)]
+    layout = []
+    offset = 0
+    for name, dtype, count in fields:
+        dtype = np.dtype(dtype)
+        layout.append((name, dtype, count, offset))
+        offset += (dtype.itemsize * count + 63) // 64 * 64  # Cache-line aligned
+    return layout, offset
+
+def _views(buf, sizes):
+    layout, _ = _layout(*sizes)
+    return {name: np.ndarray((count,), dtype=dtype, buffer=buf, offset=offset) for name, dtype, count, offset in layout}
+
+def isolate(cpus=None, priority=None):
+    """
+    Pin the calling process to a set of CPUs and run it under SCHED_FIFO (Linux).
+
+    Either step is skipped with a warning where it is not available or not permitted
+    (SCHED_FIFO needs root or CAP_SYS_NICE). Returns (CPUs the process may run on,
+    SCHED_FIFO priority or 0).
+    """
+    if cpus:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except (AttributeError, OSError) as e:
+            logger.warning("Could not pin the step worker to CPUs %s: %s", sorted(cpus), e)
+    applied = 0
+    if priority:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+            applied = priority
+        except (AttributeError, OSError) as e:
+            logger.warning("Could not run the step worker under SCHED_FIFO %d: %s", priority, e)
+    try:
+        allowed = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        allowed = []
+    return allowed, applied
+
+class ProcessEngine:
+    def __init__(self, pulseWidth=5E-6, spin_margin=SPIN_MARGIN, check_every=16, cpus=None, priority=None,
+                 ring_size=256, data_size=1 << 21, result_size=1 << 20, max_axes=8, poll=0.005, timeout=30.0):
+        """
+        Drop-in for drivers.multiaxis.MultiAxis that plays the pulses in a worker process.
+
+        Args:
+            pulseWidth (float): STEP pulse width in s.
+            spin_margin (float): Busy-wait this long before each deadline instead of sleeping.
+            check_every (int): Pulses played between two checks of the interrupt flag.
+            cpus (iterable): CPUs the worker is pinned to, e.g. {3} for a core set aside
+                with isolcpus=3 (default: not pinned).
+            priority (int): SCHED_FIFO priority of the worker, 1-99 (default: normal scheduling).
+            ring_size (int): Commands the ring holds.
+            data_size (int): Pulse offsets the data pool holds; bounds the steps of one move.
+            result_size (int): Lateness values the result pool holds; moves with more are
+                handed over in several chunks.
+            max_axes (int): Number of channels that can be driven.
+            poll (float): Interval in s at which a pending reply is checked against the run's token.
+            timeout (float): Time in s the worker is given to start.
+        """
+        self.sizes = (ring_size, data_size, result_size, max_axes)
+        self.poll = poll
+        self.seq = 0  # Sequence number of the last command sent
+        self.data_pos = 0  # Next free slot of the data pool
+        self.axes = {}  # name -> {'motor', 'id', 'end'} of the move running on that axis
+        self.ids = {}  # name -> axis id (index of its status record)
+        self.closed = False
+
+        _, size = _layout(*self.sizes)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        for name, view in _views(self.shm.buf, self.sizes).items():
+            setattr(self, name, view)
+        self.control[:] = 0
+
+        doorbell_r, self.doorbell = os.pipe()
+        self.replies, reply_w = os.pipe()
+        interrupt_r, self.interrupt = os.pipe()
+        config = {
+            'shm': self.shm.name,
+            'sizes': self.sizes,
+            'pulseWidth': pulseWidth,
+            'spin_margin': spin_margin,
+            'check_every': check_every,
+            'cpus': sorted(cpus) if cpus else None,
+            'priority': priority,
+            'fds': [doorbell_r, reply_w, interrupt_r],
+        }
+        self.process = subprocess.Popen([sys.executable, '-m', 'drivers.worker', json.dumps(config)], cwd=ROOT_DIR,
+                                        pass_fds=(doorbell_r, reply_w, interrupt_r))
+        for fd in (doorbell_r, reply_w, interrupt_r):
+            os.close(fd)
+        try:
+            self._wait(lambda: self.control[PID] != 0, timeout=timeout)
+        except Exception:
+            self.close()
+            raise
+        logger.info("Step worker running: %s", self.state())
+
+    def state(self):
+        """PID, CPUs and SCHED_FIFO priority of the worker, and the steps left of each running move."""
+        mask = int(self.control[CPUS])
+        return {
+            'pid': int(self.control[PID]),
+            'alive': self.process.poll() is None,
+            'cpus': [cpu for cpu in range(64) if mask >> cpu & 1],
+            'priority': int(self.control[PRIORITY]),
+            'remaining': {name: int(self.status[axis['id']]['remaining']) for name, axis in self.axes.items()},
+        }
+
+    def _wait(self, done, token=None, timeout=None):
+        """Wait for the worker until done() is true, forwarding an interruption of the token."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not done():
+            if token is not None and token.interrupted and not self.control[INTERRUPT]:
+                self.control[INTERRUPT] = 1
+                os.write(self.interrupt, b'!')
+            if self.control[CHUNK] != self.control[ACK]:
+                self._take_results(self.seq)  # A full result pool, before the reply to the last command
+                self.control[ACK] = self.control[CHUNK]
+                os.write(self.doorbell, b'.')
+            readable, _, _ = select.select([self.replies], [], [], self.poll)
+            if readable and not os.read(self.replies, 4096) or self.process.poll() is not None:
+                raise RuntimeError(f"The step worker has stopped (exit code {self.process.poll()}).")
+            if deadline is not None and time.monotonic() > deadline:
+                raise RuntimeError("The step worker did not answer in time.")
+        if self.control[ERROR]:
+            message = bytes(self.error).rstrip(b'\0').decode('utf-8', 'replace')
+            self.control[ERROR] = 0
+            raise RuntimeError(f"Step worker: {message}")
+
+    def _send(self, kind, axis=0, pin=0, at=0.0, offsets=None):
+        """Write a command to the ring (and its offsets to the data pool); return its sequence number."""
+        control = self.control
+        count = data = 0
+        if offsets is not None:
+            size = len(offsets)
+            count = size - 1
+            if size > len(self.data):
+                raise ValueError(f"A move of {count} steps does not fit the step worker's buffer "
+                                 f"({len(self.data) - 1} steps).")
+            if control[TAIL] == control[HEAD]:
+                self.data_pos = 0  # Everything sent has been read, and the worker copies what it keeps
+            elif self.data_pos + size > len(self.data):
+                self._wait(lambda: control[TAIL] == control[HEAD])
+                self.data_pos = 0
+            data = self.data_pos
+            self.data[data:data + size] = offsets
+            self.data_pos += size
+        if control[HEAD] - control[TAIL] >= len(self.commands):
+            self._wait(lambda: control[HEAD] - control[TAIL] < len(self.commands))
+        self.seq += 1
+        record = self.commands[self.seq % len(self.commands)]
+        record['kind'], record['axis'], record['pin'] = kind, axis, pin
+        record['count'], record['data'], record['at'] = count, data, at
+        control[HEAD] = self.seq  # Published once the record is complete
+        os.write(self.doorbell, b'.')
+        return self.seq
+
+    def _call(self, kind, token=None, **fields):
+        """Send a command and wait for its reply."""
+        seq = self._send(kind, **fields)
+        self._wait(lambda: self.control[REPLY] >= seq, token=token)
+        return seq
+
+    def _clear_interrupt(self):
+        self.control[INTERRUPT] = 0  # The worker drains the interrupt pipe before it plays
+
+    def start(self, name, motor, offsets, at=None):
+        """
+        Queue a move prepared with motor.prepare_move() to start at time `at`
+        (perf_counter seconds, default now). The motor's finish_move() is called
+        when the move is done.
+        """
+        if name in self.axes:
+            raise RuntimeError(f"Axis '{name}' is already moving.")
+        if name not in self.ids:
+            if len(self.ids) == len(self.status):
+                raise RuntimeError(f"The step worker drives at most {len(self.status)} axes.")
+            self.ids[name] = len(self.ids)
+        start = time.perf_counter() if at is None else at
+        n = len(offsets) - 1
+        self._send(START, axis=self.ids[name], pin=motor.step_pin, at=start, offsets=offsets)
+        self.axes[name] = {'motor': motor, 'id': self.ids[name], 'end': start + float(offsets[n])}
+
+    def busy(self, name=None):
+        """Return True while the named axis (or any axis) is moving."""
+        return name in self.axes if name is not None else bool(self.axes)
+
+    def end_time(self, name):
+        """Planned end of the move running on the named axis (perf_counter seconds)."""
+        return self.axes[name]['end']
+
+    def run_until(self, deadline=None, token=None):
+        """
+        Have the worker play every pulse due before deadline (default: the end of all
+        running moves) and wait until then; see MultiAxis.run_until().
+
+        A pause or cancel of the token interrupts the worker within check_every pulses.
+
+        Returns {name: timing report} of the finished moves.
+        """
+        if deadline is None:
+            deadline = max((axis['end'] for axis in self.axes.values()), default=time.perf_counter())
+        if token is not None and token.interrupted:
+            return {}
+        self._clear_interrupt()
+        return self._collect(self._call(RUN, token=token, at=deadline))
+
+    def _take_results(self, seq):
+        """Copy the chunk in the result pool to the moves finished by command seq."""
+        first, count = int(self.control[CHUNK_START]), int(self.control[CHUNK_LEN])
+        for axis in self.axes.values():
+            status = self.status[axis['id']]
+            if status['finished'] != seq:
+                continue
+            start, total = int(status['result']), int(status['count'])
+            if 'late' not in axis:
+                axis['late'], axis['edges'] = np.empty(total), np.empty(total)
+            lo, hi = max(first, start), min(first + count, start + total)
+            if hi > lo:
+                axis['late'][lo - start:hi - start] = self.late[lo - first:hi - first]
+                axis['edges'][lo - start:hi - start] = self.edges[lo - first:hi - first]
+
+    def _collect(self, seq):
+        """Finish the moves the reply to command seq reports as done; return {name: timing report}."""
+        self._take_results(seq)
+        finished = {}
+        for name, axis in list(self.axes.items()):
+            status = self.status[axis['id']]
+            axis['end'] = float(status['end'])
+            if status['finished'] != seq:
+                continue
+            del self.axes[name]
+            report = {
+                'steps': int(status['steps']),
+                'elapsed': float(status['elapsed']),
+                'planned': float(status['planned']),
+                **lateness_stats(axis['late'], axis['edges']),
+            }
+            if status['cancelled']:
+                report['cancelled'] = True
+            finished[name] = axis['motor'].finish_move(report)
+        return finished
+
+    def resume(self):
+        """Restart the moves interrupted by a pause from where they stopped (see MultiAxis.resume())."""
+        self._clear_interrupt()
+        for axis in self.axes.values():
+            remaining = int(self.status[axis['id']]['remaining'])
+            if remaining:
+                self._send(LOAD, axis=axis['id'], offsets=axis['motor'].remaining_waveform(remaining))
+        self._collect(self._call(RESUME))
+
+    def cancel(self):
+        """
+        Drop every pending pulse and finish the running moves where they stand.
+
+        Returns {name: fraction of the move's steps that were played}.
+        """
+        seq = self._call(CANCEL)
+        done = {name: float(self.status[axis['id']]['fraction']) for name, axis in self.axes.items()
+                if self.status[axis['id']]['finished'] == seq}
+        self._collect(seq)
+        return done
+
+    def move(self, moves):
+        """
+        Move several motors at the same time and wait for all of them.
+
+        Args:
+            moves (dict): name -> (motor, keyword arguments of motor.prepare_move()).
+
+        Returns {name: timing report}.
+        """
+        prepared = {name: motor.prepare_move(**kwargs)[0] for name, (motor, kwargs) in moves.items()}
+        start = time.perf_counter() + 1E-3  # Common start, slightly ahead so the first pulses are not late
+        for name, offsets in prepared.items():
+            self.start(name, moves[name][0], offsets, at=start)
+        return self.run_until()
+
+    def close(self):
+        """Stop the worker and release the shared memory; later calls do nothing."""
+        if self.closed:
+            return  # Descriptors closed twice could belong to someone else by now
+        self.closed = True
+        if self.process.poll() is None:
+            try:
+                self._send(STOP)
+                self.process.wait(timeout=2.0)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+        for fd in (self.doorbell, self.replies, self.interrupt):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        for name in VIEWS:
+            setattr(self, name, None)  # Views must go before the block can be closed
+        self.shm.close()
+        self.shm.unlink()
+
+class _Axis:
+    __slots__ = ('step_pin', 'offsets', 'report')
+
+    def __init__(self, step_pin):
+        """Stand-in for the A4988 of an axis inside the worker's MultiAxis."""
+        self.step_pin = step_pin
+        self.offsets = None  # Remaining pulses of a paused move, sent by the app with a LOAD command
+        self.report = None
+
+    def remaining_waveform(self, steps):
+        return self.offsets
+
+    def finish_move(self, report):
+        self.report = report
+        return report
+
+class _Token:
+    __slots__ = ('control', 'fd')
+
+    def __init__(self, control, fd):
+        """Interrupt flag shared with the app, read by MultiAxis like a CancelToken."""
+        self.control = control
+        self.fd = fd
+
+    @property
+    def interrupted(self):
+        return self.control[INTERRUPT] != 0
+
+    def sleep(self, seconds):
+        """Sleep, but return True as soon as the app writes to the interrupt pipe."""
+        return bool(select.select([self.fd], [], [], seconds)[0])
+
+    def drain(self):
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+def serve(config):
+    """Entry point of the worker process (see ProcessEngine)."""
+    shm = shared_memory.SharedMemory(name=config['shm'])
+    resource_tracker.unregister(shm._name, 'shared_memory')  # Owned (and unlinked) by the app
+    _serve(shm, config)
+    shm.close()  # The views of _serve() are gone with its frame
+
+def _serve(shm, config):
+    views = _views(shm.buf, config['sizes'])
+    control, commands, status = views['control'], views['commands'], views['status']
+    data, late, edges, error = views['data'], views['late'], views['edges'], views['error']
+    doorbell, reply, interrupt = config['fds']
+    os.set_blocking(interrupt, False)
+    token = _Token(control, interrupt)
+
+    cpus, priority = isolate(set(config['cpus'] or ()), config['priority'])
+    GPIO.setwarnings(False)
+    GPIO.setmode(GPIO.BCM)
+    engine = MultiAxis(pulseWidth=config['pulseWidth'], spin_margin=config['spin_margin'],
+                       check_every=config['check_every'])
+    axes = {}  # axis id -> _Axis
+
+    control[CPUS] = sum(1 << cpu for cpu in cpus if cpu < 63)
+    control[PRIORITY] = priority
+    control[PID] = os.getpid()
+    os.write(reply, b'.')
+
+    def publish(seq, done):
+        """Publish the state of the running moves and the results of the finished ones."""
+        for axis_id, axis in engine.axes.items():
+            record = status[axis_id]
+            record['remaining'], record['start'] = axis['remaining'], axis['start']
+            record['end'], record['planned'] = axis['end'], axis['planned']
+        # The lateness and edges of the finished moves form one stream; record['result'] is
+        # where a move starts in it. The stream goes through the pool in chunks: a full
+        # pool is handed over (CHUNK) and refilled once the app has copied it (ACK).
+        total = 0
+        for axis_id, fraction in done.items():
+            report = axes[axis_id].report
+            record = status[axis_id]
+            record['result'], record['count'] = total, len(report['late'])
+            record['steps'], record['remaining'] = report['steps'], 0
+            record['elapsed'], record['planned'] = report['elapsed'], report['planned']
+            record['cancelled'], record['fraction'] = bool(report.get('cancelled')), fraction
+            record['finished'] = seq
+            total += len(report['late'])
+        chunk_start = used = 0
+        for axis_id in done:
+            report = axes[axis_id].report
+            copied = 0
+            while copied < len(report['late']):
+                if used == len(late):
+                    control[CHUNK_START], control[CHUNK_LEN] = chunk_start, used
+                    control[CHUNK] += 1
+                    os.write(reply, b'.')
+                    while control[ACK] != control[CHUNK]:
+                        if not os.read(doorbell, 4096):
+                            raise SystemExit("The app is gone.")
+                    chunk_start += used
+                    used = 0
+                count = min(len(report['late']) - copied, len(late) - used)
+                late[used:used + count] = report['late'][copied:copied + count]
+                edges[used:used + count] = report['edges'][copied:copied + count]
+                used += count
+                copied += count
+        control[CHUNK_START], control[CHUNK_LEN] = chunk_start, used  # The last chunk goes with the reply
+
+    while True:
+        if not os.read(doorbell, 4096):
+            break  # The app is gone
+        while control[TAIL] < control[HEAD]:
+            seq = int(control[TAIL]) + 1
+            command = commands[seq % len(commands)]
+            kind, axis_id = int(command['kind']), int(command['axis'])
+            offsets = data[command['data']:command['data'] + command['count'] + 1]
+            try:
+                if kind == STOP:
+                    control[TAIL] = seq
+                    return
+                if kind == START:
+                    if axis_id not in axes:
+                        axes[axis_id] = _Axis(int(command['pin']))
+                        GPIO.setup(axes[axis_id].step_pin, GPIO.OUT, initial=GPIO.LOW)
+                    at = float(command['at'])
+                    engine.start(axis_id, axes[axis_id], offsets, at=at)
+                    record = status[axis_id]
+                    record['steps'] = record['remaining'] = command['count']
+                    record['start'], record['end'] = at, at + float(offsets[-1])
+                    record['planned'], record['finished'] = float(offsets[-1]), 0
+                elif kind == LOAD:
+                    axes[axis_id].offsets = offsets.copy()  # The slot is reused once this command is read
+                elif kind == RUN:
+                    token.drain()
+                    finished = engine.run_until(float(command['at']), token=token)
+                    publish(seq, dict.fromkeys(finished, 1.0))
+                elif kind == RESUME:
+                    engine.resume()
+                    publish(seq, {})
+                elif kind == CANCEL:
+                    publish(seq, engine.cancel())
+            except Exception as e:
+                message = f"{type(e).__name__}: {e}".encode()[:ERROR_SIZE - 1]
+                error[:] = 0
+                error[:len(message)] = np.frombuffer(message, dtype=np.uint8)
+                control[ERROR] = seq
+            control[TAIL] = seq
+            if kind in (RUN, RESUME, CANCEL):
+                control[REPLY] = seq
+                os.write(reply, b'.')
+
+if __name__ == '__main__':
+    serve(json.loads(sys.argv[1]))
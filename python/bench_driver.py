@@ -0,0 +1,135 @@
+"""
+Step timing benchmarks for the driver stack, run against the simulated GPIO module.
+
+    python python/bench_driver.py [--revolutions 0.5] [--speed 1] [--json out.json]
+                                  [--max-drift 0.02] [--max-p99-jitter-us 500]
+
+Reports achieved steps/s, step-interval jitter percentiles and drift from the
+requested rps for every step mode, then times Pump.move_volume and
+app.execute_program. With --max-drift / --max-p99-jitter-us the exit status is 1
+when any step mode is outside the limits, so it can gate CI.
+
+The benchmark leaves the app's state alone: the stepper keeps its calibration and
+step counter in memory, and the app is run in a temporary working directory holding
+a copy of the configuration.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+os.environ['NMRPI_GPIO'] = 'sim'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from drivers import sim_gpio
+from drivers.calibration import CalibrationStore
+from drivers.position import PositionStore
+from drivers.stepper import A4988
+from drivers.pump_v0 import Pump
+from services.logging_config import configure_logging
+
+CONFIG_FILE = 'config/pin_map.json'
+
+def edge_stats(step_pin, requested_rps, spr):
+    """Timing statistics of the STEP rising edges recorded since the last reset."""
+    edges = sim_gpio.edges(step_pin)
+    intervals = np.diff(edges)
+    planned = 1 / (requested_rps * spr)
+    jitter = np.abs(intervals - planned) * 1E6
+    achieved_sps = len(intervals) / (edges[-1] - edges[0])
+    return {
+        'steps': len(edges),
+        'requested_sps': requested_rps * spr,
+        'achieved_sps': achieved_sps,
+        'drift': achieved_sps / (requested_rps * spr) - 1,
+        'jitter_p50_us': float(np.percentile(jitter, 50)),
+        'jitter_p90_us': float(np.percentile(jitter, 90)),
+        'jitter_p99_us': float(np.percentile(jitter, 99)),
+        'jitter_max_us': float(jitter.max()),
+    }
+
+def bench_step_modes(stepper, revolutions, speed):
+    """Run A4988.move once per step mode at a constant speed."""
+    results = {}
+    step_pin = stepper.pins['STEP']['number']
+    for mode, config in stepper.microstep.MSmap.items():
+        spr = config['factor'] * stepper.motor_spr
+        sim_gpio.reset()
+        stepper.move(revolutions=revolutions, stepMode=mode, speed=speed)
+        results[mode] = edge_stats(step_pin, speed, spr)
+    return results
+
+def bench_move_volume(stepper, volume, speed):
+    """Time Pump.move_volume, including its draw/push cycle."""
+    pump = Pump(motor=stepper, syringe_volume=5.0, ml_per_rotation=1.0, step_mode='sixteenth')
+    start = time.perf_counter()
+    pump.move_volume(volume, speed=speed)
+    return {'volume': volume, 'speed': speed, 'wall_time': time.perf_counter() - start}
+
+def bench_execute_program(content):
+    """Time app.execute_program on a short program, run in a scratch copy of the configuration."""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as scratch:
+        shutil.copytree('config', os.path.join(scratch, 'config'),
+                        ignore=shutil.ignore_patterns('calibration.json', 'position.json'))
+        os.chdir(scratch)  # Calibration, positions, logs and programs of the app land here
+        try:
+            import app
+            start = time.perf_counter()
+            app.execute_program(app.compile_for_pump(content))
+            return {'lines': len(content.splitlines()), 'wall_time': time.perf_counter() - start}
+        finally:
+            os.chdir(cwd)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--revolutions', type=float, default=0.5)
+    parser.add_argument('--speed', type=float, default=1.0, help='Requested speed in rps')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--max-drift', type=float, help='Fail if |drift| exceeds this fraction')
+    parser.add_argument('--max-p99-jitter-us', type=float, help='Fail if the p99 jitter exceeds this many us')
+    parser.add_argument('--skip-app', action='store_true', help='Do not benchmark app.execute_program')
+    parser.add_argument('--log-level', default='WARNING', help='Level of the driver log output')
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    stepper = A4988(config_file=CONFIG_FILE, auto_calibrate=True, speed=args.speed, pulseWidth=5E-6,
+                    calibration_store=CalibrationStore(path=None), position_store=PositionStore(path=None))
+
+    results = {'step_modes': bench_step_modes(stepper, args.revolutions, args.speed)}
+    results['move_volume'] = bench_move_volume(stepper, args.revolutions, args.speed)
+    if not args.skip_app:
+        results['execute_program'] = bench_execute_program(f"move {args.revolutions} speed {args.speed}\npause 0.1")
+
+    print(f"\n{'Mode':<10} | {'steps/s':>9} | {'drift':>7} | {'p50 us':>7} | {'p90 us':>7} | {'p99 us':>7} | {'max us':>8}")
+    print("-" * 72)
+    for mode, r in results['step_modes'].items():
+        print(f"{mode:<10} | {r['achieved_sps']:>9.1f} | {r['drift']:>+7.2%} | {r['jitter_p50_us']:>7.1f} | "
+              f"{r['jitter_p90_us']:>7.1f} | {r['jitter_p99_us']:>7.1f} | {r['jitter_max_us']:>8.1f}")
+    print(f"\nPump.move_volume({args.revolutions} mL): {results['move_volume']['wall_time']:.3f} s")
+    if 'execute_program' in results:
+        print(f"execute_program: {results['execute_program']['wall_time']:.3f} s")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=4)
+
+    failed = []
+    for mode, r in results['step_modes'].items():
+        if args.max_drift is not None and abs(r['drift']) > args.max_drift:
+            failed.append(f"{mode}: drift {r['drift']:+.2%}")
+        if args.max_p99_jitter_us is not None and r['jitter_p99_us'] > args.max_p99_jitter_us:
+            failed.append(f"{mode}: p99 jitter {r['jitter_p99_us']:.1f} us")
+    if failed:
+        print("\nRegression limits exceeded:\n- " + "\n- ".join(failed))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
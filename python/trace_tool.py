@@ -0,0 +1,78 @@
+"""
+Inspect the motion traces written by drivers.trace.TraceRecorder.
+
+    python python/trace_tool.py info traces/*.trace
+    python python/trace_tool.py analyze TRACE [--deadline-us 100] [--nfft 4096] [--json]
+    python python/trace_tool.py compare TRACE_A TRACE_B [--deadline-us 100] [--json]
+
+Traces are memory-mapped and analyzed in chunks, so multi-million-step traces do
+not need to fit in RAM. Record traces from the app by setting NMRPI_TRACE_DIR.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from drivers.trace import Trace, analyze, compare
+
+def print_info(paths):
+    print(f"{'File':<40} | {'Run':<22} | {'Channel':<8} | {'Mode':<9} | {'rps':>6} | {'Steps':>9} | {'Recorded'}")
+    print("-" * 120)
+    for path in paths:
+        h = Trace(path).header
+        recorded = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(h['started']))
+        print(f"{os.path.basename(path):<40} | {h['run_id']:<22} | {h['channel']:<8} | {h['step_mode']:<9} | "
+              f"{h['requested_rps']:>6.3f} | {h['steps']:>9} | {recorded}")
+
+def print_analysis(result):
+    print(f"{result['run_id']} {result['channel']}: {result['steps']} steps in {result['duration']:.3f} s "
+          f"({result['step_mode']}, {result['requested_rps']:.3f} rps requested, {result['mean_sps']:.1f} steps/s)")
+    v = result['velocity_rps']
+    print(f"  velocity (rps)  mean {v['mean']:.4f}  min {v['min']:.4f}  max {v['max']:.4f}")
+    j = result['jitter_us']
+    print(f"  jitter (us)     mean {j['mean']:.1f}  p50 {j['p50']:.1f}  p99 {j['p99']:.1f}  max {j['max']:.1f}")
+    print(f"  max lateness {result['max_late_us']:.1f} us; {result['missed_deadlines']} steps later than "
+          f"{result['deadline_us']:.0f} us")
+    for peak in result['spectrum_peaks']:
+        print(f"  jitter peak {peak['hz']:>10.2f} Hz  {peak['amplitude_us']:.2f} us")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    info = commands.add_parser('info', help="Header of each trace.")
+    info.add_argument('paths', nargs='+')
+    for name, count in (('analyze', 1), ('compare', 2)):
+        command = commands.add_parser(name, help=f"{name.capitalize()} trace{'s' if count > 1 else ''}.")
+        command.add_argument('paths', nargs=count)
+        command.add_argument('--deadline-us', type=float, default=100.0, help="Lateness counted as a missed deadline.")
+        command.add_argument('--nfft', type=int, default=4096, help="Steps per segment of the jitter spectrum.")
+        command.add_argument('--json', action='store_true', help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        print_info(args.paths)
+        return
+    options = {'deadline': args.deadline_us * 1E-6, 'nfft': args.nfft}
+    if args.command == 'analyze':
+        result = analyze(Trace(args.paths[0]), **options)
+        if args.json:
+            print(json.dumps(result, indent=2))
+        else:
+            print_analysis(result)
+        return
+
+    first, second, delta = compare(Trace(args.paths[0]), Trace(args.paths[1]), **options)
+    if args.json:
+        print(json.dumps({'a': first, 'b': second, 'delta': delta}, indent=2))
+        return
+    print_analysis(first)
+    print_analysis(second)
+    print("\nDifference (b - a):")
+    for metric, value in delta.items():
+        print(f"  {metric:<20} {value:+.4f}")
+
+if __name__ == '__main__':
+    main()
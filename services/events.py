@@ -0,0 +1,64 @@
+import itertools
+import json
+import threading
+import time
+from collections import deque
+
+class Subscription:
+    def __init__(self, bus, queue_size):
+        """A subscriber's bounded queue; when full, the oldest events are dropped."""
+        self.bus = bus
+        self.queue = deque(maxlen=queue_size)
+        self.dropped = 0
+
+    def get(self, timeout=None):
+        """Wait until at least one event is queued (or timeout) and return all queued events."""
+        with self.bus.condition:
+            if not self.queue:
+                self.bus.condition.wait_for(lambda: self.queue, timeout=timeout)
+            events = list(self.queue)
+            self.queue.clear()
+        return events
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+class EventBus:
+    def __init__(self, queue_size=256):
+        """
+        Publish/subscribe bus waking subscribers as soon as an event is published.
+
+        Args:
+            queue_size (int): Capacity of each subscriber's queue.
+        """
+        self.queue_size = queue_size
+        self.condition = threading.Condition()
+        self.subscribers = set()
+        self.sequence = itertools.count(1)
+
+    def subscribe(self):
+        with self.condition:
+            subscription = Subscription(self, self.queue_size)
+            self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.condition:
+            self.subscribers.discard(subscription)
+
+    def publish(self, kind, message=None, **data):
+        """Publish an event of the given kind ('log', 'state', 'progress', 'volume', ...)."""
+        event = {'seq': next(self.sequence), 'kind': kind, 'time': time.time(), 'message': message, **data}
+        with self.condition:
+            for subscription in self.subscribers:
+                if len(subscription.queue) == subscription.queue.maxlen:
+                    subscription.dropped += 1
+                subscription.queue.append(event)
+            self.condition.notify_all()
+        return event
+
+def format_sse(event):
+    """Format an event as a server-sent event; log messages use the default event type."""
+    if event['kind'] == 'log':
+        return f"data: {event['message']}\n\n"
+    return f"event: {event['kind']}\ndata: {json.dumps(event)}\n\n"
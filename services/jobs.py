@@ -0,0 +1,159 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from drivers.runtime import CancelToken
+
+class Job:
+    def __init__(self, plan, name=None, source=None, estimated_duration=None):
+        """
+        One queued program run.
+
+        Args:
+            plan (Plan): Compiled program (drivers.program.compile_program).
+            name (str): Optional label shown in the job list.
+            source (str): Program text, so the runner can compile it again if the settings
+                changed while the job was queued.
+            estimated_duration (float): Run time in s from the refill schedule
+                (drivers.scheduler.schedule_plan); the runner updates it when the job starts.
+        """
+        self.id = uuid.uuid4().hex[:12]
+        self.plan = plan
+        self.name = name
+        self.source = source
+        self.estimated_duration = estimated_duration
+        self.status = 'queued'  # queued -> running -> completed | cancelled | failed
+        self.error = None
+        self.progress = {'instruction': 0, 'total': len(plan.instructions), 'line': None, 'command': None}
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.token = CancelToken()  # Pauses and cancels the run within a few steps
+
+    @property
+    def paused(self):
+        return self.token.paused
+
+    def pause(self):
+        self.token.pause()
+
+    def resume(self):
+        self.token.resume()
+
+    def cancel(self):
+        self.token.cancel()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'paused': self.paused,
+            'error': self.error,
+            'progress': dict(self.progress),
+            'total_volume': self.plan.total_volume,
+            'estimated_duration': self.estimated_duration,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+class JobManager:
+    def __init__(self, runner, bus=None, history=100):
+        """
+        FIFO run queue served by a single worker thread.
+
+        Only the worker touches the hardware, so two submissions can never drive the
+        same motor at once; queued jobs start back to back as soon as the previous one
+        ends.
+
+        Args:
+            runner (callable): runner(plan, job) executes a job; it should return when the job's
+                token is cancelled (drivers.runtime.Cancelled is treated as a cancel).
+            bus (EventBus): Optional bus on which job status changes are published as 'job' events.
+            history (int): Number of finished jobs kept for the status endpoints.
+        """
+        self.runner = runner
+        self.bus = bus
+        self.history = history
+        self.condition = threading.Condition()
+        self.queue = deque()
+        self.jobs = OrderedDict()  # id -> Job, in submission order
+        self.current = None
+        self.worker = threading.Thread(target=self._work, name='job-worker', daemon=True)
+        self.worker.start()
+
+    def submit(self, plan, name=None, source=None, estimated_duration=None):
+        """Queue a compiled plan (and optionally its program text and run time estimate) and return its Job."""
+        job = Job(plan, name, source, estimated_duration)
+        with self.condition:
+            self.jobs[job.id] = job
+            self.queue.append(job)
+            self._trim()
+            self.condition.notify()
+        self._publish(job)
+        return job
+
+    def get(self, job_id):
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.condition:
+            return list(self.jobs.values())
+
+    def position(self, job):
+        """0 for the running job, n for the n-th job in the queue, None if it is finished."""
+        with self.condition:
+            if job is self.current:
+                return 0
+            return self.queue.index(job) + 1 if job in self.queue else None
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job; return it, or None if unknown."""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job in self.queue:
+                self.queue.remove(job)
+                job.status = 'cancelled'
+                job.finished = time.time()
+            elif job.status == 'running':
+                job.cancel()
+        self._publish(job)
+        return job
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                job = self.queue.popleft()
+                self.current = job
+                job.status = 'running'
+                job.started = time.time()
+            self._publish(job)
+            try:
+                self.runner(job.plan, job)
+                status = 'cancelled' if job.token.cancelled else 'completed'
+            except Exception as e:
+                status = 'cancelled' if job.token.cancelled else 'failed'
+                job.error = None if job.token.cancelled else str(e)
+            with self.condition:
+                job.status = status
+                job.finished = time.time()
+                self.current = None
+            self._publish(job)
+
+    def _trim(self):
+        """Forget the oldest finished jobs beyond the history size."""
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished is not None]
+        for job_id in finished[:max(len(finished) - self.history, 0)]:
+            del self.jobs[job_id]
+
+    def _publish(self, job):
+        if self.bus is not None:
+            with self.condition:
+                queued = len(self.queue)
+            self.bus.publish('job', job_id=job.id, status=job.status, paused=job.paused, queued=queued)
@@ -0,0 +1,78 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+LOG_LEVELS_ENV = 'NMRPI_LOG_LEVELS'  # e.g. "INFO,drivers.stepper=DEBUG,drivers.utils=WARNING"
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+_listener = None
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread (the queue never leaves the process)."""
+
+    def prepare(self, record):
+        return record
+
+def parse_levels(spec):
+    """Parse "LEVEL,logger=LEVEL,..." into (root level or None, {logger name: level})."""
+    root, levels = None, {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, level = item.rpartition('=')
+        if name:
+            levels[name.strip()] = level.strip().upper()
+        else:
+            root = level.strip().upper()
+    return root, levels
+
+def configure_logging(level='INFO', levels=None, handler=None, force=False):
+    """
+    Route every log record through an in-memory queue drained by a background thread.
+
+    Logging calls on the step and move paths only put the record on the queue; the
+    QueueListener thread formats and writes it, so a slow stdout or journald never
+    delays a move. Once configured, later calls do nothing unless force is True.
+
+    Args:
+        level (str): Level of the root logger.
+        levels (dict): Per-logger levels, e.g. {'drivers.stepper': 'DEBUG'}. Levels in the
+            NMRPI_LOG_LEVELS environment variable override both arguments.
+        handler (logging.Handler): Where records end up (default: stderr).
+        force (bool): Replace an existing configuration.
+
+    Returns the QueueListener.
+    """
+    global _listener
+    if _listener is not None and not force:
+        return _listener
+    env_root, env_levels = parse_levels(os.environ.get(LOG_LEVELS_ENV, ''))
+    levels = {**(levels or {}), **env_levels}
+
+    if handler is None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    records = queue.SimpleQueue()
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(DeferredQueueHandler(records))
+    root.setLevel(env_root or level)
+    for name, logger_level in levels.items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    _listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+@atexit.register
+def _flush():
+    """Write out the records still queued when the process exits."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
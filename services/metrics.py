@@ -0,0 +1,130 @@
+import math
+import threading
+import numpy as np
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'  # Prometheus text exposition format
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        """
+        Monotonic counter, one value per combination of label values.
+
+        Args:
+            name (str): Metric name, ending in _total by convention.
+            help (str): Description shown in the exposition.
+            labelnames (tuple): Names of the labels, given as keywords to inc().
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # label values -> count
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1.0, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            items = sorted(self.values.items())
+        lines += [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in items]
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, buckets, labelnames=()):
+        """
+        Histogram with fixed bucket bounds and a pre-allocated count array per series.
+
+        observe_many() bins a whole array of values with one searchsorted/bincount, so
+        the step loops only keep their per-pulse values and hand them over once the
+        pulses have been played.
+
+        Args:
+            name (str): Metric name.
+            help (str): Description shown in the exposition.
+            buckets (iterable): Increasing upper bounds; a +Inf bucket is added.
+            labelnames (tuple): Names of the labels, given as keywords to observe().
+        """
+        self.name = name
+        self.help = help
+        self.bounds = np.asarray(sorted(buckets), dtype=np.float64)
+        self.labelnames = tuple(labelnames)
+        self.series = {}  # label values -> [bucket counts (len(bounds) + 1), sum]
+        self.lock = threading.Lock()
+
+    def _series(self, labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [np.zeros(len(self.bounds) + 1, dtype=np.int64), 0.0]
+        return series
+
+    def observe(self, value, **labels):
+        index = int(np.searchsorted(self.bounds, value))  # First bound >= value (Prometheus 'le')
+        with self.lock:
+            series = self._series(labels)
+            series[0][index] += 1
+            series[1] += value
+
+    def observe_many(self, values, **labels):
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return
+        counts = np.bincount(np.searchsorted(self.bounds, values), minlength=len(self.bounds) + 1)
+        total = float(values.sum())
+        with self.lock:
+            series = self._series(labels)
+            series[0] += counts
+            series[1] += total
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = sorted((key, counts.copy(), total) for key, (counts, total) in self.series.items())
+        bounds = [_number(bound) for bound in self.bounds] + ['+Inf']
+        for key, counts, total in items:
+            cumulative = np.cumsum(counts)
+            for bound, count in zip(bounds, cumulative.tolist()):
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', bound)])} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {int(cumulative[-1])}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        """Set of metrics exported together by render()."""
+        self.metrics = []
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, buckets, labelnames=()):
+        return self._register(Histogram(name, help, buckets, labelnames))
+
+    def _register(self, metric):
+        if any(existing.name == metric.name for existing in self.metrics):
+            raise ValueError(f"Metric '{metric.name}' is already registered.")
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines += metric.collect()
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+PROGRAMS_DIR = 'programs'
+VERSIONS_DIR = '.versions'  # Inside the programs directory: one subdirectory of old versions per program
+NAME_PATTERN = re.compile(r'^[\w\s-]+$')  # Program and version names: no path separators or dots
+
+class ProgramLibrary:
+    def __init__(self, directory=PROGRAMS_DIR, max_versions=20, rescan_interval=2.0):
+        """
+        In-memory index of the saved programs (one JSON file per program).
+
+        Listing, searching and loading are answered from the index. A file is read again
+        only when its mtime or size changed, and the directory is rescanned for new or
+        deleted files at most every `rescan_interval` s (load() always checks its own file).
+        Saves write a temporary file and rename it over the program, after copying the
+        previous version to .versions/<name>/.
+
+        Args:
+            directory (str): Directory of the program files.
+            max_versions (int): Number of previous versions kept per program.
+            rescan_interval (float): Minimum time in s between two directory scans.
+        """
+        self.directory = directory
+        self.max_versions = max_versions
+        self.rescan_interval = rescan_interval
+        self.lock = threading.RLock()
+        self.entries = {}  # name -> index entry
+        self.scanned = None  # time.monotonic() of the last directory scan
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def _check_name(name):
+        if not NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid program name '{name}'.")
+        return name
+
+    def _path(self, name):
+        return os.path.join(self.directory, f"{self._check_name(name)}.json")
+
+    def _version_dir(self, name):
+        return os.path.join(self.directory, VERSIONS_DIR, self._check_name(name))
+
+    def _read(self, name, stat):
+        """Index entry of a program file, or None if it cannot be read."""
+        try:
+            with open(self._path(name), 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            content = data['content']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return {
+            'name': name,
+            'title': data.get('name', name),
+            'content': content,
+            'content_hash': hashlib.sha256(content.encode('utf-8')).hexdigest(),
+            'lines': len(content.splitlines()),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'stamp': (stat.st_mtime_ns, stat.st_size),
+        }
+
+    def _update(self, name, stat):
+        """Bring the entry of name up to date with its file's stat; return the entry or None."""
+        entry = self.entries.get(name)
+        if entry is None or entry['stamp'] != (stat.st_mtime_ns, stat.st_size):
+            entry = self._read(name, stat)
+            if entry is None:
+                self.entries.pop(name, None)
+            else:
+                self.entries[name] = entry
+        return entry
+
+    def refresh(self, force=False):
+        """Rescan the directory (unless scanned less than rescan_interval s ago) and re-read changed files."""
+        with self.lock:
+            now = time.monotonic()
+            if not force and self.scanned is not None and now - self.scanned < self.rescan_interval:
+                return
+            self.scanned = now
+            seen = set()
+            with os.scandir(self.directory) as files:
+                for file in files:
+                    if file.name.endswith('.json') and file.is_file():
+                        name = file.name[:-len('.json')]
+                        if self._update(name, file.stat()) is not None:
+                            seen.add(name)
+            for name in set(self.entries) - seen:
+                del self.entries[name]
+
+    def names(self):
+        """Sorted names of the programs."""
+        self.refresh()
+        with self.lock:
+            return sorted(self.entries)
+
+    def list(self):
+        """Metadata of every program (everything but the content), sorted by name."""
+        self.refresh()
+        with self.lock:
+            return [self._metadata(self.entries[name]) for name in sorted(self.entries)]
+
+    def search(self, query, content=True):
+        """Metadata of the programs whose name, title or (if content is True) text contains query, ignoring case."""
+        query = query.lower()
+        self.refresh()
+        with self.lock:
+            return [self._metadata(entry) for name, entry in sorted(self.entries.items())
+                    if query in name.lower() or query in entry['title'].lower()
+                    or (content and query in entry['content'].lower())]
+
+    def load(self, name):
+        """Return the index entry of a program (with its content), or None if there is no such program."""
+        with self.lock:
+            try:
+                stat = os.stat(self._path(name))
+            except (OSError, ValueError):
+                self.entries.pop(name, None)
+                return None
+            entry = self._update(name, stat)
+            return dict(entry) if entry is not None else None
+
+    def save(self, name, content, title=None):
+        """
+        Save a program atomically, keeping its previous version; return its new index entry.
+
+        Args:
+            name (str): File name of the program (without .json), already sanitized.
+            content (str): Program text.
+            title (str): Name shown for the program (default: name).
+        """
+        path = self._path(name)
+        with self.lock:
+            if os.path.exists(path):
+                self._keep_version(name)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                    json.dump({'name': title or name, 'content': content}, file, ensure_ascii=False, indent=4)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            return self.load(name)
+
+    def _keep_version(self, name):
+        directory = self._version_dir(name)
+        os.makedirs(directory, exist_ok=True)
+        version = f"{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 10**9:09d}"  # Sorts by save time
+        shutil.copy2(self._path(name), os.path.join(directory, f"{version}.json"))
+        old = sorted(os.listdir(directory))
+        for version in old[:max(len(old) - self.max_versions, 0)]:
+            os.unlink(os.path.join(directory, version))
+
+    def versions(self, name):
+        """Previous versions of a program, oldest first: [{'version', 'saved', 'size'}]."""
+        directory = self._version_dir(name)
+        try:
+            files = sorted(os.listdir(directory))
+        except FileNotFoundError:
+            return []
+        result = []
+        for version in files:
+            stat = os.stat(os.path.join(directory, version))
+            result.append({'version': version[:-len('.json')], 'saved': stat.st_mtime, 'size': stat.st_size})
+        return result
+
+    def load_version(self, name, version):
+        """Content of a previous version of a program, or None."""
+        if not NAME_PATTERN.match(version):
+            return None
+        path = os.path.join(self._version_dir(name), f"{version}.json")
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                return json.load(file)['content']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def _metadata(entry):
+        return {key: value for key, value in entry.items() if key not in ('content', 'stamp')}
@@ -0,0 +1,161 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+LOG_DIR = 'logs'
+
+class RunLog:
+    def __init__(self, bus=None, capacity=1000, directory=LOG_DIR, segment_size=1_000_000, max_segments=100):
+        """
+        Fixed-capacity log of structured records backed by rotated segment files.
+
+        The newest `capacity` records are kept in memory; every record is also appended
+        to the current segment file (JSON lines) in `directory`. Segments are rotated at
+        `segment_size` bytes and listed in index.json with their sequence, time and run
+        ID ranges, so older records can be queried from disk.
+
+        Args:
+            bus (EventBus): Optional bus on which every record is published as a 'log' event.
+            capacity (int): Number of records kept in memory.
+            directory (str): Directory of the segment files and their index.
+            segment_size (int): Size in bytes at which a segment is closed.
+            max_segments (int): Number of segments kept on disk; older ones are deleted.
+        """
+        self.bus = bus
+        self.records = deque(maxlen=capacity)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.lock = bus.condition if bus is not None else threading.RLock()
+        self.run_id = None
+
+        os.makedirs(directory, exist_ok=True)
+        self.index_file = os.path.join(directory, 'index.json')
+        try:
+            with open(self.index_file, 'r') as file:
+                self.index = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.index = []
+        self.segment = None  # Index entry of the open segment
+        self.file = None
+        self.seq = self._recover()
+
+    def _recover(self):
+        """Bring the last index entry up to date with its segment file; return the last sequence number."""
+        if not self.index:
+            return 0
+        entry = self.index[-1]
+        try:
+            with open(os.path.join(self.directory, entry['file']), 'r') as file:
+                for line in file:
+                    record = json.loads(line)
+                    entry['last_seq'] = record['seq']
+                    entry['end_time'] = record['time']
+                    if record['run_id'] is not None and record['run_id'] not in entry['run_ids']:
+                        entry['run_ids'].append(record['run_id'])
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        return entry['last_seq']
+
+    def __iter__(self):
+        return iter(list(self.records))
+
+    def __len__(self):
+        return len(self.records)
+
+    def start_run(self):
+        """Start a new run; the following records carry its run ID. Returns the ID."""
+        with self.lock:
+            self.run_id = time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:6]
+        return self.run_id
+
+    def end_run(self):
+        with self.lock:
+            self.run_id = None
+
+    def append(self, message, **fields):
+        """Append a record and return it."""
+        with self.lock:
+            self.seq += 1
+            record = {'seq': self.seq, 'time': time.time(), 'run_id': self.run_id, 'message': message, **fields}
+            self.records.append(record)
+            self._write(record)
+            if self.bus is not None:
+                self.bus.publish('log', **record)
+        return record
+
+    def since(self, cursor=0):
+        """Return the records in memory with a sequence number above cursor."""
+        with self.lock:
+            return [record for record in self.records if record['seq'] > cursor]
+
+    def query(self, start=None, end=None, run_id=None):
+        """Return all records, from disk, within [start, end] (epoch seconds) and/or of a run."""
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+            segments = [dict(entry) for entry in self.index]
+        results = []
+        for entry in segments:
+            if start is not None and entry['end_time'] < start:
+                continue
+            if end is not None and entry['start_time'] > end:
+                continue
+            if run_id is not None and run_id not in entry['run_ids']:
+                continue
+            with open(os.path.join(self.directory, entry['file']), 'r') as file:
+                for line in file:
+                    record = json.loads(line)
+                    if start is not None and record['time'] < start:
+                        continue
+                    if end is not None and record['time'] > end:
+                        continue
+                    if run_id is not None and record['run_id'] != run_id:
+                        continue
+                    results.append(record)
+        return results
+
+    def _write(self, record):
+        if self.file is None or self.file.tell() >= self.segment_size:
+            self._rotate(record)
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        entry = self.segment
+        entry['last_seq'] = record['seq']
+        entry['end_time'] = record['time']
+        if record['run_id'] is not None and record['run_id'] not in entry['run_ids']:
+            entry['run_ids'].append(record['run_id'])
+            self._save_index()
+
+    def _rotate(self, record):
+        """Close the current segment and open a new one starting at record."""
+        if self.file is not None:
+            self.file.close()
+        name = f"segment-{record['seq']:010d}.jsonl"
+        self.segment = {'file': name, 'first_seq': record['seq'], 'last_seq': record['seq'],
+                        'start_time': record['time'], 'end_time': record['time'], 'run_ids': []}
+        self.index.append(self.segment)
+        while len(self.index) > self.max_segments:
+            old = self.index.pop(0)
+            try:
+                os.remove(os.path.join(self.directory, old['file']))
+            except FileNotFoundError:
+                pass
+        self.file = open(os.path.join(self.directory, name), 'a')
+        self._save_index()
+
+    def _save_index(self):
+        tmp_path = self.index_file + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.index, file)
+        os.replace(tmp_path, self.index_file)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self._save_index()
+                self.file.close()
+                self.file = None
@@ -0,0 +1,24 @@
+import os
+
+# The drivers run on the simulated GPIO module off the Pi
+os.environ.setdefault('NMRPI_GPIO', 'sim')
+
+import pytest
+
+from drivers import sim_gpio
+from drivers.backends import SimulatedBackend
+from drivers.calibration import CalibrationStore
+from drivers.position import PositionStore
+from drivers.stepper import A4988
+
+PIN_MAP_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config', 'pin_map.json')
+
+
+@pytest.fixture
+def stepper():
+    """An A4988 on the simulated GPIO whose moves take exactly their planned time, with nothing persisted."""
+    motor = A4988(PIN_MAP_FILE, backend=SimulatedBackend(realtime=False), gpio=sim_gpio,
+                  calibration_store=CalibrationStore(path=None), position_store=PositionStore(path=None))
+    motor.sleep_overhead = 1E-5
+    yield motor
+    motor.cleanup()
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from drivers.feedback import TimingController, steady_elapsed
+from drivers.utils import lateness_stats
+
+STALL = 0.2  # s
+
+
+def report_of(offsets, late):
+    """Timing report of a pulse train whose pulses were late by late (s, one value per pulse)."""
+    n = len(offsets) - 1
+    planned = float(offsets[n])
+    return {'steps': n, 'elapsed': planned + float(late[-1]), 'planned': planned,
+            **lateness_stats(late, np.asarray(offsets[:n]) + late)}
+
+
+def test_one_stall_does_not_speed_up_the_next_moves(stepper):
+    stepper.feedback = TimingController()
+    offsets, _ = stepper.prepare_move(steps=400, speed=1)
+    late = np.zeros(400)
+    late[100:] = STALL  # Held up once, then on time again
+    stepper.finish_move(report_of(offsets, late))
+
+    assert stepper.feedback.scale('full', 1) == pytest.approx(1.0)
+    offsets_after, _ = stepper.prepare_move(steps=400, speed=1)
+    assert offsets_after[-1] == pytest.approx(offsets[-1])
+    stepper.finish_move(report_of(offsets_after, np.zeros(400)))
+
+
+def test_steadily_slow_steps_are_corrected_within_the_clamp(stepper):
+    stepper.feedback = TimingController()
+    for _ in range(20):
+        offsets, _ = stepper.prepare_move(steps=400, speed=1)
+        intervals = np.diff(offsets[:-1]) * 0.5  # Every step takes 1.5 times its interval
+        late = np.concatenate([[0.0], np.cumsum(intervals)])
+        stepper.finish_move(report_of(offsets, late))
+
+    assert stepper.feedback.scale('full', 1) == pytest.approx(stepper.feedback.min_scale)
+
+
+def test_steady_elapsed_without_edges_is_the_measured_time():
+    assert steady_elapsed({'elapsed': 2.0, 'planned': 1.0}) == 2.0
@@ -0,0 +1,61 @@
+import time
+
+import numpy as np
+
+from drivers import sim_gpio
+from drivers.multiaxis import MultiAxis
+from drivers.utils import build_waveform, CATCH_UP
+
+PERIOD = 2E-3
+
+
+class Motor:
+    """The part of an A4988 the engine uses."""
+
+    def __init__(self, step_pin):
+        self.step_pin = step_pin
+
+    def finish_move(self, report):
+        return report
+
+
+class StallingGPIO:
+    """Simulated GPIO whose output blocks once, on the given rising edge."""
+    HIGH, LOW = sim_gpio.HIGH, sim_gpio.LOW
+
+    def __init__(self, pulse, duration):
+        self.pulse = pulse
+        self.duration = duration
+        self.rising = 0
+
+    def output(self, pin, level):
+        if level == self.HIGH:
+            if self.rising == self.pulse:
+                time.sleep(self.duration)
+            self.rising += 1
+
+
+def test_axes_step_at_their_own_rates():
+    engine = MultiAxis(gpio=StallingGPIO(pulse=-1, duration=0))
+    start = time.perf_counter() + 1E-3
+    engine.start('a', Motor(1), build_waveform(40, PERIOD), at=start)
+    engine.start('b', Motor(2), build_waveform(20, 2 * PERIOD), at=start)
+    reports = engine.run_until()
+
+    assert set(reports) == {'a', 'b'}
+    assert abs(np.median(np.diff(reports['a']['edges'])) - PERIOD) < 0.25 * PERIOD
+    assert abs(np.median(np.diff(reports['b']['edges'])) - 2 * PERIOD) < 0.5 * PERIOD
+
+
+def test_stalled_axes_catch_up_without_a_burst():
+    engine = MultiAxis(gpio=StallingGPIO(pulse=10, duration=20 * PERIOD))
+    start = time.perf_counter() + 1E-3
+    engine.start('a', Motor(1), build_waveform(60, PERIOD), at=start)
+    engine.start('b', Motor(2), build_waveform(30, 2 * PERIOD), at=start)
+    reports = engine.run_until()
+
+    for name, period in (('a', PERIOD), ('b', 2 * PERIOD)):
+        report = reports[name]
+        assert report['max_late'] > 10 * PERIOD  # Both axes were held up by the stall
+        # Before, each axis fired the pulses it had missed back to back
+        assert np.diff(report['edges']).min() > (1 - CATCH_UP) * period * 0.9
@@ -0,0 +1,42 @@
+import threading
+
+from drivers.position import PositionStore
+
+
+def test_stores_of_one_file_keep_each_others_channels(tmp_path):
+    path = str(tmp_path / 'position.json')
+    first, second = PositionStore(path), PositionStore(path)
+    assert first.get('pump1') is None and second.get('pump2') is None  # Both loaded before either saves
+
+    first.save('pump1', {'position': 100})
+    second.save('pump2', {'position': 200})
+
+    reloaded = PositionStore(path)
+    assert reloaded.get('pump1') == {'position': 100}
+    assert reloaded.get('pump2') == {'position': 200}
+
+
+def test_shared_store_keeps_every_channel_saved_from_threads(tmp_path):
+    path = str(tmp_path / 'position.json')
+    store = PositionStore(path)
+    channels = [f'pump{i}' for i in range(8)]
+
+    def save(channel):
+        for position in range(20):
+            store.save(channel, {'position': position})
+
+    threads = [threading.Thread(target=save, args=(channel,)) for channel in channels]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    reloaded = PositionStore(path)
+    assert all(reloaded.get(channel) == {'position': 19} for channel in channels)
+
+
+def test_store_without_path_stays_in_memory(tmp_path):
+    store = PositionStore(path=None)
+    store.save('pump1', {'position': 5})
+    assert store.get('pump1') == {'position': 5}
+    assert not list(tmp_path.iterdir())
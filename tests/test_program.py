@@ -0,0 +1,28 @@
+import time
+
+import pytest
+
+from drivers.program import compile_program, ProgramError
+
+SETTINGS = {'syringe_volume': 5.0, 'default_speed': 1.0}
+
+
+def test_repeat_is_unrolled():
+    plan = compile_program("repeat 3\nmove 0.5\npause 1\nend repeat", **SETTINGS)
+    assert [i.action for i in plan.instructions] == ["MOVE", "PAUSE"] * 3
+    assert plan.total_volume == pytest.approx(1.5)
+
+
+def test_huge_repeat_count_is_rejected_before_unrolling():
+    started = time.perf_counter()
+    with pytest.raises(ProgramError) as error:
+        compile_program("move 0.5\nrepeat 999999999999\nmove 0.5\nend repeat", **SETTINGS)
+    assert time.perf_counter() - started < 1.0  # Unrolling 10^12 instructions would not return at all
+    assert error.value.errors == [(2, "Program unrolls to more than 100000 instructions.")]
+
+
+def test_nested_repeats_count_against_the_limit():
+    program = "repeat 100\nrepeat 100\npause 1\nend repeat\nend repeat"
+    with pytest.raises(ProgramError):
+        compile_program(program, max_instructions=1000, **SETTINGS)
+    assert len(compile_program(program, **SETTINGS).instructions) == 10000
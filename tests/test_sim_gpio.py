@@ -0,0 +1,11 @@
+from drivers import sim_gpio
+
+
+def test_recorded_events_are_bounded():
+    sim_gpio.reset()
+    for _ in range(sim_gpio.MAX_EVENTS):
+        sim_gpio.output(99, sim_gpio.HIGH)
+        sim_gpio.output(99, sim_gpio.LOW)
+    assert len(sim_gpio.events) == sim_gpio.MAX_EVENTS
+    assert len(sim_gpio.edges(99)) == sim_gpio.MAX_EVENTS // 2
+    sim_gpio.reset()
@@ -0,0 +1,29 @@
+import numpy as np
+
+from drivers.utils import lateness_stats
+
+
+def played(offsets, slowdown=1.0, late=0.0):
+    """Timing report of a pulse train played slowdown times slower, every pulse late by late s."""
+    n = len(offsets) - 1
+    planned = float(offsets[n])
+    return {'steps': n, 'elapsed': planned * slowdown, 'planned': planned,
+            **lateness_stats(np.full(n, late), np.asarray(offsets[:n]) * slowdown + late)}
+
+
+def test_drift_marks_the_calibration_due_without_recalibrating_mid_run(stepper):
+    offsets, _ = stepper.prepare_move(steps=200, speed=1)
+    report = stepper.finish_move(played(offsets, slowdown=1.5))
+
+    assert report['drifted']
+    assert stepper.recalibration_due
+    assert stepper._calibration_thread is None  # Nothing competes with the pulses of the next move
+
+    stepper.recalibrate(background=False)
+    assert not stepper.recalibration_due
+
+
+def test_on_time_move_does_not_drift(stepper):
+    offsets, _ = stepper.prepare_move(steps=200, speed=1)
+    report = stepper.finish_move(played(offsets))
+    assert not report['drifted'] and not stepper.recalibration_due
@@ -0,0 +1,40 @@
+import time
+
+import numpy as np
+
+from drivers import utils
+from drivers.utils import build_waveform, play_waveform, CATCH_UP
+
+PIN = {'STEP': {'number': 17}}
+PERIOD = 2E-3
+
+
+def stall_at(monkeypatch, pulse, duration):
+    """Make the GPIO output of the given rising edge block for duration seconds."""
+    output = utils.GPIO.output
+    edges = []
+
+    def stalling(number, level):
+        output(number, level)
+        if level == utils.GPIO.HIGH:
+            edges.append(number)
+            if len(edges) == pulse + 1:
+                time.sleep(duration)
+
+    monkeypatch.setattr(utils.GPIO, 'output', stalling)
+
+
+def test_steady_pulses_follow_their_deadlines():
+    report = play_waveform(build_waveform(50, PERIOD), PIN, 5E-6)
+    assert report['steps'] == 50
+    assert abs(np.median(np.diff(report['edges'])) - PERIOD) < 0.25 * PERIOD
+
+
+def test_stall_is_made_up_without_a_burst(monkeypatch):
+    stall_at(monkeypatch, pulse=10, duration=20 * PERIOD)
+    report = play_waveform(build_waveform(60, PERIOD), PIN, 5E-6)
+
+    intervals = np.diff(report['edges'])
+    assert report['max_late'] > 10 * PERIOD  # The stall happened
+    # Before, the ~20 missed pulses were fired back to back right after the stall
+    assert intervals[10:].min() > (1 - CATCH_UP) * PERIOD * 0.9
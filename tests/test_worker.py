@@ -0,0 +1,12 @@
+import os
+
+from drivers.worker import ProcessEngine
+
+
+def test_close_twice_is_harmless():
+    engine = ProcessEngine(data_size=1 << 12, result_size=1 << 10)
+    name = engine.shm.name
+    engine.close()
+    engine.close()  # As atexit does after an explicit close
+    assert engine.process.poll() is not None
+    assert not os.path.exists(os.path.join('/dev/shm', name.lstrip('/')))